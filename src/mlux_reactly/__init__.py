@@ -1,6 +1,8 @@
 
 from .agent import ReactlyAgent
-from .types import Tracer, ZeroTracer, Tool, LLM
+from .types import Tracer, ZeroTracer, Tool, ToolError, LLM, LLMRequest, LLMResponse, AgentConfig, StageRoute, StreamEvent
+from .llms import OllamaLLM, FakeLLM, RoutedLLM, RecordReplayLLM
+from .cache import CachedLLM, LLMCache, ToolResultCache, cached_tool
 
 
-#__all__ = ["ReactlyAgent", "Tracer", "ZeroTracer", "Tool", "LLM"]
+#__all__ = ["ReactlyAgent", "AgentConfig", "StageRoute", "StreamEvent", "Tracer", "ZeroTracer", "Tool", "ToolError", "LLM", "LLMRequest", "LLMResponse", "OllamaLLM", "FakeLLM", "RoutedLLM", "RecordReplayLLM", "CachedLLM", "LLMCache", "ToolResultCache", "cached_tool"]
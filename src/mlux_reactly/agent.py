@@ -1,10 +1,19 @@
 from typing import Any, List, Dict
-from typing import Callable
+from typing import Callable, AsyncIterator, Iterator
 from typing import get_origin, get_args, Annotated
 import inspect
+import asyncio
+import time
+from dataclasses import replace
 from io import StringIO
-from .types import LLM, Tool, ChatQA, Tracer, ZeroTracer, AgentConfig
-from .core import run_query
+from .types import LLM, Tool, ChatQA, Tracer, ZeroTracer, AgentConfig, StreamEvent
+from .llms import OllamaLLM, RoutedLLM
+from .core import run_query, ToolExecutors
+from .framework import run_sync, iterate_sync, warm_up_stages, track_token_usage
+from .stages import STAGES
+from .tool_index import ToolIndex, Embed, local_embed
+from .history import ChatHistory
+from .batching import BatchingLLM
 
 
 def describe(fn):
@@ -36,7 +45,25 @@ def tool_from_function(tool_fn: Tool | Callable) -> Tool:
     if isinstance(tool_fn, Tool):
         return tool_fn
     else:
-        return Tool(tool_fn.__name__, tool_fn.__doc__, describe(tool_fn), tool_fn)
+        return Tool(tool_fn.__name__, tool_fn.__doc__, describe(tool_fn), tool_fn, cache=getattr(tool_fn, 'tool_cache', None))
+
+
+class _ProgressTracer(Tracer):
+    """forwards to a tracer and emits task and toolrun events as StreamEvents"""
+
+    def __init__(self, tracer: Tracer, emit: Callable[[StreamEvent], None]):
+        self.tracer = tracer
+        self.emit = emit
+
+    def on(self, key: str, args: Dict[str, Any]) -> "_ProgressTracer":
+        if key == 'task':
+            self.emit(StreamEvent('task', args.get('task')))
+        elif key == 'toolrun':
+            self.emit(StreamEvent('toolrun', args['tool'].name))
+        return _ProgressTracer(self.tracer.on(key, args), self.emit)
+
+    def add_arg(self, arg_name: str, arg: Any):
+        self.tracer.add_arg(arg_name, arg)
 
 
 class ReactlyAgent:
@@ -44,16 +71,119 @@ class ReactlyAgent:
             self, 
             tools: List[Tool | Callable], *, 
             tracer: Tracer = ZeroTracer(),
-            llm = LLM("qwen2.5:7b-instruct-q8_0"),
+            llm: LLM|None = None,
             config: AgentConfig = AgentConfig()):
         self.tools = [tool_from_function(tool_fn) for tool_fn in tools]
-        self.llm = llm
+        self.llm = llm if llm is not None else OllamaLLM()
+        if config.stage_routes:
+            self.llm = RoutedLLM(self.llm, config.stage_routes)
         self.tracer = tracer
-        self.history: List[ChatQA] = []
         self.config = config
+        embed = local_embed if config.local_embeddings else self.llm.embed
+        self.tool_index = ToolIndex(self.tools, embed)
+        self.tool_executors = ToolExecutors(max_threads=config.tool_threads, max_processes=config.tool_processes)
+        self.history = self._new_history(embed)
 
-    def query(self, user_question: str) -> str:
-        response = run_query(user_question, self.history, self.tools, self.llm, self.tracer, self.config)
+    def close(self) -> None:
+        """Shuts down the thread and process pools of the sync tools. Tool runs that exceeded their timeout are abandoned, not waited for.
+        The pools are created again if the agent is used afterwards."""
+        self.tool_executors.shutdown()
+
+    async def aclose(self) -> None:
+        self.close()
+
+    def __enter__(self) -> 'ReactlyAgent':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    async def __aenter__(self) -> 'ReactlyAgent':
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    async def aquery(self, user_question: str) -> str:
+        response = await run_query(user_question, self.history, self.tools, self.llm, self.tracer, self.config, tool_index=self.tool_index, executors=self.tool_executors)
         self.history.append(ChatQA(user_question, response))
         return response
 
+    def query(self, user_question: str) -> str:
+        return run_sync(self.aquery(user_question))
+
+    def _new_history(self, embed: Embed) -> ChatHistory:
+        return ChatHistory(
+            keep_last=self.config.history_keep_last,
+            token_budget=self.config.history_token_budget,
+            retrieve_top_k=self.config.history_retrieve_top_k,
+            embed=embed)
+
+    async def aquery_many(self, user_questions: List[str], *, concurrency: int = 4, max_in_flight: int|None = None, priority: str = 'batch', return_exceptions: bool = False) -> List[str|BaseException]:
+        """Answers independent questions (without chat history), running up to `concurrency` queries at once.
+
+        The LLM requests of all queries share a `BatchingLLM`: at most `max_in_flight` (default: `concurrency`) requests
+        are sent to the backend at once, identical requests are sent once and embeddings are batched.
+        The requests have the LLM scheduler `priority`.
+        With `return_exceptions`, a failing query returns its exception instead of failing all."""
+        max_in_flight = max_in_flight or concurrency
+        config = replace(self.config, llm_priority=priority)
+        llm = BatchingLLM(self.llm, max_in_flight=max_in_flight)
+        embed = local_embed if self.config.local_embeddings else llm.embed
+        tool_index = self.tool_index.with_embed(embed)
+        tracer = self.tracer.on('query_many', {'nr_questions': len(user_questions), 'concurrency': concurrency, 'max_in_flight': max_in_flight})
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def answer(user_question: str) -> str:
+            async with semaphore:
+                return await run_query(user_question, self._new_history(embed), self.tools, llm, tracer, config, tool_index=tool_index, executors=self.tool_executors)
+
+        start_time = time.perf_counter()
+        with track_token_usage() as usage:
+            answers = await asyncio.gather(*[answer(q) for q in user_questions], return_exceptions=return_exceptions)
+        duration = time.perf_counter() - start_time
+        questions_per_min = len(user_questions) / duration * 60 if duration > 0 else 0.0
+        token_stats = {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens}
+        for arg_name, arg in (llm.stats() | token_stats | {'duration': duration, 'questions_per_min': questions_per_min}).items():
+            tracer.add_arg(arg_name, arg)
+        tracer.on('result', {'result': f"{len(user_questions)} questions in {duration:.1f}s ({questions_per_min:.1f} questions/min)"})
+        return answers
+
+    def query_many(self, user_questions: List[str], *, concurrency: int = 4, max_in_flight: int|None = None, priority: str = 'batch', return_exceptions: bool = False) -> List[str|BaseException]:
+        return run_sync(self.aquery_many(user_questions, concurrency=concurrency, max_in_flight=max_in_flight, priority=priority, return_exceptions=return_exceptions))
+
+    async def awarm_up(self) -> None:
+        """Loads the model and prefills the prompts of all stages, so the first queries do not pay for it."""
+        await warm_up_stages(STAGES, self.llm, self.tracer)
+
+    def warm_up(self) -> None:
+        run_sync(self.awarm_up())
+
+    async def aquery_stream(self, user_question: str) -> AsyncIterator[StreamEvent]:
+        """Yields progress events while the query runs, then the final answer in 'token' chunks and finally the whole 'answer'.
+        If generating the answer fails and is retried, a 'retry' event tells to discard the tokens streamed so far."""
+        events: asyncio.Queue[StreamEvent|None] = asyncio.Queue()
+        progress_tracer = _ProgressTracer(self.tracer, events.put_nowait)
+        on_token = lambda token: events.put_nowait(StreamEvent('token', token))
+        on_retry = lambda try_nr: events.put_nowait(StreamEvent('retry', try_nr))
+
+        async def run() -> str:
+            try:
+                return await run_query(user_question, self.history, self.tools, self.llm, progress_tracer, self.config, on_token=on_token, on_retry=on_retry, tool_index=self.tool_index, executors=self.tool_executors)
+            finally:
+                events.put_nowait(None)
+
+        query_run = asyncio.create_task(run())
+        try:
+            while (event := await events.get()) is not None:
+                yield event
+            response = await query_run
+        finally:
+            query_run.cancel()
+
+        self.history.append(ChatQA(user_question, response))
+        yield StreamEvent('answer', response)
+
+    def query_stream(self, user_question: str) -> Iterator[StreamEvent]:
+        return iterate_sync(self.aquery_stream(user_question))
+
@@ -0,0 +1,92 @@
+from typing import Any, Dict, List, Tuple, AsyncIterator
+from dataclasses import replace
+import asyncio
+from .types import LLM, LLMRequest, LLMResponse
+from .cache import hash_key
+
+
+class BatchingLLM(LLM):
+    """Wraps a LLM backend for many concurrent queries.
+
+    At most `max_in_flight` requests are sent to the backend at once, the others wait. Identical concurrent
+    requests are sent only once (not for retries or stages with `cache=False`), and `embed` calls issued in the
+    same event loop iteration are combined into a single backend call.
+
+    Bound to the event loop it is first used on."""
+
+    def __init__(self, llm: LLM, *, max_in_flight: int = 4):
+        self.llm = llm
+        self.max_in_flight = max_in_flight
+        self.coalesced = 0
+        self.embed_calls = 0
+        self.embed_batches = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._in_flight: Dict[str, asyncio.Future[LLMResponse]] = {}
+        self._pending_embeds: List[Tuple[List[str], asyncio.Future[List[List[float]]]]] = []
+        self._flush_task: asyncio.Future|None = None
+
+    @property
+    def model(self) -> str:
+        return self.llm.model
+
+    def options_for(self, stage: str) -> Dict[str, Any]:
+        return self.llm.options_for(stage)
+
+    async def _chat(self, request: LLMRequest) -> LLMResponse:
+        async with self._semaphore:
+            return await self.llm.chat(request)
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        if not request.cache or request.attempt > 0:
+            return await self._chat(request)
+
+        key = hash_key(self.model, request.stage, request.sys_prompt, request.prompt, request.options, request.format)
+        running = self._in_flight.get(key)
+        if running is not None:
+            self.coalesced += 1
+            return replace(await asyncio.shield(running))
+
+        running = self._in_flight[key] = asyncio.ensure_future(self._chat(request))
+        try:
+            return await asyncio.shield(running)
+        finally:
+            if running.done():
+                del self._in_flight[key]
+            else: # cancelled while waiting, others may still await it
+                running.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        async with self._semaphore:
+            async for chunk in self.llm.chat_stream(request):
+                yield chunk
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        self.embed_calls += 1
+        future: asyncio.Future[List[List[float]]] = asyncio.get_running_loop().create_future()
+        self._pending_embeds.append((texts, future))
+        if len(self._pending_embeds) == 1: # the flush runs after the other ready tasks had the chance to add their texts
+            self._flush_task = asyncio.ensure_future(self._flush_embeds())
+        return await future
+
+    async def _flush_embeds(self) -> None:
+        async with self._semaphore: # texts added while waiting for the semaphore join this batch
+            pending, self._pending_embeds = self._pending_embeds, []
+            unique_texts = list(dict.fromkeys(text for texts, _ in pending for text in texts))
+            self.embed_batches += 1
+            try:
+                vectors = await self.llm.embed(unique_texts)
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        by_text = dict(zip(unique_texts, vectors))
+        for texts, future in pending:
+            if not future.done():
+                future.set_result([by_text[text] for text in texts])
+
+    def stats(self) -> Dict[str, int]:
+        return {'coalesced': self.coalesced, 'embed_calls': self.embed_calls, 'embed_batches': self.embed_batches}
+
+    def __repr__(self) -> str:
+        return f"BatchingLLM({self.llm!r}, max_in_flight={self.max_in_flight})"
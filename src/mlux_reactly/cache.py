@@ -0,0 +1,289 @@
+from typing import Any, Callable, Dict, List, Tuple, AsyncIterator, TypeVar
+from collections import OrderedDict
+from dataclasses import replace
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from .types import LLM, LLMRequest, LLMResponse, Tool
+
+
+def hash_key(*parts: Any) -> str:
+    """content hash of JSON-serializable parts"""
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class LRUCache:
+    """Bounded in-memory cache evicting the least recently used entries beyond `max_entries` entries or `max_bytes` total size
+    (the sizes are given to put). Entries expire after `ttl` seconds (if set)."""
+
+    def __init__(self, max_entries: int = 1024, *, ttl: float|None = None, max_bytes: int|None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nr_bytes = 0
+        self._entries: OrderedDict[str, tuple[float, Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            created, value, size = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._entries[key]
+                self.nr_bytes -= size
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Any, size: int = 0) -> None:
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nr_bytes -= previous[2]
+            self._entries[key] = (time.time(), value, size)
+            self.nr_bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.nr_bytes > self.max_bytes and len(self._entries) > 1):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.nr_bytes -= evicted_size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteCache:
+    """Persistent string cache in a SQLite file. Entries expire after `ttl` seconds (if set),
+    the least recently used entries are evicted beyond `max_entries`."""
+
+    _EVICT_EVERY = 64
+
+    def __init__(self, path: str|Path, *, ttl: float|None = None, max_entries: int = 100_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._puts_since_evict = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key: str, default: str|None = None) -> str|None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            value, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return default
+            self._db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)", (key, value, now, now))
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= self._EVICT_EVERY:
+                self._puts_since_evict = 0
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class LLMCache:
+    """Two-tier cache for LLM responses: a bounded in-memory LRU and an optional persistent SQLite file at `path`."""
+
+    def __init__(
+            self,
+            max_entries: int = 1024, *,
+            path: str|Path|None = None,
+            ttl: float|None = None,
+            max_disk_entries: int = 100_000):
+        self.memory = LRUCache(max_entries, ttl=ttl)
+        self.disk = SqliteCache(path, ttl=ttl, max_entries=max_disk_entries) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> str|None:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.memory)}
+
+
+class CachedLLM(LLM):
+    """Wraps a LLM backend and serves repeated requests from a LLMCache.
+
+    Requests are keyed by a hash of model, prompts and options. Requests of stages created with `cache=False`
+    bypass the cache. Retries (attempt > 0) always query the backend and replace the cached response."""
+
+    def __init__(self, llm: LLM, cache: LLMCache|None = None):
+        self.llm = llm
+        self.cache = cache or LLMCache()
+
+    @property
+    def model(self) -> str:
+        return self.llm.model
+
+    def options_for(self, stage: str) -> Dict[str, Any]:
+        return self.llm.options_for(stage)
+
+    def request_key(self, request: LLMRequest) -> str:
+        return hash_key(self.model, request.sys_prompt, request.prompt, self.options_for(request.stage) | request.options, request.format)
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        if not request.cache:
+            return await self.llm.chat(request)
+
+        key = self.request_key(request)
+        if request.attempt == 0:
+            content = self.cache.get(key)
+            if content is not None:
+                return LLMResponse(content, cached=True)
+
+        response = await self.llm.chat(request)
+        self.cache.put(key, response.content)
+        response.cached = False
+        return response
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        if not request.cache:
+            async for chunk in self.llm.chat_stream(request):
+                yield chunk
+            return
+
+        key = self.request_key(request)
+        if request.attempt == 0:
+            content = self.cache.get(key)
+            if content is not None:
+                yield content
+                return
+
+        chunks: List[str] = []
+        async for chunk in self.llm.chat_stream(request):
+            chunks.append(chunk)
+            yield chunk
+        self.cache.put(key, ''.join(chunks))
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        return await self.llm.embed(texts)
+
+    def __repr__(self) -> str:
+        return f"CachedLLM({self.llm!r})"
+
+
+
+_MISSING = object()
+
+def canonical_input(value: Any) -> Any:
+    """tool input normalized for cache keys: only its structure (tuples as lists, keys are sorted by hash_key), never its values"""
+    if isinstance(value, dict):
+        return {str(k): canonical_input(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical_input(v) for v in value]
+    return value
+
+
+class ToolResultCache:
+    """Cache of the results of a tool, keyed by its canonical input. Failed tool runs are not cached.
+
+    `pure` tools (results depend only on the input) are cached until evicted, impure ones only if `ttl` is set.
+    The in-memory LRU holds at most `max_entries` results of together at most `max_bytes` (size of their JSON).
+    With `path`, JSON-serializable results are also kept in a SQLite file."""
+
+    def __init__(
+            self, *,
+            ttl: float|None = None,
+            pure: bool = True,
+            max_entries: int = 256,
+            max_bytes: int|None = None,
+            path: str|Path|None = None,
+            max_disk_entries: int = 100_000):
+        self.pure = pure
+        self.memory = LRUCache(max_entries, ttl=ttl, max_bytes=max_bytes)
+        self.disk = SqliteCache(path, ttl=ttl, max_entries=max_disk_entries) if path is not None else None
+        self.enabled = pure or ttl is not None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tool_name: str, input: Any) -> str:
+        return hash_key(tool_name, canonical_input(input))
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """(True, result) on a hit, (False, None) otherwise"""
+        value = self.memory.get(key, _MISSING)
+        if value is _MISSING and self.disk is not None:
+            serialized = self.disk.get(key)
+            if serialized is not None:
+                value = json.loads(serialized)
+                self.memory.put(key, value, len(serialized))
+        if value is _MISSING:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, value
+
+    def put(self, key: str, result: Any) -> None:
+        try:
+            serialized = json.dumps(result, ensure_ascii=False)
+        except (TypeError, ValueError):
+            serialized = None
+        self.memory.put(key, result, len(serialized) if serialized is not None else len(repr(result)))
+        if self.disk is not None and serialized is not None:
+            self.disk.put(key, serialized)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.memory), 'bytes': self.memory.nr_bytes}
+
+    def __deepcopy__(self, memo: Dict) -> 'ToolResultCache':
+        return self # copies of a tool share its cache
+
+
+ToolT = TypeVar('ToolT', bound=Tool|Callable)
+
+def cached_tool(
+        *,
+        ttl: float|None = None,
+        pure: bool = True,
+        max_entries: int = 256,
+        max_bytes: int|None = None,
+        path: str|Path|None = None) -> Callable[[ToolT], ToolT]:
+    """Decorator for tool functions (or wrapper for Tools) enabling a ToolResultCache for the tool.
+    The function stays callable as before."""
+    def decorate(tool_fn: ToolT) -> ToolT:
+        cache = ToolResultCache(ttl=ttl, pure=pure, max_entries=max_entries, max_bytes=max_bytes, path=path)
+        if isinstance(tool_fn, Tool):
+            return replace(tool_fn, cache=cache)
+        tool_fn.tool_cache = cache
+        return tool_fn
+    return decorate
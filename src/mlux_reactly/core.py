@@ -1,65 +1,264 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Iterable, Awaitable, Callable, Tuple
 from enum import Enum
 from dataclasses import dataclass, asdict
-from .types import LLM, Tool, Task, TaskResult, ChatQA, Tracer, Answer, AgentConfig
+from functools import partial
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import asyncio
+import inspect
+import threading
+from .types import LLM, Tool, ToolError, Task, TaskResult, ChatQA, Tracer, Answer, AgentConfig, T
 from .stages import enhance_user_question, split_question_into_tasks, enhance_task_description
-from .stages import rate_tools_for_task, make_tool_input, try_answer, rate_task_answer, ToolRunRecord
+from .stages import rate_tools_for_task, make_tool_input, plan_tool_calls, try_answer, rate_task_answer, ToolRunRecord, RatedTool, ToolCall
+from .framework import llm_priority, track_token_usage
+from .tool_index import ToolIndex
+from .shaping import shape_results
+from .history import ChatHistory
 
 
 
 
 
 
-def run_tool(tool: Tool, input: Dict[str, Any], caller_tracer: Tracer) -> Any:
+class ToolExecutors:
+    """The thread and process pools running sync tools, created on first use"""
+
+    def __init__(self, *, max_threads: int|None = None, max_processes: int|None = None):
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self._thread_pool: ThreadPoolExecutor|None = None
+        self._process_pool: ProcessPoolExecutor|None = None
+        self._lock = threading.Lock()
+
+    def executor(self, execution: str) -> Executor:
+        with self._lock:
+            if execution == 'process':
+                if self._process_pool is None:
+                    self._process_pool = ProcessPoolExecutor(self.max_processes)
+                return self._process_pool
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(self.max_threads, thread_name_prefix='mlux-reactly-tool')
+            return self._thread_pool
+
+    def shutdown(self) -> None:
+        """shuts the pools down without waiting for abandoned tool runs"""
+        with self._lock:
+            for pool in [self._thread_pool, self._process_pool]:
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            self._thread_pool = self._process_pool = None
+
+DEFAULT_TOOL_EXECUTORS = ToolExecutors()
+
+
+async def call_tool(tool: Tool, input: Dict[str, Any], executors: ToolExecutors = DEFAULT_TOOL_EXECUTORS) -> Any:
+    """awaits coroutine tools, sync tools are run according to their execution mode (by default in a thread to not block the event loop)"""
+    if inspect.iscoroutinefunction(tool.run):
+        return await tool.run(**input)
+    if tool.execution == 'inline':
+        result = tool.run(**input)
+    else:
+        result = await asyncio.get_running_loop().run_in_executor(executors.executor(tool.execution), partial(tool.run, **input))
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+async def gather_all(awaitables: Iterable[Awaitable[T]]) -> List[T]:
+    """like asyncio.gather, but cancels the remaining awaitables if one fails"""
+    futures = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*futures)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+async def run_tool(tool: Tool, input: Dict[str, Any], caller_tracer: Tracer, *, timeout: float|None = None, executors: ToolExecutors = DEFAULT_TOOL_EXECUTORS) -> Any:
+    """result of the tool run, or a ToolError if it failed or exceeded its timeout (tool.timeout if set, else timeout)"""
     tracer = caller_tracer.on("toolrun", {'tool': tool})
+    cache = tool.cache if tool.cache is not None and tool.cache.enabled else None
+    if cache is not None:
+        key = cache.key(tool.name, input)
+        hit, result = cache.get(key)
+        tracer.add_arg('cache_hit', hit)
+        if hit:
+            tracer.on("result", {'result': result})
+            return result
+    timeout = tool.timeout if tool.timeout is not None else timeout
     try:
-        result = tool.run(**input)
+        result = await asyncio.wait_for(call_tool(tool, input, executors), timeout)
+        if cache is not None:
+            cache.put(key, result)
         tracer.on("result", {'result': result})
+    except TimeoutError as e:
+        abandoned = not inspect.iscoroutinefunction(tool.run)
+        result = ToolError('timeout', f"the tool did not finish within {timeout}s, its result is not available")
+        tracer.on("failed", {'reason_code': 'timeout', 'result': result, 'exception': e, 'abandoned': abandoned})
     except Exception as e:
-        result = f"tool failed: {e}"
+        result = ToolError('exception', f"tool failed: {e}")
         tracer.on("failed", {'result': result, 'exception': e})
     return result
 
 
 
 
-def run_query(user_question: str, history: List[ChatQA], tools: List[Tool], llm: LLM, agent_tracer: Tracer, agent_config: AgentConfig) -> str:
-    query_tracer = agent_tracer.on("query", {'user_question': user_question})
+@dataclass
+class QueryStats:
+    """counters collected while answering a query, reported on the query event"""
+    rater_calls_skipped: int = 0
+
+
+def verify_answer(task: Task, answer: str, tool_results: List[ToolRunRecord], tracer: Tracer, agent_config: AgentConfig) -> float|None:
+    """satisfaction by the first confident answer verifier, None if none is confident"""
+    results = [record.result for record in tool_results]
+    for verifier in agent_config.answer_verifiers:
+        satisfaction = verifier(task.description, answer, results)
+        if satisfaction is not None:
+            tracer.on('answer_verified', {'verifier': getattr(verifier, '__name__', repr(verifier)), 'satisfaction': satisfaction})
+            return satisfaction
+    return None
+
+
+async def shortlist_tools(task: Task, tools: List[Tool], tool_index: ToolIndex|None, tracer: Tracer, agent_config: AgentConfig) -> Tuple[List[Tool], bool]:
+    """the tools shortlisted by the tool index (all tools if not configured) and whether the first one was found decisively"""
+    top_k = agent_config.tool_prefilter_top_k
+    margin = agent_config.tool_prefilter_decisive_margin
+    if tool_index is None or (top_k is None and margin is None):
+        return tools, False
+
+    k = top_k if top_k is not None else len(tools)
+    ranked = await tool_index.top_k(task.description, max(k, 2)) # the runner-up decides, even if it is not shortlisted
+    shortlist = ranked[:k]
+    prefilter_tracer = tracer.on('tool_prefilter', {'shortlist': {tool.name: round(score, 3) for tool, score in shortlist}})
+    # without a runner-up to compare with, a tool is never decisive
+    if margin is not None and len(ranked) >= 2 and len(shortlist) >= 1:
+        (best, best_score), (_, second_score) = ranked[0], ranked[1]
+        if best_score >= agent_config.tool_prefilter_decisive_min_score and best_score - second_score >= margin:
+            prefilter_tracer.on('result', {'result': f"decisive: {best.name}"})
+            return [best], True
+    return [tool for tool, _ in shortlist], False
 
-    enhanced_user_question = enhance_user_question(user_question, history, llm, query_tracer)
 
-    tasks: List[Task] = split_question_into_tasks(enhanced_user_question, tools, llm, query_tracer)
-    task_results: List[TaskResult] = []
+async def rate_tools(task: Task, tools: List[Tool], tool_index: ToolIndex|None, llm: LLM, tracer: Tracer, agent_config: AgentConfig) -> List[RatedTool]:
+    """LLM tool rating, with the tools shortlisted by the tool index beforehand (if configured)"""
+    candidates, decisive = await shortlist_tools(task, tools, tool_index, tracer, agent_config)
+    if decisive:
+        return [RatedTool(candidates[0], 1.0)]
+    return await rate_tools_for_task(task, candidates, llm, tracer)
 
-    for original_task in tasks:
-        tracer = query_tracer.on("task", {'task': original_task.description})
-        tool_results: List[ToolRunRecord] = []
 
-        task = Task(enhance_task_description(original_task.description, task_results, llm, tracer))
+async def plan_tools(task: Task, tools: List[Tool], tool_index: ToolIndex|None, llm: LLM, tracer: Tracer, agent_config: AgentConfig) -> List[ToolCall]:
+    """fused tool selection and input generation, with the tools shortlisted by the tool index beforehand (if configured)"""
+    candidates, _ = await shortlist_tools(task, tools, tool_index, tracer, agent_config)
+    if not candidates:
+        return []
+    return await plan_tool_calls(task, candidates, llm, tracer)
 
-        proposed_task_answers: List[TaskResult] = []
-        for try_nr in range(agent_config.max_nr_tries_per_task):
-            tracer.on('try', {'nr': try_nr})
-            rated_tools = rate_tools_for_task(task, tools, llm, tracer)
+
+async def run_task(original_task: Task, previous_results: List[TaskResult], tools: List[Tool], llm: LLM, query_tracer: Tracer, agent_config: AgentConfig, *, tool_index: ToolIndex|None = None, stats: QueryStats|None = None, executors: ToolExecutors = DEFAULT_TOOL_EXECUTORS) -> TaskResult|None:
+    tracer = query_tracer.on("task", {'task': original_task.description})
+    tool_results: List[ToolRunRecord] = []
+    tool_semaphore = asyncio.Semaphore(agent_config.max_parallel_tool_runs)
+
+    task = Task(await enhance_task_description(original_task.description, previous_results, llm, tracer))
+
+    proposed_task_answers: List[TaskResult] = []
+    for try_nr in range(agent_config.max_nr_tries_per_task):
+        try_tracer = tracer.on('try', {'nr': try_nr})
+
+        async def use_tool(tool: Tool, tool_input: Any|None = None) -> ToolRunRecord:
+            async with tool_semaphore:
+                if tool_input is None:
+                    tool_input = await make_tool_input(task, tool, llm, try_tracer)
+                tool_result = await run_tool(tool, tool_input, try_tracer, timeout=agent_config.tool_timeout, executors=executors)
+                return ToolRunRecord(tool.name, tool_input, tool_result)
+
+        if agent_config.tool_pipeline == 'fused':
+            tool_calls = await plan_tools(task, tools, tool_index, llm, try_tracer, agent_config)
+            tool_results.extend(await gather_all(use_tool(call.tool, call.input) for call in tool_calls))
+        else:
+            rated_tools = await rate_tools(task, tools, tool_index, llm, try_tracer, agent_config)
             rated_tools.sort(key=lambda rt: -rt.score)
+            selected_tools = [rt.tool for rt in rated_tools if rt.score >= agent_config.tool_use_rating_threshold]
+            tool_results.extend(await gather_all(use_tool(tool) for tool in selected_tools))
+
+        answer_inputs = shape_results(task.description, tool_results, try_tracer, max_result_tokens=agent_config.tool_result_max_tokens, max_total_tokens=agent_config.tool_results_max_tokens, model=llm.model)
+        task_answer = await try_answer(task.description, answer_inputs, llm, try_tracer)
+        satisfaction = verify_answer(task, task_answer, answer_inputs, try_tracer, agent_config)
+        if satisfaction is None:
+            satisfaction = await rate_task_answer(task.description, task_answer, llm, try_tracer)
+        elif stats is not None:
+            stats.rater_calls_skipped += 1
+
+        if satisfaction >= agent_config.task_answer_satisfaction_threshold:
+            tracer.on('result', {'result': task_answer})
+            return TaskResult(task.description, task_answer, satisfaction)
+        else:
+            proposed_task_answers.append(TaskResult(task.description, task_answer, satisfaction))
+            task = Task(await enhance_task_description(original_task.description, proposed_task_answers, llm, try_tracer))
+    tracer.on('failed', {'reason_code': 'unsatisfied', 'tries': agent_config.max_nr_tries_per_task})
+    return None
+
+
+def task_ancestors(tasks: List[Task], index: int) -> List[int]:
+    """indices of all tasks the task at index (transitively) depends on, in task order"""
+    ancestors = set()
+    pending = list(tasks[index].depends_on or [])
+    while pending:
+        dep = pending.pop()
+        if dep not in ancestors:
+            ancestors.add(dep)
+            pending.extend(tasks[dep].depends_on or [])
+    return sorted(ancestors)
+
+
+async def run_task_graph(tasks: List[Task], tools: List[Tool], llm: LLM, query_tracer: Tracer, agent_config: AgentConfig, *, tool_index: ToolIndex|None = None, stats: QueryStats|None = None, executors: ToolExecutors = DEFAULT_TOOL_EXECUTORS) -> List[TaskResult]:
+    """Runs each task as soon as the tasks it depends on are done, with at most agent_config.max_parallel_tasks tasks at once."""
+    semaphore = asyncio.Semaphore(agent_config.max_parallel_tasks)
+    results: List[TaskResult|None] = [None] * len(tasks)
+    runs: List[asyncio.Task] = []
+
+    async def run(index: int):
+        await asyncio.gather(*[runs[dep] for dep in tasks[index].depends_on or []])
+        previous_results = [r for r in (results[i] for i in task_ancestors(tasks, index)) if r is not None]
+        async with semaphore:
+            results[index] = await run_task(tasks[index], previous_results, tools, llm, query_tracer, agent_config, tool_index=tool_index, stats=stats, executors=executors)
+
+    for index in range(len(tasks)):
+        runs.append(asyncio.create_task(run(index)))
+    await gather_all(runs)
+    return [r for r in results if r is not None]
+
+
+async def run_query(user_question: str, history: ChatHistory, tools: List[Tool], llm: LLM, agent_tracer: Tracer, agent_config: AgentConfig, *, on_token: Callable[[str], None]|None = None, on_retry: Callable[[int], None]|None = None, tool_index: ToolIndex|None = None, executors: ToolExecutors = DEFAULT_TOOL_EXECUTORS) -> str:
+    """on_token: stream the final answer, calling on_token with each chunk.
+    on_retry: called with the try number before a retry of the final answer streams, the chunks streamed before are void then.
+    tool_index: used to shortlist tools, see AgentConfig.tool_prefilter_top_k
+    executors: the pools running the tools"""
+    with llm_priority(agent_config.llm_priority), track_token_usage() as usage:
+        query_tracer = agent_tracer.on("query", {'user_question': user_question})
+        stats = QueryStats()
+
+        history_context = await history.context(user_question, llm, query_tracer)
+        enhanced_user_question = await enhance_user_question(user_question, history_context.turns, llm, query_tracer, summary=history_context.summary)
+
+        run_parallel = agent_config.max_parallel_tasks > 1
+        tasks: List[Task] = await split_question_into_tasks(enhanced_user_question, tools, llm, query_tracer, with_dependencies=run_parallel)
+        task_results: List[TaskResult] = []
+
+        if run_parallel:
+            task_results = await run_task_graph(tasks, tools, llm, query_tracer, agent_config, tool_index=tool_index, stats=stats, executors=executors)
+        else:
+            for original_task in tasks:
+                task_result = await run_task(original_task, task_results, tools, llm, query_tracer, agent_config, tool_index=tool_index, stats=stats, executors=executors)
+                if task_result is not None:
+                    task_results.append(task_result)
 
-            for rated_tool in rated_tools:
-                if rated_tool.score < agent_config.tool_use_rating_threshold:
-                    break
-                tool_input = make_tool_input(task, rated_tool.tool, llm, tracer)
-                tool_result = run_tool(rated_tool.tool, tool_input, tracer)
-                tool_results.append(ToolRunRecord(rated_tool.tool.name, tool_input, tool_result))
-
-            task_answer = try_answer(task.description, tool_results, llm, tracer)
-            satisfaction = rate_task_answer(task.description, task_answer, llm, tracer)
-
-            if satisfaction >= agent_config.task_answer_satisfaction_threshold:
-                task_results.append(TaskResult(task.description, task_answer, satisfaction))
-                break
-            else:
-                proposed_task_answers.append(TaskResult(task.description, task_answer, satisfaction))
-                task = Task(enhance_task_description(original_task.description, proposed_task_answers, llm, tracer))
-        
-    answer = str(try_answer(enhanced_user_question, [ToolRunRecord('subtask', t.task, t.result) for t in task_results], llm, query_tracer))
-    query_tracer.on('result', {'result': answer})
-    return answer
+        answer_inputs = shape_results(enhanced_user_question, [ToolRunRecord('subtask', t.task, t.result) for t in task_results], query_tracer, max_result_tokens=agent_config.tool_result_max_tokens, max_total_tokens=agent_config.tool_results_max_tokens, model=llm.model)
+        answer = str(await try_answer(enhanced_user_question, answer_inputs, llm, query_tracer, on_token=on_token, on_retry=on_retry))
+        query_tracer.add_arg('rater_calls_skipped', stats.rater_calls_skipped)
+        query_tracer.add_arg('prompt_tokens', usage.prompt_tokens)
+        query_tracer.add_arg('completion_tokens', usage.completion_tokens)
+        query_tracer.on('result', {'result': answer})
+        return answer
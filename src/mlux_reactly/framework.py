@@ -1,9 +1,18 @@
-from typing import Callable, Any, Tuple, List, Dict
+from typing import Callable, Any, Tuple, List, Dict, Awaitable, AsyncIterable, AsyncIterator, Iterator
 from dataclasses import dataclass, asdict, is_dataclass, replace, field
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
 from enum import Enum
+import asyncio
+import heapq
+import inspect
+import os
+import threading
+import time
+import math
 import json
-import ollama
-from .types import LLM, Tracer, _UNUSED_sentinel
+import re
+from .types import LLM, LLMRequest, Tracer, ZeroTracer, T, _UNUSED_sentinel
 
 
 @dataclass
@@ -15,8 +24,10 @@ class FormatDescr:
     preshape_requires_type: type|None
     is_plain_text: bool
     label: str
+    schema: Dict[str, Any]|None = None # JSON schema of the format, used to constrain LLM output
+    shrinkable: bool = False # for list inputs: the first (oldest) elements may be left out if the prompt exceeds the context window
 
-    def as_list(self, label: str = '', *, add_rules: List[str] = []):
+    def as_list(self, label: str = '', *, add_rules: List[str] = [], shrinkable: bool = False):
         return FormatDescr(
             template=f"[{self.template}]",
             rules=self.rules + add_rules,
@@ -25,12 +36,34 @@ class FormatDescr:
             preshape_requires_type=list,
             default=[],
             is_plain_text=False,
-            label=label
+            label=label,
+            schema={'type': 'array', 'items': self.schema} if self.schema is not None else None,
+            shrinkable=shrinkable
         )
 
     def with_label(self, new_label: str) -> 'FormatDescr':
         return replace(self, label=new_label)
 
+def schema_from_template(template: Any) -> Dict[str, Any]:
+    """JSON schema for values shaped like the template. All keys of objects are required"""
+    if isinstance(template, bool):
+        return {'type': 'boolean'}
+    if isinstance(template, int):
+        return {'type': 'integer'}
+    if isinstance(template, float):
+        return {'type': 'number'}
+    if isinstance(template, str):
+        return {'type': 'string'}
+    if isinstance(template, list):
+        return {'type': 'array', 'items': schema_from_template(template[0])} if template else {'type': 'array'}
+    if isinstance(template, dict):
+        return {
+            'type': 'object',
+            'properties': {k: schema_from_template(v) for k, v in template.items()},
+            'required': list(template.keys()),
+        }
+    return {}
+
 def make_format(
         template: Any,
         *, 
@@ -39,8 +72,11 @@ def make_format(
         preshape_fn: Callable[[Any], Any] | None = None,
         preshape_requires_type: type|None = None,
         is_plain_text: bool = False,
-        label: str = ""
+        label: str = "",
+        schema: Dict[str, Any]|None = None,
+        shrinkable: bool = False
     ) -> FormatDescr:
+    """schema: JSON schema of the format. Derived from template if not given (keys of objects in template must then be fixed)"""
     return FormatDescr(
         template=format_data_explicit(template, None, ctx='make_format_descr:' + label),
         rules=rules,
@@ -49,6 +85,8 @@ def make_format(
         preshape_requires_type=preshape_requires_type,
         is_plain_text=is_plain_text,
         label=label,
+        schema=None if is_plain_text else (schema if schema is not None else schema_from_template(template)),
+        shrinkable=shrinkable,
     )
 
 @dataclass
@@ -59,23 +97,419 @@ class Stage:
     output_format: FormatDescr
     tries: int
     or_return: Any # return this if stage failed
+    cache: bool = True # whether LLM responses for this stage may be cached
+    output_schema: Dict[str, Any]|None = None # constrains the LLM output, if the backend supports it
 
 
 
-def call_llm(sys_prompt: str, conversation_section: str, llm: LLM, *, tracer: Tracer) -> str:
-    tracer = tracer.on('llmcall', {'sys_prompt': sys_prompt, 'prompt': conversation_section})
+DEFAULT_NUM_CTX = 4096
+"""context window assumed if the backend options set no num_ctx (Ollama's default)"""
+DEFAULT_OUTPUT_RESERVE = 512
+"""tokens kept free for the response if the backend options set no num_predict"""
 
-    messages = []
-    if sys_prompt:
-        messages.append({'role': 'system', 'content': sys_prompt})
-    messages.append({'role': 'user','content': conversation_section})
-    response_ollama = ollama.chat(
-            model=llm.model,
-            messages=messages,
-    )
-    response_content = str(response_ollama["message"]["content"])
-    tracer.on('result', {'result': response_content})
-    return response_content
+
+class TokenEstimator:
+    """Estimates the number of tokens of a text from its length.
+
+    The characters per token of each model are calibrated with the prompt token counts reported by the backend
+    (moving average). The backend only counts the prompt tokens it did not reuse from its prompt cache, which would
+    inflate the ratio, so only the first request with each system prompt (i.e. of each stage) per model is used:
+    a prompt prefix the backend has not seen before cannot be cached. Ratios outside `plausible` are ignored."""
+
+    DEFAULT_CHARS_PER_TOKEN = 4.0
+
+    def __init__(self, *, smoothing: float = 0.2, plausible: Tuple[float, float] = (1.5, 6.0)):
+        self.smoothing = smoothing
+        self.plausible = plausible
+        self._chars_per_token: Dict[str, float] = {}
+        self._seen_prefixes: set[Tuple[str, int]] = set()
+        self._lock = threading.Lock()
+
+    def chars_per_token(self, model: str|None = None) -> float:
+        return self._chars_per_token.get(model, self.DEFAULT_CHARS_PER_TOKEN) if model is not None else self.DEFAULT_CHARS_PER_TOKEN
+
+    def estimate(self, text: str, model: str|None = None) -> int:
+        return math.ceil(len(text) / self.chars_per_token(model))
+
+    def truncate(self, text: str, max_tokens: int, model: str|None = None) -> str:
+        """the start of text with about max_tokens tokens"""
+        return text[:max(0, int(max_tokens * self.chars_per_token(model)))]
+
+    def observe(self, model: str, nr_chars: int, nr_tokens: int, *, prefix: str = '') -> None:
+        """calibrates model with a prompt of nr_chars characters that had nr_tokens tokens, if it is the first prompt of model starting with prefix"""
+        if nr_tokens <= 0:
+            return
+        ratio = nr_chars / nr_tokens
+        with self._lock:
+            seen = (model, hash(prefix))
+            if seen in self._seen_prefixes:
+                return
+            self._seen_prefixes.add(seen)
+            if not self.plausible[0] <= ratio <= self.plausible[1]:
+                return
+            current = self._chars_per_token.get(model)
+            self._chars_per_token[model] = ratio if current is None else current + self.smoothing * (ratio - current)
+
+TOKEN_ESTIMATOR = TokenEstimator()
+
+
+def estimate_tokens(text: str, model: str|None = None) -> int:
+    """number of LLM tokens of text, estimated with TOKEN_ESTIMATOR"""
+    return TOKEN_ESTIMATOR.estimate(text, model)
+
+def truncate_tokens(text: str, max_tokens: int, model: str|None = None) -> str:
+    """text cut to about max_tokens LLM tokens, estimated with TOKEN_ESTIMATOR"""
+    return TOKEN_ESTIMATOR.truncate(text, max_tokens, model)
+
+
+def context_budget(llm: LLM, stage: 'Stage') -> int:
+    """number of tokens available for the inputs of stage: the context window without the static prompt and the response"""
+    options = llm.options_for(stage.name)
+    num_predict = options.get('num_predict') or 0
+    reserve = num_predict if num_predict > 0 else DEFAULT_OUTPUT_RESERVE
+    return options.get('num_ctx', DEFAULT_NUM_CTX) - estimate_tokens(stage.static_prompt, llm.model) - reserve
+
+
+@dataclass
+class TokenUsage:
+    """token counts of the LLM calls made while tracking (see track_token_usage)"""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    llm_calls: int = 0
+    parent: 'TokenUsage|None' = None
+
+    def add(self, prompt_tokens: int, completion_tokens: int) -> None:
+        usage: TokenUsage|None = self
+        while usage is not None:
+            usage.prompt_tokens += prompt_tokens
+            usage.completion_tokens += completion_tokens
+            usage.llm_calls += 1
+            usage = usage.parent
+
+current_token_usage: ContextVar[TokenUsage|None] = ContextVar('current_token_usage', default=None)
+
+@contextmanager
+def track_token_usage() -> Iterator[TokenUsage]:
+    """sums up the tokens of the LLM calls made within this context (also by tasks created in it), nested trackers included"""
+    usage = TokenUsage(parent=current_token_usage.get())
+    token = current_token_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        current_token_usage.reset(token)
+
+
+
+_background_loop: asyncio.AbstractEventLoop | None = None
+_background_thread: threading.Thread | None = None
+_background_loop_lock = threading.Lock()
+
+def _forget_background_loop() -> None:
+    """a forked child does not inherit the thread running the background loop, it starts its own on demand"""
+    global _background_loop, _background_thread, _background_loop_lock
+    _background_loop = None
+    _background_thread = None
+    _background_loop_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_background_loop)
+
+def run_sync(awaitable: Awaitable[T]) -> T:
+    """Runs awaitable to completion for sync callers, blocking the calling thread (and its event loop, if one is running in it).
+    Everything runs on one persistent background event loop, so async clients and their pooled connections are reused between calls.
+
+    It can not be called from the background loop itself (e.g. by an inline tool calling the sync `query` of another agent):
+    blocking the loop would stall the LLM scheduler and deadlock. Such callers have to await the async variant (`aquery`) instead."""
+    global _background_loop, _background_thread
+    if threading.current_thread() is _background_thread:
+        if inspect.iscoroutine(awaitable):
+            awaitable.close()
+        raise RuntimeError("run_sync was called from the running background event loop, which it would block; await the async variant (e.g. `aquery`) instead")
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            _background_thread = threading.Thread(target=_background_loop.run_forever, name='mlux-reactly-loop', daemon=True)
+            _background_thread.start()
+
+    async def run():
+        return await awaitable
+    return asyncio.run_coroutine_threadsafe(run(), _background_loop).result()
+
+def iterate_sync(aiterable: AsyncIterable[T]) -> Iterator[T]:
+    """sync iterator over an async iterable, which is iterated on the background event loop of run_sync"""
+    aiterator = aiterable.__aiter__()
+    try:
+        while True:
+            try:
+                yield run_sync(anext(aiterator))
+            except StopAsyncIteration:
+                return
+    finally:
+        aclose = getattr(aiterator, 'aclose', None)
+        if aclose is not None:
+            run_sync(aclose())
+
+
+
+PRIORITIES = {'interactive': 0, 'batch': 1}
+"""priority classes of LLM requests, lower values are served first"""
+
+current_llm_priority: ContextVar[str] = ContextVar('current_llm_priority', default='interactive')
+
+@contextmanager
+def llm_priority(priority: str) -> Iterator[None]:
+    """LLM requests made within this context (also by tasks created in it) get priority"""
+    assert priority in PRIORITIES, f"unknown priority '{priority}'"
+    token = current_llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_llm_priority.reset(token)
+
+
+class LLMSchedulerRejected(Exception):
+    """a LLM request was rejected by the LLMScheduler (backpressure)"""
+
+
+@dataclass
+class SchedulerLimits:
+    max_concurrency: int|None = None
+    """maximal number of requests in flight"""
+    requests_per_second: float|None = None
+    """token bucket rate limit"""
+    burst: int = 1
+    """token bucket size, i.e. number of requests that may be sent at once after a pause"""
+    max_queue: int|None = None
+    """if this many requests are waiting, further requests are rejected. None waits without bound"""
+    max_wait: float|None = None
+    """requests waiting longer (in seconds) are rejected"""
+
+
+@dataclass
+class _Waiter:
+    loop: asyncio.AbstractEventLoop
+    future: asyncio.Future
+    granted: bool = False
+    abandoned: bool = False
+
+@dataclass
+class _ModelState:
+    limits: SchedulerLimits
+    queue: List[Tuple[int, int, _Waiter]] = field(default_factory=list)
+    nr_queued: int = 0
+    running: int = 0
+    tokens: float = 0.0
+    refilled: float = 0.0
+    refill_scheduled: bool = False
+    granted: int = 0
+    rejected: int = 0
+    total_wait: float = 0.0
+    max_wait_seen: float = 0.0
+
+
+class LLMScheduler:
+    """Process-wide scheduler of LLM requests with limits per model.
+
+    The backends that send requests to a model take a `slot` of that model, wrappers (caches, routing, batching) do not,
+    so cache hits and coalesced requests are not counted. Waiting requests are served by priority, then in order of arrival.
+    Thread safe, requests may come from different event loops. Requests to models without limits are not scheduled."""
+
+    def __init__(self, limits: Dict[str, SchedulerLimits]|None = None, *, default_limits: SchedulerLimits|None = None):
+        self.default_limits = default_limits
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._states: Dict[str, _ModelState] = {}
+        for model, model_limits in (limits or {}).items():
+            self.set_limits(model, model_limits)
+
+    def set_limits(self, model: str, limits: SchedulerLimits|None) -> None:
+        """sets the limits of model (None: unlimited). Requests already waiting or running keep the old limits"""
+        with self._lock:
+            if limits is None:
+                self._states.pop(model, None)
+            else:
+                self._states[model] = _ModelState(limits, tokens=float(limits.burst), refilled=time.monotonic())
+
+    def _state(self, model: str) -> _ModelState|None:
+        state = self._states.get(model)
+        if state is None and self.default_limits is not None:
+            state = self._states[model] = _ModelState(self.default_limits, tokens=float(self.default_limits.burst), refilled=time.monotonic())
+        return state
+
+    def _refill(self, state: _ModelState) -> None:
+        now = time.monotonic()
+        if state.limits.requests_per_second is not None:
+            state.tokens = min(float(state.limits.burst), state.tokens + (now - state.refilled) * state.limits.requests_per_second)
+        state.refilled = now
+
+    def _dispatch(self, model: str, state: _ModelState) -> None:
+        """grants waiting requests as far as the limits allow. Must be called with the lock held"""
+        limits = state.limits
+        while state.queue:
+            waiter = state.queue[0][2]
+            if waiter.abandoned or waiter.loop.is_closed(): # cancelled, or its event loop ended without cancelling it
+                heapq.heappop(state.queue)
+                if not waiter.abandoned:
+                    waiter.abandoned = True
+                    state.nr_queued -= 1
+                continue
+            if limits.max_concurrency is not None and state.running >= limits.max_concurrency:
+                return
+            if limits.requests_per_second is not None:
+                self._refill(state)
+                if state.tokens < 1.0:
+                    if not state.refill_scheduled:
+                        # not a timer of the waiter's event loop, which may end before it fires and leave the queue stuck
+                        state.refill_scheduled = True
+                        delay = (1.0 - state.tokens) / limits.requests_per_second
+                        timer = threading.Timer(delay, self._on_refill, (model, state))
+                        timer.daemon = True
+                        timer.start()
+                    return
+            heapq.heappop(state.queue)
+            state.nr_queued -= 1
+            try:
+                waiter.loop.call_soon_threadsafe(_resolve_waiter, waiter.future)
+            except RuntimeError: # the event loop closed meanwhile
+                waiter.abandoned = True
+                continue
+            if limits.requests_per_second is not None:
+                state.tokens -= 1.0
+            state.running += 1
+            state.granted += 1
+            waiter.granted = True
+
+    def _on_refill(self, model: str, state: _ModelState) -> None:
+        with self._lock:
+            state.refill_scheduled = False
+            self._dispatch(model, state)
+
+    async def acquire(self, model: str, priority: str = 'interactive') -> Tuple[_ModelState|None, Dict[str, Any]]:
+        """Waits until a request to model may be sent, returns the model state for release and the scheduling metrics.
+        Raises LLMSchedulerRejected if max_queue requests are waiting already or the request waited longer than max_wait."""
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop, loop.create_future())
+        start = time.perf_counter()
+        with self._lock:
+            state = self._state(model)
+            if state is None:
+                return None, {}
+            queue_depth = state.nr_queued
+            if state.limits.max_queue is not None and queue_depth >= state.limits.max_queue:
+                state.rejected += 1
+                raise LLMSchedulerRejected(f"{queue_depth} requests to {model} are waiting already")
+            self._seq += 1
+            heapq.heappush(state.queue, (PRIORITIES[priority], self._seq, waiter))
+            state.nr_queued += 1
+            self._dispatch(model, state)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), state.limits.max_wait)
+        except (asyncio.CancelledError, TimeoutError) as e:
+            with self._lock:
+                if waiter.granted:
+                    state.running -= 1
+                else:
+                    waiter.abandoned = True
+                    state.nr_queued -= 1
+                    if isinstance(e, TimeoutError):
+                        state.rejected += 1
+                self._dispatch(model, state)
+            if isinstance(e, TimeoutError):
+                raise LLMSchedulerRejected(f"request to {model} waited longer than {state.limits.max_wait}s") from e
+            raise
+
+        wait = time.perf_counter() - start
+        with self._lock:
+            state.total_wait += wait
+            state.max_wait_seen = max(state.max_wait_seen, wait)
+        return state, {'queue_depth': queue_depth, 'queue_wait': wait, 'priority': priority}
+
+    def release(self, model: str, state: _ModelState) -> None:
+        with self._lock:
+            state.running -= 1
+            self._dispatch(model, state)
+
+    @asynccontextmanager
+    async def slot(self, model: str, tracer: Tracer|None = None) -> AsyncIterator[None]:
+        """holds a request slot of model (with the current llm_priority) and adds the scheduling metrics to tracer
+        (default: the llmcall event of the current call_llm)"""
+        state, metrics = await self.acquire(model, current_llm_priority.get())
+        tracer = tracer if tracer is not None else current_llmcall_tracer.get()
+        for arg_name, arg in metrics.items():
+            tracer.add_arg(arg_name, arg)
+        try:
+            yield
+        finally:
+            if state is not None:
+                self.release(model, state)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {model: {
+                'running': state.running,
+                'queued': state.nr_queued,
+                'granted': state.granted,
+                'rejected': state.rejected,
+                'avg_wait': state.total_wait / state.granted if state.granted else 0.0,
+                'max_wait': state.max_wait_seen,
+            } for model, state in self._states.items()}
+
+def _resolve_waiter(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+LLM_SCHEDULER = LLMScheduler()
+"""the scheduler the requests of all backends go through. Unlimited unless limits are set"""
+
+current_llmcall_tracer: ContextVar[Tracer] = ContextVar('current_llmcall_tracer', default=ZeroTracer())
+"""the llmcall event of the running call_llm, the scheduling metrics of the backend are added to it"""
+
+
+
+async def call_llm(request: LLMRequest, llm: LLM, *, tracer: Tracer, on_token: Callable[[str], None]|None = None) -> str:
+    tracer = tracer.on('llmcall', {'model': llm.model, 'stage': request.stage, 'sys_prompt': request.sys_prompt, 'prompt': request.prompt})
+
+    token = current_llmcall_tracer.set(tracer)
+    try:
+        if on_token is not None:
+            chunks: List[str] = []
+            async for chunk in llm.chat_stream(request):
+                on_token(chunk)
+                chunks.append(chunk)
+            content = ''.join(chunks)
+            _record_tokens(request, llm.model, content, None, tracer)
+            tracer.on('result', {'result': content})
+            return content
+
+        response = await llm.chat(request)
+    finally:
+        current_llmcall_tracer.reset(token)
+
+    if response.model is not None:
+        tracer.add_arg('model', response.model)
+    if response.cached is not None:
+        tracer.add_arg('cache', 'hit' if response.cached else 'miss')
+    if response.prompt_eval_time is not None:
+        tracer.add_arg('prompt_eval_count', response.prompt_eval_count)
+        tracer.add_arg('prompt_eval_time', response.prompt_eval_time)
+    model = response.model or llm.model
+    if response.prompt_eval_count and not response.cached:
+        TOKEN_ESTIMATOR.observe(model, len(request.sys_prompt) + len(request.prompt), response.prompt_eval_count, prefix=request.sys_prompt)
+    _record_tokens(request, model, response.content, response.eval_count, tracer)
+    tracer.on('result', {'result': response.content})
+    return response.content
+
+
+def _record_tokens(request: LLMRequest, model: str, content: str, completion_tokens: int|None, tracer: Tracer) -> None:
+    """adds the prompt and completion tokens of a call to its llmcall event and the tracked token usage"""
+    prompt_tokens = estimate_tokens(request.sys_prompt, model) + estimate_tokens(request.prompt, model)
+    if completion_tokens is None:
+        completion_tokens = estimate_tokens(content, model)
+    tracer.add_arg('prompt_tokens', prompt_tokens)
+    tracer.add_arg('completion_tokens', completion_tokens)
+    usage = current_token_usage.get()
+    if usage is not None:
+        usage.add(prompt_tokens, completion_tokens)
 
 
 
@@ -97,6 +531,34 @@ def serialize_data(data) -> str:
     return json.dumps(serializable, ensure_ascii=False)
 
 
+_code_fence_re = re.compile(r"```[a-zA-Z]*\s*(.*?)```", re.DOTALL)
+
+def extract_json(text: str) -> Any:
+    """Parses the JSON value in an LLM response, tolerating code fences and text around the value.
+    Raises the error of parsing the whole text if no JSON value is found."""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        error = e
+
+    fenced = _code_fence_re.search(text)
+    if fenced:
+        try:
+            return json.loads(fenced.group(1))
+        except json.JSONDecodeError:
+            pass
+
+    decoder = json.JSONDecoder()
+    for start, char in enumerate(text):
+        if char in '{[':
+            try:
+                value, _ = decoder.raw_decode(text, start)
+                return value
+            except json.JSONDecodeError:
+                continue
+    raise error
+
+
 def format_data_explicit(data, preshape_fn: Callable[[Any], Any] | None, *, ctx: str = "", preshape_required: bool = True) -> str:
     try:
         data = data if preshape_fn is None else preshape_fn(data)
@@ -116,14 +578,32 @@ def format_data(data, format: FormatDescr, *, ctx: str = "", preshape_required:
 
 
 
-def generate_conversation(data: Dict[str, Any], inputs: List[FormatDescr], output: FormatDescr, with_output: bool = False, ctx: str = ""):
+def generate_conversation(
+        data: Dict[str, Any],
+        inputs: List[FormatDescr],
+        output: FormatDescr,
+        with_output: bool = False,
+        ctx: str = "", *,
+        max_tokens: int|None = None,
+        model: str|None = None,
+        tracer: Tracer = ZeroTracer()):
+    """max_tokens: if the inputs exceed this number of tokens, the first elements of the largest shrinkable inputs
+    are left out until they fit (or cannot be shrunk further), traced as 'input_shrunk' event"""
     unhandled_input_labels = set(data.keys())
 
-    conversation_section: str = ""
+    values: Dict[str, Any] = {}
+    formatted: Dict[str, str] = {}
     for input in inputs:
-        input_value = data.get(input.label, input.default)
+        values[input.label] = data.get(input.label, input.default)
         unhandled_input_labels.discard(input.label)
-        conversation_section += f"{input.label}: {format_data(input_value, input, ctx=ctx+f": generate_conversation input {input.label}")}\n"
+        formatted[input.label] = format_data(values[input.label], input, ctx=ctx+f": generate_conversation input {input.label}")
+
+    if max_tokens is not None:
+        shrink_inputs(values, formatted, inputs, max_tokens, model=model, tracer=tracer, ctx=ctx)
+
+    conversation_section: str = ""
+    for input in inputs:
+        conversation_section += f"{input.label}: {formatted[input.label]}\n"
 
     conversation_section += f"{output.label}: "
     if with_output:
@@ -139,6 +619,28 @@ def generate_conversation(data: Dict[str, Any], inputs: List[FormatDescr], outpu
     return conversation_section
 
 
+def shrink_inputs(values: Dict[str, Any], formatted: Dict[str, str], inputs: List[FormatDescr], max_tokens: int, *, model: str|None, tracer: Tracer, ctx: str = "") -> None:
+    """leaves out the first element of the largest shrinkable list input until all inputs fit into max_tokens. Updates values and formatted"""
+    tokens = {label: estimate_tokens(text, model) for label, text in formatted.items()}
+    tokens_before = sum(tokens.values())
+    if tokens_before <= max_tokens:
+        return
+
+    dropped: Dict[str, int] = {}
+    while sum(tokens.values()) > max_tokens:
+        candidates = [input for input in inputs if input.shrinkable and isinstance(values[input.label], list) and len(values[input.label]) > 1]
+        if not candidates:
+            break
+        largest = max(candidates, key=lambda input: tokens[input.label]) # the first of equally large ones
+        values[largest.label] = values[largest.label][1:]
+        formatted[largest.label] = format_data(values[largest.label], largest, ctx=ctx+f": shrink_inputs {largest.label}")
+        tokens[largest.label] = estimate_tokens(formatted[largest.label], model)
+        dropped[largest.label] = dropped.get(largest.label, 0) + 1
+
+    tokens_after = sum(tokens.values())
+    tracer.on('input_shrunk', {'dropped': dropped, 'tokens': tokens_before, 'kept_tokens': tokens_after, 'max_tokens': max_tokens, 'overflow': tokens_after > max_tokens})
+
+
 def generate_static_prompt(
         stage_description: str, 
         rules: List[str],
@@ -204,8 +706,11 @@ def make_stage(
         tries: int = 1,
         good_examples: List[Dict[str, Any]] = [],
         bad_examples: List[Dict[str, Any]] = [],
-        or_return: Any = _UNUSED_sentinel
+        or_return: Any = _UNUSED_sentinel,
+        cache: bool = True,
+        constrained: bool = True
 ):
+    """constrained: let the LLM backend enforce the JSON schema of the output format"""
     inputs = input_formats = [as_format_descr(format) for format in inputs]
     output = output_format = as_format_descr(output)
     return Stage(
@@ -214,15 +719,21 @@ def make_stage(
         input_formats,
         output_format,
         tries,
-        or_return
+        or_return,
+        cache,
+        output_format.schema if constrained else None
     )
 
 
-def run_stage(stage: Stage, input_data: Dict[str, Any], llm: LLM, tracer: Tracer, *, post_fn: Callable|None = None):
+async def run_stage(stage: Stage, input_data: Dict[str, Any], llm: LLM, tracer: Tracer, *, post_fn: Callable|None = None, on_token: Callable[[str], None]|None = None, on_retry: Callable[[int], None]|None = None):
+    """on_token: stream the LLM response, calling on_token with each chunk. Only useful for plain text outputs
+    on_retry: called with the try number before a retry streams, the chunks streamed by the failed tries are void then"""
     tracer = tracer.on("stage", {'name': stage.name})
 
     try:
-        conversation_section = generate_conversation(input_data, inputs=stage.input_formats, output=stage.output_format, ctx="stage_run")
+        conversation_section = generate_conversation(
+            input_data, inputs=stage.input_formats, output=stage.output_format, ctx="stage_run",
+            max_tokens=context_budget(llm, stage), model=llm.model, tracer=tracer)
     except Exception as e:
         tracer.on('failed', {'reason_code': 'generate_conversation', 'exception': e})
         return stage.or_return
@@ -234,12 +745,17 @@ def run_stage(stage: Stage, input_data: Dict[str, Any], llm: LLM, tracer: Tracer
             try_tracer = tracer.on('try', {'nr': try_nr})
 
             err_reason_code = 'llm'
-            llm_response = call_llm(stage.static_prompt, conversation_section, llm, tracer=try_tracer)
+            request = LLMRequest(stage.static_prompt, conversation_section, stage.name, attempt=try_nr, cache=stage.cache, format=stage.output_schema)
+            if try_nr > 0 and on_token is not None and on_retry is not None:
+                on_retry(try_nr)
+            llm_response = await call_llm(request, llm, tracer=try_tracer, on_token=on_token)
             err_reason_code = 'json_parsing'
             try:
-                parsed_result = json.loads(llm_response)
+                parsed_result = json.loads(llm_response) if stage.output_format.is_plain_text else extract_json(llm_response)
             except Exception as e:
                 if stage.output_format.is_plain_text:
+                    tracer.add_arg('retries', try_nr)
+                    tracer.on('result', {'result': llm_response})
                     return llm_response
                 else:
                     raise e
@@ -249,8 +765,12 @@ def run_stage(stage: Stage, input_data: Dict[str, Any], llm: LLM, tracer: Tracer
                 result = post_fn(parsed_result)
             else:
                 result = parsed_result
+            tracer.add_arg('retries', try_nr)
             tracer.on('result', {'result': result})
             return result
+        except LLMSchedulerRejected as e:
+            tracer.on('failed', {'reason_code': 'rejected', 'exception': e})
+            raise
         except Exception as e:
             last_err = e
             try_tracer.on('failed', {'reason_code': err_reason_code, 'exception': e})
@@ -259,4 +779,15 @@ def run_stage(stage: Stage, input_data: Dict[str, Any], llm: LLM, tracer: Tracer
     if stage.or_return is _UNUSED_sentinel:
         raise last_err
     else:
-        return stage.or_return
\ No newline at end of file
+        return stage.or_return
+
+
+
+async def warm_up_stages(stages: List[Stage], llm: LLM, tracer: Tracer) -> None:
+    """Prefills the static prompt of every stage once, so later stage calls find it in the prompt cache of the LLM server."""
+    tracer = tracer.on('warm_up', {'stages': [stage.name for stage in stages]})
+    for stage in stages:
+        stage_tracer = tracer.on('stage', {'name': stage.name})
+        request = LLMRequest(stage.static_prompt, '', stage.name, cache=False, options={'num_predict': 1})
+        await call_llm(request, llm, tracer=stage_tracer)
+    tracer.on('result', {'result': f"{len(stages)} stages"})
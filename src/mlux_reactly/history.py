@@ -0,0 +1,114 @@
+from typing import Iterator, List, Tuple
+from collections import deque
+from dataclasses import dataclass, field
+import numpy as np
+from .types import ChatQA, LLM, Tracer
+from .framework import estimate_tokens
+from .stages import summarize_history
+from .tool_index import Embed, normalize_rows
+
+
+@dataclass
+class HistoryContext:
+    """the part of the chat history given to the agent for a question"""
+    summary: str = ''
+    turns: List[ChatQA] = field(default_factory=list)
+
+
+def qa_tokens(qa: ChatQA) -> int:
+    return estimate_tokens(qa.question) + estimate_tokens(qa.response)
+
+def qa_text(qa: ChatQA) -> str:
+    return f"{qa.question}\n{qa.response}"
+
+
+class ChatHistory:
+    """Chat history with bounded memory and prompt size.
+
+    The last `keep_last` turns (at most `token_budget` tokens) are kept verbatim. Older turns are folded into a
+    rolling summary by the summarize_history stage. If `retrieve_top_k` > 0, folded turns are also archived
+    (at most `max_archived`) with their embeddings, and the ones most similar to the current question are added
+    to the context again."""
+
+    def __init__(
+            self, *,
+            keep_last: int = 8,
+            token_budget: int = 2000,
+            retrieve_top_k: int = 0,
+            max_archived: int = 256,
+            embed: Embed|None = None):
+        self.keep_last = keep_last
+        self.token_budget = token_budget
+        self.retrieve_top_k = retrieve_top_k
+        self.embed = embed
+        self.summary: str = ''
+        self.recent: List[ChatQA] = []
+        self._archive: deque[Tuple[ChatQA, np.ndarray]] = deque(maxlen=max_archived)
+
+    def append(self, qa: ChatQA) -> None:
+        self.recent.append(qa)
+
+    def clear(self) -> None:
+        self.summary = ''
+        self.recent.clear()
+        self._archive.clear()
+
+    def __len__(self) -> int:
+        return len(self.recent)
+
+    def __iter__(self) -> Iterator[ChatQA]:
+        return iter(self.recent)
+
+    def __repr__(self) -> str:
+        return f"ChatHistory(summary={self.summary!r}, recent={self.recent!r})"
+
+    def _turns_to_fold(self) -> int:
+        nr_fold = max(0, len(self.recent) - self.keep_last)
+        tokens = sum(qa_tokens(qa) for qa in self.recent[nr_fold:])
+        while tokens > self.token_budget and nr_fold < len(self.recent) - 1:
+            tokens -= qa_tokens(self.recent[nr_fold])
+            nr_fold += 1
+        return nr_fold
+
+    async def compact(self, llm: LLM, tracer: Tracer) -> None:
+        """folds the turns exceeding keep_last or the token budget into the summary.
+        If no summary is produced (or summarizing raises), the turns stay in `recent` and are folded next time.
+        If embedding them fails, the folded turns are not archived"""
+        nr_fold = self._turns_to_fold()
+        if nr_fold == 0:
+            return
+        folded = self.recent[:nr_fold]
+
+        summary = await summarize_history(self.summary, folded, llm, tracer)
+        if not summary:
+            return
+        summary = str(summary)
+        max_chars = self.token_budget * 2 # the summary may take up about half of the budget
+        self.summary = summary if len(summary) <= max_chars else summary[:max_chars]
+        del self.recent[:nr_fold]
+
+        if self.retrieve_top_k > 0 and self.embed is not None:
+            try:
+                vectors = normalize_rows(np.asarray(await self.embed([qa_text(qa) for qa in folded]), dtype=np.float32))
+            except Exception as e: # the turns are in the summary already, they are just not retrievable
+                tracer.on('history_archive', {'turns': [qa.question for qa in folded]}).on('failed', {'reason_code': 'embed', 'exception': e})
+                return
+            self._archive.extend(zip(folded, vectors))
+
+    async def context(self, question: str, llm: LLM, tracer: Tracer) -> HistoryContext:
+        """compacts the history and returns the context for question: summary, relevant archived turns and the recent turns"""
+        await self.compact(llm, tracer)
+        turns = list(self.recent)
+        if self.retrieve_top_k > 0 and self.embed is not None and len(self._archive) > 0:
+            matrix = np.stack([vector for _, vector in self._archive])
+            try:
+                query = normalize_rows(np.asarray((await self.embed([question]))[0], dtype=np.float32))
+            except Exception as e:
+                tracer.on('history_retrieval', {'question': question}).on('failed', {'reason_code': 'embed', 'exception': e})
+                return HistoryContext(self.summary, turns)
+            scores = matrix @ query
+            top = sorted(np.argsort(-scores, kind='stable')[:self.retrieve_top_k])
+            relevant = [self._archive[i][0] for i in top]
+            tracer.on('history_retrieval', {'turns': [qa.question for qa in relevant], 'scores': [round(float(scores[i]), 3) for i in top]})
+            turns = relevant + turns
+        return HistoryContext(self.summary, turns)
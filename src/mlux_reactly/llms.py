@@ -0,0 +1,422 @@
+from typing import Any, Callable, Dict, List, Literal, AsyncIterator
+from collections import defaultdict
+from dataclasses import asdict, replace
+from weakref import WeakKeyDictionary
+import asyncio
+import json
+import os
+import threading
+import time
+import httpx
+import ollama
+from .types import LLM, LLMRequest, LLMResponse, StageRoute
+from .framework import LLM_SCHEDULER, extract_json
+from .cache import hash_key
+from .tool_index import hashing_embed
+
+
+DEFAULT_MODEL = "qwen2.5:7b-instruct-q8_0"
+DEFAULT_EMBED_MODEL = "nomic-embed-text"
+
+
+class OllamaLLM(LLM):
+    """LLM backend using a persistent `ollama.AsyncClient`, so HTTP connections are pooled and kept alive between calls.
+
+    httpx connections are bound to the event loop they were opened on, thus there is one client per event loop.
+    Each request takes a slot of its model (`embed` of the embed model) from `LLM_SCHEDULER`."""
+
+    def __init__(
+            self,
+            model: str = DEFAULT_MODEL, *,
+            host: str|None = None,
+            timeout: float|None = 300.0,
+            connect_timeout: float = 10.0,
+            max_connections: int = 16,
+            keep_alive: float|str|None = None,
+            options: Dict[str, Any]|None = None,
+            stage_options: Dict[str, Dict[str, Any]]|None = None,
+            embed_model: str = DEFAULT_EMBED_MODEL,
+            pinned: bool = False):
+        """
+        `timeout` limits the whole request (generation included), `connect_timeout` only establishing the connection.
+        `keep_alive` is passed to Ollama and controls how long the model stays loaded after a request.
+        `options` (e.g. num_ctx, num_predict, temperature) are used for every request,
+        `stage_options` maps stage names to options overriding `options` for that stage.
+        `embed_model` is the Ollama model used for `embed`.
+        `pinned` keeps warm sessions: the model stays loaded (unless `keep_alive` is given) and all stages use the same num_ctx
+        (a different num_ctx reloads the model in Ollama, dropping its prompt caches).
+        """
+        self.model = model
+        self.embed_model = embed_model
+        self.pinned = pinned
+        self.keep_alive = keep_alive if keep_alive is not None or not pinned else -1
+        self.options = options or {}
+        self.stage_options = stage_options or {}
+        self._client_kwargs = {
+            'host': host,
+            'timeout': httpx.Timeout(timeout, connect=connect_timeout),
+            'limits': httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        }
+        self._clients: WeakKeyDictionary[asyncio.AbstractEventLoop, ollama.AsyncClient] = WeakKeyDictionary()
+
+    @property
+    def client(self) -> ollama.AsyncClient:
+        """the client of the running event loop"""
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = ollama.AsyncClient(**self._client_kwargs)
+        return client
+
+    def _pin(self, options: Dict[str, Any]) -> Dict[str, Any]:
+        """options with the num_ctx of the session applied last, if pinned"""
+        if not self.pinned:
+            return options
+        return {k: v for k, v in options.items() if k != 'num_ctx'} | {k: v for k, v in self.options.items() if k == 'num_ctx'}
+
+    def options_for(self, stage: str) -> Dict[str, Any]:
+        return self._pin(self.options | self.stage_options.get(stage, {}))
+
+    def _chat_args(self, request: LLMRequest) -> Dict[str, Any]:
+        options = self._pin(self.options_for(request.stage) | request.options)
+        return {
+            'model': self.model,
+            'messages': request.as_messages(),
+            'options': options or None,
+            'keep_alive': self.keep_alive,
+            'format': request.format,
+        }
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        async with LLM_SCHEDULER.slot(self.model):
+            response = await self.client.chat(**self._chat_args(request))
+        return LLMResponse(
+            str(response.message.content),
+            prompt_eval_count=response.prompt_eval_count,
+            prompt_eval_time=response.prompt_eval_duration / 1e9 if response.prompt_eval_duration is not None else None,
+            eval_count=response.eval_count,
+        )
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        async with LLM_SCHEDULER.slot(self.model):
+            chunks = await self.client.chat(**self._chat_args(request), stream=True)
+            async for chunk in chunks:
+                if chunk.message.content:
+                    yield chunk.message.content
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        async with LLM_SCHEDULER.slot(self.embed_model):
+            response = await self.client.embed(model=self.embed_model, input=texts)
+        return [list(vector) for vector in response.embeddings]
+
+    def __repr__(self) -> str:
+        return f"OllamaLLM({self.model!r})"
+
+
+class FakeLLM(LLM):
+    """In-process LLM stand-in for tests.
+
+    `responses` is either a function answering a request, or maps stage names to a response
+    or a list of responses (the n-th call of a stage gets the n-th response, the last one repeats).
+    All received requests are kept in `requests`. Like a real backend, `chat` takes a slot of `LLM_SCHEDULER`."""
+
+    def __init__(
+            self,
+            responses: Dict[str, str|List[str]]|Callable[[LLMRequest], str], *,
+            model: str = 'fake',
+            default: str = ''):
+        self.model = model
+        self.responses = responses
+        self.default = default
+        self.requests: List[LLMRequest] = []
+        self._calls_per_stage: Dict[str, int] = defaultdict(int)
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        self.requests.append(request)
+        async with LLM_SCHEDULER.slot(self.model):
+            return LLMResponse(self._respond(request))
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        return hashing_embed(texts)
+
+    def _respond(self, request: LLMRequest) -> str:
+        if callable(self.responses):
+            return self.responses(request)
+        canned = self.responses.get(request.stage, self.default)
+        if isinstance(canned, list):
+            call_nr = self._calls_per_stage[request.stage]
+            self._calls_per_stage[request.stage] += 1
+            return canned[min(call_nr, len(canned)-1)] if canned else self.default
+        return canned
+
+    def __repr__(self) -> str:
+        return f"FakeLLM({self.model!r})"
+
+
+def decisive_scores(*, center: float = 0.5, margin: float = 0.2) -> Callable[[str], bool]:
+    """`StageRoute.accept` check for rating stages: accepts a JSON response if all numbers in it are at least margin away from center"""
+    def numbers(value: Any) -> List[float]:
+        if isinstance(value, bool):
+            return []
+        if isinstance(value, (int, float)):
+            return [float(value)]
+        if isinstance(value, dict):
+            return [n for v in value.values() for n in numbers(v)]
+        if isinstance(value, list):
+            return [n for v in value for n in numbers(v)]
+        return []
+
+    def accept(content: str) -> bool:
+        try:
+            parsed = extract_json(content)
+        except Exception:
+            return False
+        return all(abs(n - center) >= margin for n in numbers(parsed))
+    return accept
+
+
+class RoutedLLM(LLM):
+    """Sends the requests of each stage to the backend of its `StageRoute`, the others to `llm`.
+
+    Routes with `escalate_to` form a cascade: the response of the (small) stage backend is only used if it is
+    valid JSON (for requests with a JSON format) and accepted by the route, otherwise the request is sent to `escalate_to`."""
+
+    def __init__(self, llm: LLM, routes: Dict[str, StageRoute]):
+        self.llm = llm
+        self.routes = routes
+        self.escalations = 0
+
+    @property
+    def model(self) -> str:
+        return self.llm.model
+
+    def _backend(self, stage: str) -> LLM:
+        route = self.routes.get(stage)
+        return route.llm if route is not None and route.llm is not None else self.llm
+
+    def options_for(self, stage: str) -> Dict[str, Any]:
+        route = self.routes.get(stage)
+        return self._backend(stage).options_for(stage) | (route.options if route is not None else {})
+
+    def _routed_request(self, request: LLMRequest, route: StageRoute) -> LLMRequest:
+        return replace(request, options=route.options | request.options) if route.options else request
+
+    def _accepted(self, request: LLMRequest, route: StageRoute, content: str) -> bool:
+        if request.format is not None:
+            try:
+                extract_json(content)
+            except Exception:
+                return False
+        return route.accept is None or route.accept(content)
+
+    async def _escalate(self, request: LLMRequest, route: StageRoute) -> LLMResponse:
+        assert route.escalate_to is not None
+        self.escalations += 1
+        response = await route.escalate_to.chat(request)
+        response.model = response.model or route.escalate_to.model
+        return response
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        route = self.routes.get(request.stage)
+        if route is None:
+            return await self.llm.chat(request)
+        if route.escalate_to is not None and request.attempt > 0:
+            return await self._escalate(request, route)
+
+        backend = self._backend(request.stage)
+        response = await backend.chat(self._routed_request(request, route))
+        if route.escalate_to is not None and not self._accepted(request, route, response.content):
+            return await self._escalate(request, route)
+        response.model = response.model or backend.model
+        return response
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        route = self.routes.get(request.stage)
+        if route is None:
+            chunks = self.llm.chat_stream(request)
+        else:
+            chunks = self._backend(request.stage).chat_stream(self._routed_request(request, route))
+        async for chunk in chunks:
+            yield chunk
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        return await self.llm.embed(texts)
+
+    def __repr__(self) -> str:
+        return f"RoutedLLM({self.llm!r}, {list(self.routes.keys())!r})"
+
+
+Latency = float|Literal['recorded']|Callable[[LLMRequest, LLMResponse], float]
+"""synthetic latency of replayed responses: fixed seconds, 'recorded' for the duration of the recorded call,
+or a function of request and response (see `token_latency`)"""
+
+
+def token_latency(*, prefill_tokens_per_second: float = 2000.0, tokens_per_second: float = 40.0, overhead: float = 0.02) -> Callable[[LLMRequest, LLMResponse], float]:
+    """latency from the recorded token counts of a response, like a model with the given prefill and generation speed"""
+    def latency(request: LLMRequest, response: LLMResponse) -> float:
+        return (overhead + (response.prompt_eval_count or 0) / prefill_tokens_per_second
+                + (response.eval_count or 0) / tokens_per_second)
+    return latency
+
+
+class RecordReplayLLM(LLM):
+    """Records the responses of a LLM backend to a JSON lines file, and replays them deterministically without the backend.
+
+    mode 'record' sends all requests to `llm` and appends each response to `path` (with its token counts and duration).
+    mode 'replay' serves the recorded responses with a synthetic `latency` (multiplied by `speed`), so the framework
+    can be benchmarked without Ollama. Requests are matched by stage, attempt, prompts, request options and format;
+    if the same request was recorded several times, its n-th replay gets the n-th response (the last one repeats).
+    Requests that were not recorded are sent to `llm` if given, otherwise they raise a `KeyError`.
+    The options of the backend per stage are recorded too, so the replayed `options_for` (e.g. num_ctx for context budgets) match.
+    Replayed requests take a slot of the recorded model from `LLM_SCHEDULER`, like requests to the backend."""
+
+    def __init__(
+            self,
+            path: str,
+            llm: LLM|None = None, *,
+            mode: Literal['record', 'replay'] = 'replay',
+            latency: Latency = 0.0,
+            speed: float = 1.0):
+        if mode == 'record' and llm is None:
+            raise ValueError("recording needs a LLM backend")
+        self.path = path
+        self.llm = llm
+        self.mode = mode
+        self.latency = latency
+        self.speed = speed
+        self.replayed = 0
+        self.misses = 0
+        self._recorded_model: str|None = None
+        self._responses: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._stage_options: Dict[str, Dict[str, Any]] = {}
+        self._replays_per_key: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            self._load()
+        self._file = open(path, 'a', encoding='utf-8') if mode == 'record' else None
+
+    @property
+    def model(self) -> str:
+        if self.mode == 'record' and self.llm is not None:
+            return self.llm.model
+        return self._recorded_model or (self.llm.model if self.llm is not None else 'replay')
+
+    def options_for(self, stage: str) -> Dict[str, Any]:
+        if self.mode == 'replay' and stage in self._stage_options:
+            return self._stage_options[stage]
+        return self.llm.options_for(stage) if self.llm is not None else {}
+
+    def request_key(self, request: LLMRequest) -> str:
+        return hash_key(request.stage, request.attempt, request.sys_prompt, request.prompt, request.options, request.format)
+
+    def _load(self) -> None:
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # cut off by a crash while writing
+                    continue
+                self._responses[record['key']].append(record)
+                if 'response' in record:
+                    self._stage_options.setdefault(record['stage'], record['options'])
+                self._recorded_model = self._recorded_model or record.get('response', {}).get('model')
+
+    def _record(self, key: str, record: Dict[str, Any]) -> None:
+        assert self._file is not None
+        with self._lock:
+            self._responses[key].append(record)
+            self._file.write(json.dumps({'key': key} | record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def _replay(self, key: str) -> Dict[str, Any]|None:
+        with self._lock:
+            records = self._responses.get(key)
+            if not records:
+                self.misses += 1
+                return None
+            nr = self._replays_per_key[key]
+            self._replays_per_key[key] += 1
+            self.replayed += 1
+            return records[min(nr, len(records)-1)]
+
+    def _latency(self, request: LLMRequest, response: LLMResponse, record: Dict[str, Any]) -> float:
+        if self.latency == 'recorded':
+            seconds = record.get('duration', 0.0)
+        elif callable(self.latency):
+            seconds = self.latency(request, response)
+        else:
+            seconds = self.latency
+        return max(seconds * self.speed, 0.0)
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        key = self.request_key(request)
+        if self.mode == 'record':
+            assert self.llm is not None
+            start_time = time.perf_counter()
+            response = await self.llm.chat(request)
+            response.model = response.model or self.llm.model
+            self._record(key, {'stage': request.stage, 'options': self.llm.options_for(request.stage),
+                               'duration': time.perf_counter() - start_time, 'response': asdict(response)})
+            return response
+
+        record = self._replay(key)
+        if record is None:
+            if self.llm is None:
+                raise KeyError(f"no recorded response for a request of stage '{request.stage}' (attempt {request.attempt}) in {self.path}")
+            return await self.llm.chat(request)
+        response = LLMResponse(**record['response'])
+        async with LLM_SCHEDULER.slot(self.model):
+            await asyncio.sleep(self._latency(request, response, record))
+        return response
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        key = self.request_key(request)
+        if self.mode == 'record':
+            assert self.llm is not None
+            start_time = time.perf_counter()
+            chunks: List[str] = []
+            async for chunk in self.llm.chat_stream(request):
+                chunks.append(chunk)
+                yield chunk
+            self._record(key, {'stage': request.stage, 'options': self.llm.options_for(request.stage),
+                               'duration': time.perf_counter() - start_time, 'chunks': chunks,
+                               'response': asdict(LLMResponse(''.join(chunks), model=self.llm.model))})
+            return
+
+        record = self._replay(key)
+        if record is None:
+            if self.llm is None:
+                raise KeyError(f"no recorded response for a request of stage '{request.stage}' (attempt {request.attempt}) in {self.path}")
+            async for chunk in self.llm.chat_stream(request):
+                yield chunk
+            return
+        response = LLMResponse(**record['response'])
+        chunks = record.get('chunks') or [response.content]
+        seconds = self._latency(request, response, record)
+        async with LLM_SCHEDULER.slot(self.model):
+            for chunk in chunks: # the latency is spread over the chunks
+                await asyncio.sleep(seconds / len(chunks))
+                yield chunk
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """embeddings are recorded and replayed too (without latency), so tool retrieval selects the same tools.
+        Texts that were not recorded are embedded by `llm` if given, otherwise by `hashing_embed`"""
+        key = hash_key('embed', texts)
+        if self.mode == 'record':
+            assert self.llm is not None
+            vectors = await self.llm.embed(texts)
+            self._record(key, {'stage': '', 'embeddings': vectors})
+            return vectors
+
+        record = self._replay(key)
+        if record is not None:
+            return record['embeddings']
+        return await self.llm.embed(texts) if self.llm is not None else hashing_embed(texts)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __repr__(self) -> str:
+        return f"RecordReplayLLM({self.path!r}, mode={self.mode!r})"
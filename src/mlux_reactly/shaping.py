@@ -0,0 +1,125 @@
+from typing import Any, List, Tuple
+from dataclasses import replace
+import re
+import numpy as np
+from .types import Tracer, ToolError
+from .framework import estimate_tokens, truncate_tokens, serialize_data
+from .stages import ToolRunRecord
+
+
+_word_re = re.compile(r"\w+")
+_paragraph_re = re.compile(r"\n\s*\n|\n")
+_sentence_re = re.compile(r"(?<=[.!?])\s+")
+
+PASSAGE_SEPARATOR = "\n...\n"
+
+
+def as_text(result: Any) -> str:
+    """tool result as text, the elements of lists and dicts in separate paragraphs"""
+    if isinstance(result, str):
+        return result
+    if isinstance(result, list):
+        return "\n\n".join(as_text(element) for element in result)
+    if isinstance(result, dict):
+        return "\n\n".join(f"{key}: {as_text(value)}" for key, value in result.items())
+    return serialize_data(result)
+
+
+def split_passages(text: str, max_tokens: int = 96, *, model: str|None = None) -> List[str]:
+    """splits text into paragraphs, long paragraphs into runs of sentences of at most max_tokens (if possible)"""
+    passages: List[str] = []
+    for paragraph in _paragraph_re.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_tokens(paragraph, model) <= max_tokens:
+            passages.append(paragraph)
+            continue
+        current = ''
+        for sentence in _sentence_re.split(paragraph):
+            if current and estimate_tokens(current, model) + estimate_tokens(sentence, model) > max_tokens:
+                passages.append(current)
+                current = ''
+            current = f"{current} {sentence}" if current else sentence
+        if current:
+            passages.append(current)
+    return passages
+
+
+def bm25_scores(query: str, passages: List[str], *, k1: float = 1.5, b: float = 0.75) -> np.ndarray:
+    """BM25 relevance of each passage to query"""
+    tokenized = [_word_re.findall(passage.lower()) for passage in passages]
+    lengths = np.array([len(tokens) for tokens in tokenized], dtype=np.int64)
+    query_terms = np.unique(np.array(_word_re.findall(query.lower()), dtype=str))
+    if query_terms.size == 0 or lengths.sum() == 0:
+        return np.zeros(len(passages))
+
+    tokens = np.array([token for passage_tokens in tokenized for token in passage_tokens], dtype=str)
+    passage_ids = np.repeat(np.arange(len(passages)), lengths)
+    term_ids = np.minimum(np.searchsorted(query_terms, tokens), query_terms.size - 1)
+    is_query_term = query_terms[term_ids] == tokens
+    term_freqs = np.zeros((len(passages), query_terms.size))
+    np.add.at(term_freqs, (passage_ids[is_query_term], term_ids[is_query_term]), 1.0)
+
+    doc_freqs = (term_freqs > 0).sum(axis=0)
+    idf = np.log1p((len(passages) - doc_freqs + 0.5) / (doc_freqs + 0.5))
+    length_norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1e-9))
+    return (term_freqs * (k1 + 1) / (term_freqs + length_norm[:, None])) @ idf
+
+
+def select_passages(query: str, text: str, max_tokens: int, *, model: str|None = None) -> str:
+    """the passages of text most relevant to query (by BM25) within max_tokens (of model), in their original order"""
+    passages = split_passages(text, model=model)
+    if not passages:
+        return ''
+    scores = bm25_scores(query, passages)
+    sizes = np.array([estimate_tokens(passage, model) + estimate_tokens(PASSAGE_SEPARATOR, model) for passage in passages])
+    selected = np.zeros(len(passages), dtype=bool)
+    budget = max_tokens
+    for i in np.argsort(-scores, kind='stable'):
+        if sizes[i] <= budget:
+            selected[i] = True
+            budget -= sizes[i]
+    if not selected.any(): # not even the most relevant passage fits, cut it
+        best = int(np.argmax(scores))
+        return truncate_tokens(passages[best], max_tokens, model)
+    return PASSAGE_SEPARATOR.join(passage for passage, keep in zip(passages, selected) if keep)
+
+
+def allocate_budgets(sizes: List[int], total: int) -> List[int]:
+    """splits total evenly between the sizes, sizes below their share keep their size and leave the rest to the others"""
+    budgets = [0] * len(sizes)
+    remaining = total
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining // len(pending)
+        i = pending.pop(0)
+        budgets[i] = min(sizes[i], share)
+        remaining -= budgets[i]
+    return budgets
+
+
+def shape_results(query: str, records: List[ToolRunRecord], tracer: Tracer, *, max_result_tokens: int|None, max_total_tokens: int|None, model: str|None = None) -> List[ToolRunRecord]:
+    """Trims the tool results given to the answer stage to the token limits (in tokens of model), keeping the passages most relevant to query.
+    Results exceeding their budget become text excerpts. The trimming is traced as 'result_shaping' event."""
+    sizes = [estimate_tokens(serialize_data(record.result), model) for record in records]
+    budgets = [min(size, max_result_tokens) if max_result_tokens is not None else size for size in sizes]
+    if max_total_tokens is not None and sum(budgets) > max_total_tokens:
+        budgets = allocate_budgets(budgets, max_total_tokens)
+    if budgets == sizes:
+        return records
+
+    shaped: List[ToolRunRecord] = []
+    trimmed: List[Tuple[str, int, int]] = []
+    for record, size, budget in zip(records, sizes, budgets):
+        if budget >= size or isinstance(record.result, ToolError):
+            shaped.append(record)
+            continue
+        excerpt = select_passages(query, as_text(record.result), budget, model=model)
+        shaped.append(replace(record, result=excerpt))
+        trimmed.append((record.tool, size, estimate_tokens(serialize_data(excerpt), model)))
+    tracer.on('result_shaping', {
+        'trimmed_tokens': sum(before - after for _, before, after in trimmed),
+        'results': [{'tool': tool, 'tokens': before, 'kept_tokens': after} for tool, before, after in trimmed],
+    })
+    return shaped
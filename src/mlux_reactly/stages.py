@@ -1,8 +1,8 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable
 from dataclasses import dataclass
 
 from .types import AnyBasic, T, Task, TaskResult, Answer, LLM, Tracer, Tool, ChatQA
-from .framework import make_format, FormatDescr, make_stage, run_stage
+from .framework import make_format, FormatDescr, make_stage, run_stage, Stage
 
 
 
@@ -12,6 +12,11 @@ class RatedTool:
     tool: Tool
     score: float
 
+@dataclass
+class ToolCall:
+    tool: Tool
+    input: Any
+
 @dataclass
 class ToolRunRecord:
     tool: str
@@ -23,6 +28,12 @@ _qa_format = make_format(
     preshape_fn=lambda qa: {'question': qa.question, 'answer': qa.response}
 )
 
+_summary_format = make_format(
+    'summary of the earlier chat',
+    default='',
+    label='Summary'
+)
+
 _tools_concise_format = make_format(
     {"name of tool": "description of tool"},
     preshape_fn=lambda tools: {tool.name: tool.doc for tool in tools},
@@ -40,6 +51,12 @@ _task_description_format = make_format(
     label='Task'
 )
 
+_task_node_format = make_format(
+    {'task': 'description of the task', 'depends_on': [0]},
+    preshape_fn=lambda task: {'task': task.description, 'depends_on': task.depends_on or []},
+    label='Task'
+)
+
 _task_specification_format = make_format(
     {'description': 'description of the task', 'tools': ['name of tool 1', '...']},
     label='Tool'
@@ -55,11 +72,13 @@ _rated_tools_format = make_format(
     {"name of tool1": 0.123, "tool2": 0.456},
     preshape_fn=lambda rated_tools: {rated_tool.tool.name: rated_tool.score for rated_tool in rated_tools},
     preshape_requires_type=RatedTool,
-    label='Ratings'
+    label='Ratings',
+    schema={'type': 'object', 'additionalProperties': {'type': 'number'}}
 )
 
 _tool_runs_format = make_format(
     [{'tool': 'name of tool', 'input': 'input to tool (does not have to be a string)', 'result': 'the output of the tool run'}],
+    shrinkable=True
 )
 
 _answer_format = make_format('The answer of the Task.', label='Answer', is_plain_text=True)
@@ -81,6 +100,9 @@ _EXAMPLE_TOOL_RATINGS = [
 
 
 
+# Stage inputs that stay the same across calls (like the list of tools) are placed first. Consecutive
+# prompts then share a long prefix, which the LLM server can reuse from its prompt (KV) cache.
+
 OBJECTIVITY_RULES = [
     "Do not invent facts or assume missing information.",
     "Use neutral, imperative phrasing.",
@@ -95,20 +117,22 @@ OBJECTIVITY_RULES = [
 
 
 
+_SPLIT_QUESTION_RULES = OBJECTIVITY_RULES + [
+    "Do NOT answer the Question.",
+    "Tasks must be strictly ordered.",
+    "Do not merge multiple actions into one task.",
+    "If required information is missing, create a task to retrieve it.",
+    "Each Task should only need a single Tool call to answer it.",
+    "Prefer many small tasks over few large tasks. For example, if the Question asks about different people or places, use one Task for each.",
+]
+
 _split_question_into_tasks_stage = make_stage(
     'split_question_into_tasks',
     """You are a task-splitting system.\nYour job is to decompose the user Question into an ordered list of atomic Tasks required to answer it.""",
-    rules = OBJECTIVITY_RULES + [
-        "Do NOT answer the Question.",
-        "Tasks must be strictly ordered.",
-        "Do not merge multiple actions into one task.",
-        "If required information is missing, create a task to retrieve it.",
-        "Each Task should only need a single Tool call to answer it.",
-        "Prefer many small tasks over few large tasks. For example, if the Question asks about different people or places, use one Task for each.",
-    ],
+    rules = _SPLIT_QUESTION_RULES,
     inputs = [
-        ('Question', 'The user question'),
         _tools_concise_format,
+        ('Question', 'The user question'),
     ],
     output=_task_description_format.as_list(label='Tasks'),
     good_examples=[
@@ -132,11 +156,58 @@ _split_question_into_tasks_stage = make_stage(
     or_return=[]
 )
 
-def split_question_into_tasks(user_question: str, tools: List[Tool], llm: LLM, tracer: Tracer) -> List[Task]:
+_split_question_into_task_graph_stage = make_stage(
+    'split_question_into_task_graph',
+    """You are a task-splitting system.\nYour job is to decompose the user Question into an ordered list of atomic Tasks required to answer it, and to state which earlier Tasks each Task depends on.""",
+    rules = _SPLIT_QUESTION_RULES + [
+        "depends_on lists the indices (starting at 0) of the earlier Tasks whose results are needed to work on the Task.",
+        "Leave depends_on empty if a Task does not need results of other Tasks. Such Tasks are worked on in parallel.",
+    ],
+    inputs = [
+        _tools_concise_format,
+        ('Question', 'The user question'),
+    ],
+    output=_task_node_format.as_list(label='Tasks'),
+    good_examples=[
+        {
+            'Tools': _EXAMPLE_TOOLS, 
+            'Question': "What is the sqare of the year the coworker Mike was born?",
+            'Tasks': [
+                Task('Find out the date of birth for coworker Mike', []),
+                Task("Square the year number of the date of birth.", [0]),
+            ],
+        },
+         {
+            'Tools': _EXAMPLE_TOOLS, 
+            'Question': "How much more does a ton of oak wood cost than a ton of beech wood in Jessie's home country?",
+            'Tasks': [
+                Task("Determine the home country of Jessie.", []),
+                Task("Determine the price of a ton of oak wood in Jessie's home country.", [0]),
+                Task("Determine the price of a ton of beech wood in Jessie's home country.", [0]),
+                Task("Calculate the difference between the prices of wood.", [1, 2]),
+            ],
+        }
+    ],
+    tries = 3,
+    or_return=[]
+)
+
+async def split_question_into_tasks(user_question: str, tools: List[Tool], llm: LLM, tracer: Tracer, *, with_dependencies: bool = False) -> List[Task]:
     def post_process(parsed: List[str]) -> List[Task]:
         return [Task(description) for description in parsed]
 
-    tasks: List[Task] = run_stage(_split_question_into_tasks_stage, {'Question': user_question, 'Tools': tools}, llm, tracer, post_fn=post_process)
+    def post_process_graph(parsed: List[Dict[str, Any]]) -> List[Task]:
+        tasks: List[Task] = []
+        for index, node in enumerate(parsed):
+            assert isinstance(node, dict)
+            # only earlier tasks are valid dependencies, which also rules out cycles
+            depends_on = sorted({dep for dep in node.get('depends_on') or [] if type(dep) == int and 0 <= dep < index})
+            tasks.append(Task(str(node['task']), depends_on))
+        return tasks
+
+    if with_dependencies:
+        return await run_stage(_split_question_into_task_graph_stage, {'Question': user_question, 'Tools': tools}, llm, tracer, post_fn=post_process_graph)
+    tasks: List[Task] = await run_stage(_split_question_into_tasks_stage, {'Question': user_question, 'Tools': tools}, llm, tracer, post_fn=post_process)
     return tasks
 
 
@@ -156,7 +227,8 @@ _enhance_user_question_stage = make_stage(
         "Include all informations from previous chat interactions *relevant* for answering this user Question."
     ],
     inputs=[
-        _qa_format.as_list('History'),
+        _summary_format,
+        _qa_format.as_list('History', shrinkable=True),
         ('Question', 'the user question'),
     ],
     output=('Enhanced', 'Your enhanced user Question'),
@@ -175,10 +247,10 @@ _enhance_user_question_stage = make_stage(
     tries=3
 )
 
-def enhance_user_question(user_question: str, history: List[ChatQA], llm: LLM, tracer: Tracer) -> str:
-    if len(history) == 0:
+async def enhance_user_question(user_question: str, history: List[ChatQA], llm: LLM, tracer: Tracer, *, summary: str = '') -> str:
+    if len(history) == 0 and not summary:
         return user_question
-    enhanced = run_stage(_enhance_user_question_stage, {'History': history, 'Question': user_question}, llm, tracer)
+    enhanced = await run_stage(_enhance_user_question_stage, {'Summary': summary, 'History': history, 'Question': user_question}, llm, tracer)
     return enhanced or user_question
 
 
@@ -188,6 +260,43 @@ def enhance_user_question(user_question: str, history: List[ChatQA], llm: LLM, t
 
 
 
+_summarize_history_stage = make_stage(
+    'summarize_history',
+    """You are a chat summarizer.\nYour job is to fold the chat History into the Summary of the earlier chat. Later questions of the user might refer to anything in it.""",
+    rules=OBJECTIVITY_RULES+[
+        "Keep names, places, numbers and facts that later questions could refer to.",
+        "Drop greetings, repetitions and details irrelevant for the conversation.",
+        "The Updated summary must be shorter than 150 words.",
+    ],
+    inputs=[
+        _summary_format,
+        _qa_format.as_list('History', shrinkable=True),
+    ],
+    output=('Updated', 'the Summary updated with the History'),
+    good_examples=[
+        {
+            'Summary': "The user asked where the Prime Minister lives: 10 Downing Street, London.",
+            'History': [
+                ChatQA('How old is he?', "51 years"),
+                ChatQA('Does he pay rent there?', "No, it's an official residence paided by the state."),
+            ],
+            'Updated': "The user asked about the Prime Minister: he lives in 10 Downing Street, London, an official residence paid by the state (no rent), and is 51 years old.",
+        }
+    ],
+    or_return=None,
+    tries=2
+)
+
+async def summarize_history(summary: str, history: List[ChatQA], llm: LLM, tracer: Tracer) -> str|None:
+    return await run_stage(_summarize_history_stage, {'Summary': summary, 'History': history}, llm, tracer)
+
+
+
+
+
+
+
+
 _enhance_task_description_stage = make_stage(
     'enhance_task_description',
     """You are a task enhancing stage.\nYour job is to Enhance the description of a Task with previous Results. The following stages will try to answer the task using only your Enhanced description.""",
@@ -196,7 +305,7 @@ _enhance_task_description_stage = make_stage(
         "The Enhanced description should explicitly state which information is asked for."
     ],
     inputs=[
-        _task_result_format.as_list('Results'),
+        _task_result_format.as_list('Results', shrinkable=True),
         _task_description_format,
     ],
     output=('Enhanced', 'Your task description enhanced by the relevant knowledge learned from the Results'),
@@ -217,8 +326,8 @@ _enhance_task_description_stage = make_stage(
     ]
 )
 
-def enhance_task_description(task_descr: str, previous_tasks: List[TaskResult], llm: LLM, tracer: Tracer) -> str:
-    return run_stage(_enhance_task_description_stage, {'Results': previous_tasks, 'Task': task_descr}, llm, tracer)
+async def enhance_task_description(task_descr: str, previous_tasks: List[TaskResult], llm: LLM, tracer: Tracer) -> str:
+    return await run_stage(_enhance_task_description_stage, {'Results': previous_tasks, 'Task': task_descr}, llm, tracer)
 
 
 
@@ -232,8 +341,8 @@ _rate_tools_for_task_stage = make_stage(
         'Rate every available Tool.'
     ],
     inputs = [
+        _tools_concise_format,
         ('Task', _task_description_format),
-        _tools_concise_format
     ],
     output=_rated_tools_format,
     good_examples=[
@@ -247,7 +356,7 @@ _rate_tools_for_task_stage = make_stage(
 )
 
 
-def rate_tools_for_task(task: Task, tools: List[Tool], llm: LLM, tracer: Tracer) -> List[RatedTool]:
+async def rate_tools_for_task(task: Task, tools: List[Tool], llm: LLM, tracer: Tracer) -> List[RatedTool]:
     available_tools_by_name = {t.name: t for t in tools}
     def post_process(parsed: AnyBasic) -> List[RatedTool]:
         result: List[RatedTool] = []
@@ -259,7 +368,7 @@ def rate_tools_for_task(task: Task, tools: List[Tool], llm: LLM, tracer: Tracer)
         return result
 
 
-    return run_stage(_rate_tools_for_task_stage, {'Task': task.description, 'Tools': tools}, llm, tracer, post_fn=post_process)
+    return await run_stage(_rate_tools_for_task_stage, {'Task': task.description, 'Tools': tools}, llm, tracer, post_fn=post_process)
 
 
 
@@ -275,18 +384,68 @@ _make_tool_input_stage = make_stage(
         "Format the Input according to the input_format of the Tool."
     ],
     inputs = [
+        _tool_verbose_format,
         ('Task', _task_description_format),
-        _tool_verbose_format
     ],
-    output=('Input', make_format({'first parameter name': "some input value (of JSON-type specified by input format)", "another parameter name": "another input value"})),
+    output=('Input', make_format(
+        {'first parameter name': "some input value (of JSON-type specified by input format)", "another parameter name": "another input value"},
+        schema={'type': 'object'}
+    )),
     good_examples=[
         {'Task': "Find the square of 123.", 'Tool': _EXAMPLE_TOOL_SQR, 'Input': {'number': 123}}
     ],
     tries = 2
 )
 
-def make_tool_input(task: Task, tool: Tool, llm: LLM, tracer: Tracer) -> AnyBasic:
-    return run_stage(_make_tool_input_stage, {'Task': task.description, 'Tool': tool}, llm, tracer)
+async def make_tool_input(task: Task, tool: Tool, llm: LLM, tracer: Tracer) -> AnyBasic:
+    return await run_stage(_make_tool_input_stage, {'Task': task.description, 'Tool': tool}, llm, tracer)
+
+
+
+
+_plan_tool_calls_stage = make_stage(
+    'plan_tool_calls',
+    """You are a tool call planner.\nYour job is to select the Tools needed for answering the Task and to generate a valid input for each selected Tool.""",
+    rules = OBJECTIVITY_RULES + [
+        "Only select Tools that help answering the Task. Select no Tool, if none of them helps.",
+        "Format the input of each call according to the input_format of its Tool.",
+    ],
+    inputs = [
+        _tool_verbose_format.as_list('Tools'),
+        ('Task', _task_description_format),
+    ],
+    output=('Calls', make_format(
+        [{'tool': 'name of tool', 'input': {'first parameter name': "some input value (of JSON-type specified by input format)"}}],
+        schema={
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {'tool': {'type': 'string'}, 'input': {'type': 'object'}},
+                'required': ['tool', 'input'],
+            },
+        }
+    )),
+    good_examples=[
+        {'Tools': _EXAMPLE_TOOLS, 'Task': "Lookup the ANSI color code of magenta.", 'Calls': [{'tool': 'hex_color', 'input': {'color_name': 'magenta'}}]},
+        {'Tools': _EXAMPLE_TOOLS, 'Task': "Who was the first person on the moon?", 'Calls': []},
+    ],
+    tries = 2
+)
+
+async def plan_tool_calls(task: Task, tools: List[Tool], llm: LLM, tracer: Tracer) -> List[ToolCall]:
+    """selects the tools for the task together with their inputs, with a single LLM call"""
+    available_tools_by_name = {t.name: t for t in tools}
+    def post_process(parsed: AnyBasic) -> List[ToolCall]:
+        result: List[ToolCall] = []
+        assert isinstance(parsed, list)
+        for call in parsed:
+            assert isinstance(call, dict)
+            tool = available_tools_by_name.get(call.get('tool'))
+            assert tool is not None
+            result.append(ToolCall(tool, call.get('input', {})))
+        return result
+
+    return await run_stage(_plan_tool_calls_stage, {'Task': task.description, 'Tools': tools}, llm, tracer, post_fn=post_process)
 
 
 
@@ -342,8 +501,8 @@ _try_answer_task_stage = make_stage(
     tries = 2
 )
 
-def try_answer(task_description: str, results: List[ToolRunRecord], llm: LLM, tracer: Tracer) -> str:
-    return run_stage(_try_answer_task_stage, {'Task': task_description, 'Results': results}, llm, tracer)
+async def try_answer(task_description: str, results: List[ToolRunRecord], llm: LLM, tracer: Tracer, *, on_token: Callable[[str], None]|None = None, on_retry: Callable[[int], None]|None = None) -> str:
+    return await run_stage(_try_answer_task_stage, {'Task': task_description, 'Results': results}, llm, tracer, on_token=on_token, on_retry=on_retry)
 
 
 
@@ -360,7 +519,10 @@ _rate_task_answer_stage = make_stage(
         ('Task', _task_description_format),
         ('Answer', _tool_runs_format),
     ],
-    output=('Rating', make_format({'satisfaction': 0.12, 'reason': "Why the answer can't fully satisfy the Task. (This attribute can be ommitted when satisfaction is high.)"})),
+    output=('Rating', make_format(
+        {'satisfaction': 0.12, 'reason': "Why the answer can't fully satisfy the Task. (This attribute can be ommitted when satisfaction is high.)"},
+        schema={'type': 'object', 'properties': {'satisfaction': {'type': 'number'}, 'reason': {'type': 'string'}}, 'required': ['satisfaction']}
+    )),
     good_examples=[
         {
             'Task': "Find the names of daughter and brother of Joe.", 
@@ -386,9 +548,25 @@ _rate_task_answer_stage = make_stage(
     tries = 2
 )
 
-def rate_task_answer(task_description: str, answer: str, llm: LLM, tracer: Tracer) -> int:
+async def rate_task_answer(task_description: str, answer: str, llm: LLM, tracer: Tracer) -> int:
     def post_process(output: Dict[str, str|float]) -> Answer:
         return output.get('satisfaction', 0.0)
-    return run_stage(_rate_task_answer_stage, {'Task': task_description, 'Answer': answer}, llm, tracer, post_fn=post_process)
+    return await run_stage(_rate_task_answer_stage, {'Task': task_description, 'Answer': answer}, llm, tracer, post_fn=post_process)
 
 
+
+
+
+
+STAGES: List[Stage] = [
+    _split_question_into_tasks_stage,
+    _split_question_into_task_graph_stage,
+    _enhance_user_question_stage,
+    _summarize_history_stage,
+    _enhance_task_description_stage,
+    _rate_tools_for_task_stage,
+    _make_tool_input_stage,
+    _plan_tool_calls_stage,
+    _try_answer_task_stage,
+    _rate_task_answer_stage,
+]
@@ -0,0 +1,69 @@
+from typing import Awaitable, Callable, List, Tuple
+import hashlib
+import json
+import re
+import numpy as np
+from .types import Tool
+
+
+Embed = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+_word_re = re.compile(r"\w+")
+
+def hashing_embed(texts: List[str], dim: int = 512) -> List[List[float]]:
+    """Local stand-in for an embedding model: hashed bag of words and character trigrams, no model needed."""
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = _word_re.findall(text.lower())
+        features = words + [word[i:i+3] for word in words for i in range(max(1, len(word)-2))]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], 'little') % dim
+            sign = 1.0 if digest[4] & 1 else -1.0
+            matrix[row, index] += sign
+    return matrix.tolist()
+
+async def local_embed(texts: List[str]) -> List[List[float]]:
+    return hashing_embed(texts)
+
+
+def tool_text(tool: Tool) -> str:
+    return f"{tool.name}: {tool.doc}\n{json.dumps(tool.input_doc, ensure_ascii=False)}"
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class ToolIndex:
+    """Embeds the description of every tool once and looks up the tools most similar to a task by cosine similarity."""
+
+    def __init__(self, tools: List[Tool], embed: Embed):
+        self.tools = tools
+        self.embed = embed
+        self._matrix: np.ndarray|None = None
+
+    def with_embed(self, embed: Embed) -> 'ToolIndex':
+        """index of the same tools using embed, sharing the tool embeddings if already computed"""
+        index = ToolIndex(self.tools, embed)
+        index._matrix = self._matrix
+        return index
+
+    async def matrix(self) -> np.ndarray:
+        """normalized tool embeddings, one row per tool"""
+        if self._matrix is None:
+            vectors = await self.embed([tool_text(tool) for tool in self.tools])
+            self._matrix = normalize_rows(np.asarray(vectors, dtype=np.float32))
+        return self._matrix
+
+    async def top_k(self, query: str, k: int) -> List[Tuple[Tool, float]]:
+        """the k tools most similar to query with their similarity, most similar first"""
+        k = min(k, len(self.tools))
+        if k <= 0:
+            return []
+        matrix = await self.matrix()
+        query_vector = normalize_rows(np.asarray((await self.embed([query]))[0], dtype=np.float32))
+        scores = matrix @ query_vector
+        top = np.argpartition(-scores, k-1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self.tools[i], float(scores[i])) for i in top]
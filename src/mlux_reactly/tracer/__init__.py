@@ -1 +1,5 @@
-from .test_tracer import TestTracer, Event, make_json_serializable, format_tracer, format_tracer_with_nr, FormatConfig, TraceConfig, LIVE_VERBOSE, format_event
\ No newline at end of file
+from .test_tracer import TestTracer, Event, make_json_serializable, format_tracer, format_tracer_with_nr, FormatConfig, TraceConfig, LIVE_VERBOSE, format_event
+from .metrics_tracer import MetricsTracer
+from .trace_sink import TraceSink, read_trace
+from .trace_store import TraceStore
+from .timeline import chrome_trace, write_chrome_trace, collapsed_stacks, critical_path, close_events
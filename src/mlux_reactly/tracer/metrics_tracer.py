@@ -0,0 +1,313 @@
+from typing import Any, Dict, List, Tuple, TextIO
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import threading
+import time
+from mlux_reactly import Tracer
+
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+"""upper bounds in seconds of the duration histogram buckets"""
+
+TIMED_KEYS = frozenset(['query', 'query_many', 'task', 'stage', 'llmcall', 'toolrun'])
+"""event keys whose duration is recorded (until their 'result' or 'failed' child event)"""
+
+
+class Histogram:
+    """counts of observed values per bucket (not cumulative), with their sum"""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """(upper bound, number of values <= bound) per bucket, the last bound is inf"""
+        result, total = [], 0
+        for bound, count in zip(list(self.bounds) + [math.inf], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> float|None:
+        """estimated by linear interpolation within the bucket, the upper bound of the largest finite bucket if beyond"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        lower, seen = 0.0, 0
+        for bound, count in zip(self.bounds, self.counts):
+            if seen + count >= rank and count > 0:
+                return lower + (bound - lower) * (rank - seen) / count
+            lower, seen = bound, seen + count
+        return self.bounds[-1] if self.bounds else None
+
+
+class _Span(Tracer):
+    """the tracer of one event, only keeping what the metrics need"""
+    __slots__ = ('metrics', 'key', 'name', 'model', 'start', 'done')
+
+    def __init__(self, metrics: 'MetricsTracer', key: str, name: str, model: str):
+        self.metrics = metrics
+        self.key = key
+        self.name = name
+        self.model = model
+        self.start = time.perf_counter()
+        self.done = False
+
+    def on(self, key: str, args: Dict[str, Any]) -> Tracer:
+        metrics = self.metrics
+        if key == 'result' or key == 'failed':
+            if not self.done:
+                self.done = True
+                if self.key in TIMED_KEYS:
+                    metrics._observe(self.key, self.name, time.perf_counter() - self.start)
+            if key == 'failed':
+                metrics._count_failure(self.key, self.name, args.get('reason_code') or 'error')
+            return _DONE
+        metrics._count_event(key)
+        if key == 'try':
+            if args.get('nr', 0) > 0:
+                metrics._count_retry(self.key, self.name)
+            return _Attempt(metrics, self.key, self.name, self.model)
+        return _Span(metrics, key, _event_name(key, args), args.get('model', self.model))
+
+    def add_arg(self, arg_name: str, arg: Any):
+        if self.key != 'llmcall' and self.key != 'toolrun':
+            return
+        if arg_name == 'model' and arg:
+            self.model = arg
+        elif arg_name == 'prompt_tokens' or arg_name == 'completion_tokens':
+            self.metrics._count_tokens(self.model, self.name, arg_name[:-len('_tokens')], arg)
+        elif arg_name == 'queue_wait':
+            self.metrics._observe_queue_wait(self.model, arg)
+        elif (arg_name == 'cache' and arg == 'hit') or (arg_name == 'cache_hit' and arg):
+            self.metrics._count_cache_hit(self.key, self.name)
+
+
+class _Attempt(_Span):
+    """a try of its parent event: failures are counted as failed attempts of the parent, not timed"""
+    __slots__ = ()
+
+    def on(self, key: str, args: Dict[str, Any]) -> Tracer:
+        if key == 'failed':
+            self.metrics._count_attempt_failure(self.key, self.name, args.get('reason_code') or 'error')
+            return _DONE
+        if key == 'result':
+            return _DONE
+        self.metrics._count_event(key)
+        return _Span(self.metrics, key, _event_name(key, args), args.get('model', self.model))
+
+
+class _Done(Tracer):
+    def on(self, key: str, args: Dict[str, Any]) -> Tracer:
+        return self
+    def add_arg(self, arg_name, arg):
+        return
+
+_DONE = _Done()
+
+
+def _event_name(key: str, args: Dict[str, Any]) -> str:
+    if key == 'stage':
+        return args.get('name', '')
+    if key == 'llmcall':
+        return args.get('stage', '')
+    if key == 'toolrun':
+        tool = args.get('tool')
+        return getattr(tool, 'name', '')
+    return ''
+
+
+def _labels(**labels: Any) -> str:
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels.keys(), escaped)) + '}'
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if math.isinf(bound) else repr(bound)
+
+
+class MetricsTracer(Tracer):
+    """Records latency and throughput metrics of the agent instead of an event tree.
+
+    Keeps duration histograms per event key (and stage, tool or LLM stage name), counters of retries, failures,
+    cache hits and events, token counts per model and stage, and LLM scheduler queue waits.
+    The memory only grows with the number of distinct names (stages, tools, models, failure reasons), not with the number of events.
+    Export with `prometheus_text()` (or `serve_prometheus()`), `snapshot()` or periodically with `start_snapshots()`."""
+
+    def __init__(self, *, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, namespace: str = 'reactly'):
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._durations: Dict[Tuple[str, str], Histogram] = {}
+        self._queue_waits: Dict[str, Histogram] = {}
+        self._failures: Dict[Tuple[str, str, str], int] = {}
+        self._attempt_failures: Dict[Tuple[str, str, str], int] = {}
+        self._retries: Dict[Tuple[str, str], int] = {}
+        self._cache_hits: Dict[Tuple[str, str], int] = {}
+        self._events: Dict[str, int] = {}
+        self._tokens: Dict[Tuple[str, str, str], int] = {}
+        self._snapshot_stop: threading.Event|None = None
+        self._snapshot_thread: threading.Thread|None = None
+
+    def on(self, key: str, args: Dict[str, Any]) -> Tracer:
+        self._count_event(key)
+        return _Span(self, key, _event_name(key, args), args.get('model', ''))
+
+    def add_arg(self, arg_name: str, arg: Any):
+        return
+
+    # recording, called by the spans
+
+    def _observe(self, key: str, name: str, duration: float) -> None:
+        with self._lock:
+            histogram = self._durations.get((key, name))
+            if histogram is None:
+                histogram = self._durations[(key, name)] = Histogram(self.buckets)
+            histogram.observe(duration)
+
+    def _observe_queue_wait(self, model: str, wait: float) -> None:
+        with self._lock:
+            histogram = self._queue_waits.get(model)
+            if histogram is None:
+                histogram = self._queue_waits[model] = Histogram(self.buckets)
+            histogram.observe(wait)
+
+    def _increment(self, counter: Dict, labels: Any, amount: int = 1) -> None:
+        with self._lock:
+            counter[labels] = counter.get(labels, 0) + amount
+
+    def _count_failure(self, key: str, name: str, reason: str) -> None:
+        self._increment(self._failures, (key, name, reason))
+
+    def _count_attempt_failure(self, key: str, name: str, reason: str) -> None:
+        self._increment(self._attempt_failures, (key, name, reason))
+
+    def _count_retry(self, key: str, name: str) -> None:
+        self._increment(self._retries, (key, name))
+
+    def _count_cache_hit(self, key: str, name: str) -> None:
+        self._increment(self._cache_hits, (key, name))
+
+    def _count_event(self, key: str) -> None:
+        self._increment(self._events, key)
+
+    def _count_tokens(self, model: str, stage: str, kind: str, nr_tokens: int) -> None:
+        self._increment(self._tokens, (model, stage, kind), nr_tokens)
+
+    # export
+
+    def prometheus_text(self) -> str:
+        """all metrics in the Prometheus text exposition format"""
+        ns = self.namespace
+        lines: List[str] = []
+
+        def histograms(metric: str, help: str, items: List[Tuple[Dict[str, str], Histogram]]) -> None:
+            lines.extend([f"# HELP {ns}_{metric} {help}", f"# TYPE {ns}_{metric} histogram"])
+            for labels, histogram in items:
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{ns}_{metric}_bucket{_labels(**labels, le=_format_bound(bound))} {count}")
+                lines.append(f"{ns}_{metric}_sum{_labels(**labels)} {histogram.sum!r}")
+                lines.append(f"{ns}_{metric}_count{_labels(**labels)} {histogram.count}")
+
+        def counters(metric: str, help: str, label_names: Tuple[str, ...], counter: Dict) -> None:
+            lines.extend([f"# HELP {ns}_{metric} {help}", f"# TYPE {ns}_{metric} counter"])
+            for labels, value in sorted(counter.items()):
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                lines.append(f"{ns}_{metric}{_labels(**dict(zip(label_names, labels)))} {value}")
+
+        with self._lock:
+            histograms('duration_seconds', 'duration of agent operations by event key and stage/tool name',
+                       [({'key': key, 'name': name}, h) for (key, name), h in sorted(self._durations.items())])
+            histograms('llm_queue_wait_seconds', 'time LLM requests waited for the LLM scheduler',
+                       [({'model': model}, h) for model, h in sorted(self._queue_waits.items())])
+            counters('failures_total', 'operations that failed', ('key', 'name', 'reason'), self._failures)
+            counters('attempt_failures_total', 'single tries that failed (and may have been retried)', ('key', 'name', 'reason'), self._attempt_failures)
+            counters('retries_total', 'retries of stages and tasks', ('key', 'name'), self._retries)
+            counters('cache_hits_total', 'LLM calls and tool runs served from cache', ('key', 'name'), self._cache_hits)
+            counters('tokens_total', 'prompt and completion tokens of LLM calls', ('model', 'stage', 'kind'), self._tokens)
+            counters('events_total', 'trace events by key', ('key',), self._events)
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """all metrics as JSON serializable dict, durations with estimated percentiles"""
+        def histogram(h: Histogram) -> Dict[str, Any]:
+            return {
+                'count': h.count, 'sum': h.sum,
+                'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99),
+                'buckets': {_format_bound(bound): count for bound, count in h.cumulative()},
+            }
+
+        def counter(c: Dict) -> List[Dict[str, Any]]:
+            return [{'labels': list(labels) if isinstance(labels, tuple) else [labels], 'value': value} for labels, value in sorted(c.items())]
+
+        with self._lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self.started,
+                'durations': [{'key': key, 'name': name} | histogram(h) for (key, name), h in sorted(self._durations.items())],
+                'llm_queue_waits': [{'model': model} | histogram(h) for model, h in sorted(self._queue_waits.items())],
+                'failures': counter(self._failures),
+                'attempt_failures': counter(self._attempt_failures),
+                'retries': counter(self._retries),
+                'cache_hits': counter(self._cache_hits),
+                'tokens': counter(self._tokens),
+                'events': dict(sorted(self._events.items())),
+            }
+
+    def start_snapshots(self, file: TextIO|str, interval: float = 60.0) -> None:
+        """appends a JSON line snapshot to file (path or open text file) every interval seconds, and a last one on `close()`"""
+        self.close()
+        stop = self._snapshot_stop = threading.Event()
+
+        def write() -> None:
+            out = open(file, 'a', encoding='utf-8') if isinstance(file, str) else file
+            try:
+                while True:
+                    stopping = stop.wait(interval)
+                    out.write(json.dumps(self.snapshot()) + "\n")
+                    out.flush()
+                    if stopping:
+                        return
+            finally:
+                if isinstance(file, str):
+                    out.close()
+
+        self._snapshot_thread = threading.Thread(target=write, name='mlux-reactly-metrics', daemon=True)
+        self._snapshot_thread.start()
+
+    def close(self) -> None:
+        """stops the periodic snapshots"""
+        if self._snapshot_stop is not None and self._snapshot_thread is not None:
+            self._snapshot_stop.set()
+            self._snapshot_thread.join()
+        self._snapshot_stop = self._snapshot_thread = None
+
+    def serve_prometheus(self, port: int = 9464, addr: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """serves `prometheus_text()` over HTTP in a background thread. Stop with `server.shutdown()`"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        threading.Thread(target=server.serve_forever, name='mlux-reactly-metrics-http', daemon=True).start()
+        return server
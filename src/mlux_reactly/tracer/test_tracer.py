@@ -1,9 +1,12 @@
 from dataclasses import dataclass, asdict, is_dataclass, field
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Deque, TYPE_CHECKING
+from collections import deque
 from datetime import datetime
 from io import TextIOWrapper
 import json
 from mlux_reactly import Tracer, Tool
+if TYPE_CHECKING:
+    from .trace_sink import TraceSink
 
 
 SHOW_ALL = '_all'
@@ -35,6 +38,10 @@ class TraceConfig:
     session: str
     record_file: TextIOWrapper|None = None
     live_format: FormatConfig = FormatConfig(show=[])
+    sink: 'TraceSink|None' = None
+    """streams all events to this append-only sink"""
+    max_events: int|None = None
+    """If set, the event tree is not kept in memory, only this number of most recent events (`TestTracer.recent_events`)"""
 
 LIVE_VERBOSE = FormatConfig(show=['query', 'stage', 'task', 'toolrun', 'llmcall', 'failed', 'result'])
 
@@ -115,13 +122,32 @@ def format_event(event: Event, *, level: int|None = None, format_config: FormatC
     elif key == 'stage':
         headline += f" {NCOLOR}'{event.args.get('name', '')}'{RESET} => {format_json_line(event.args.get('result'))}"
     elif key == 'toolrun':
-        tool: Tool = event.args.get('tool') or Tool()
-        headline += f" {NCOLOR}'{tool.name}'{RESET} => {format_json_line(event.args.get('result'))}"
+        tool: Tool|str = event.args.get('tool') or Tool() # the tool name in stored traces
+        headline += f" {NCOLOR}'{tool.name if isinstance(tool, Tool) else tool}'{RESET}{' (cached)' if event.args.get('cache_hit') else ''} => {format_json_line(event.args.get('result'))}"
+    elif key == 'tool_prefilter':
+        headline += f" {format_json_line(event.args.get('shortlist'))} => {format_json_line(event.args.get('result'))}"
+    elif key == 'query_many':
+        headline += f" {NCOLOR}{event.args.get('nr_questions')} questions{RESET}, concurrency: {event.args.get('concurrency')}, max in flight: {event.args.get('max_in_flight')}"
+    elif key == 'result_shaping':
+        headline += f" trimmed {event.args.get('trimmed_tokens')} tokens: {format_json_line(event.args.get('results'))}"
+    elif key == 'input_shrunk':
+        overflow = f" {ERRCOLOR}(still exceeds the context){RESET}" if event.args.get('overflow') else ''
+        headline += f" {event.args.get('tokens')} -> {event.args.get('kept_tokens')} of {event.args.get('max_tokens')} tokens, dropped: {format_json_line(event.args.get('dropped'))}{overflow}"
+    elif key == 'answer_verified':
+        headline += f" {NCOLOR}'{event.args.get('verifier', '')}'{RESET} => satisfaction: {event.args.get('satisfaction')}"
     elif key == 'try' and arg_nr == 0:
         headline = ""
     elif key == 'try' and arg_nr != 0:
         headline = f"{ERRCOLOR}{"  "*level}* retry: {arg_nr}{RESET}"
     elif key == 'llmcall':
+        if event.args.get('cache') == 'hit':
+            headline += ' (cached)'
+        if event.args.get('prompt_eval_time') is not None:
+            headline += f" prefill: {event.args.get('prompt_eval_count')} tokens in {event.args.get('prompt_eval_time'):.3f}s"
+        if event.args.get('prompt_tokens') is not None:
+            headline += f" tokens: {event.args.get('prompt_tokens')} + {event.args.get('completion_tokens')}"
+        if event.args.get('queue_wait') is not None:
+            headline += f" queued: {event.args.get('queue_wait'):.3f}s ({event.args.get('priority')}, {event.args.get('queue_depth')} ahead)"
         if not format_config.compact:
             details += _format_text_manyline('    => ', str(event.args.get('sys_prompt', '<--- sys prompt not available --->')))
             details += _format_text_manyline('    -> ', str(event.args.get('prompt', '<--- prompt not available --->')))
@@ -145,12 +171,18 @@ def format_event(event: Event, *, level: int|None = None, format_config: FormatC
 
     if key == 'query':
         lines.append(f"{''.ljust(4)}{"  "*level} * query answer: {format_json_line(event.args.get('result'))}")
+        if event.args.get('rater_calls_skipped'):
+            lines.append(f"{''.ljust(4)}{"  "*level} * answer ratings skipped: {event.args.get('rater_calls_skipped')}")
+        if event.args.get('prompt_tokens') is not None:
+            lines.append(f"{''.ljust(4)}{"  "*level} * tokens: {event.args.get('prompt_tokens')} prompt, {event.args.get('completion_tokens')} completion")
     return "\n".join([line for line in lines if line != ""])
     
 
 
 
 def format_tracer(tracer: Tracer, format_config: FormatConfig = FormatConfig()) -> str:
+    if isinstance(tracer, TestTracer) and tracer.recent_events is not None:
+        return "\n".join(line for line in (format_event(event, format_config=format_config) for event in tracer.recent_events) if line)
     if isinstance(tracer, TestTracer):
         event = tracer.event
         for _ in range(3):
@@ -178,7 +210,7 @@ def find_event_with_nr(event: Event, nr: int) -> Event|None:
 
 def format_tracer_with_nr(tracer: Tracer, nr: int, format_config: FormatConfig = FormatConfig(compact=False)) -> str:
     if isinstance(tracer, TestTracer):
-        event = find_event_with_nr(tracer.event, nr)
+        event = tracer.find_event(nr)
         if event is not None:
             return format_event(event, format_config=format_config)
         return f"no such event with nr {nr}"
@@ -191,6 +223,8 @@ class TestTracer(Tracer):
     event: Event
     root_tracer: 'TestTracer'
     event_count: int = 0
+    recent_events: Deque[Event]|None = None
+    events_by_nr: Dict[int, Event]
     _prevent_print_live: bool = False
 
     def __init__(self, *, 
@@ -200,36 +234,64 @@ class TestTracer(Tracer):
                  session: str|None = None,
                  record_file: TextIOWrapper|None = None,
                  live_format: FormatConfig = FormatConfig(show=[]),
+                 sink: 'TraceSink|None' = None,
+                 max_events: int|None = None,
                  _prevent_print_live: bool = False):
         self.event = event or Event("root", {}, sub=[], time=datetime.now(), nr=0)
-        self.config = config or TraceConfig(session=session or f"default", record_file=record_file, live_format=live_format)
+        self.config = config or TraceConfig(session=session or f"default", record_file=record_file, live_format=live_format, sink=sink, max_events=max_events)
         self.root_tracer = root_tracer or self
         self._prevent_print_live = _prevent_print_live
+        if root_tracer is None:
+            self.events_by_nr = {}
+            if self.config.max_events is not None:
+                self.recent_events = deque(maxlen=self.config.max_events)
+            if self.config.sink is not None:
+                self.config.sink.session(self.config.session)
 
     def on(self, key: str, args: Dict[str, Any]) -> "TestTracer":
         time = datetime.now()
-        event = Event(key, args, [], time, nr=self.root_tracer.event_count, level=self.event.level+1)
-        self.root_tracer.event_count += 1
-        self.event.sub.append(event)
+        root_tracer = self.root_tracer
+        event = Event(key, args, [], time, nr=root_tracer.event_count, level=self.event.level+1)
+        root_tracer.event_count += 1
+        recent_events = root_tracer.recent_events
+        if recent_events is not None:
+            if len(recent_events) == recent_events.maxlen:
+                del root_tracer.events_by_nr[recent_events[0].nr]
+            recent_events.append(event)
+        else:
+            self.event.sub.append(event)
+        root_tracer.events_by_nr[event.nr] = event
+        if self.config.sink is not None:
+            self.config.sink.event(event, self.event.nr if self is not root_tracer else None)
+
+        if (key == 'result' or key == 'failed') and self.event.endtime is None:
+            self.event.endtime = time
 
         if key == 'result':
-            self.add_arg('result', args.get('result'))
+            self.event.args['result'] = args.get('result') # not recorded to the sink as arg, it is in the result event
             if self.event.key == 'query':
                 self._record_to_file()
 
         if key == 'failed':
-            self.root_tracer.event.args['flag_has_failed_event'] = True
+            root_tracer.event.args['flag_has_failed_event'] = True
 
-        if True or not self._prevent_print_live:
-            live_out = format_event(event, format_config=self.config.live_format, parent_key=self.event.key)
+        live_format = self.config.live_format
+        if live_format.show and (should_show(key, live_format.show) or key == 'result'):
+            live_out = format_event(event, format_config=live_format, parent_key=self.event.key)
             if live_out:
                 print(live_out)
 
         return TestTracer(config=self.config, event=event, root_tracer=self.root_tracer, 
                           _prevent_print_live=self._prevent_print_live or not should_show(key, self.config.live_format.show))
     
+    def find_event(self, nr: int) -> Event|None:
+        """the event with number nr (if still in memory)"""
+        return self.root_tracer.events_by_nr.get(nr)
+
     def add_arg(self, arg_name: str, arg: Any):
         self.event.args[arg_name] = arg
+        if self.config.sink is not None:
+            self.config.sink.arg(self.event.nr, arg_name, arg)
 
     def _record_to_file(self) -> None:
         if self.config.record_file is not None:
@@ -0,0 +1,145 @@
+from typing import Any, Dict, List, Tuple
+from datetime import datetime
+import json
+from mlux_reactly import Tool
+from .test_tracer import Event
+
+
+INSTANT_KEYS = frozenset(['result', 'failed'])
+"""keys of events that mark the end of their parent and have no duration themselves"""
+
+_HIDDEN_ARGS = frozenset(['sys_prompt', 'prompt', 'result', 'exception', 'tool'])
+
+
+def close_events(event: Event) -> datetime:
+    """Sets the missing endtimes of event and its sub events, returns the endtime of event.
+
+    Events without 'result' or 'failed' event end with their last sub event. The try markers of tasks
+    (which have no sub events) last until the next try or the end of their parent."""
+    end = event.time
+    for sub in event.sub:
+        end = max(end, close_events(sub))
+    if event.endtime is None:
+        event.endtime = end
+    else:
+        end = max(end, event.endtime)
+
+    tries = [sub for sub in event.sub if sub.key == 'try' and not sub.sub]
+    for i, sub in enumerate(tries):
+        sub.endtime = tries[i+1].time if i+1 < len(tries) else event.endtime
+    return end
+
+
+def event_label(event: Event) -> str:
+    key, args = event.key, event.args
+    if key == 'stage':
+        return f"stage {args.get('name', '')}"
+    if key == 'llmcall':
+        return f"llmcall {args.get('stage', '')}"
+    if key == 'toolrun':
+        tool = args.get('tool')
+        return f"toolrun {tool.name if isinstance(tool, Tool) else tool}"
+    if key == 'try':
+        return f"try {args.get('nr', '')}"
+    return key
+
+
+def _duration(event: Event) -> float:
+    return (event.endtime - event.time).total_seconds() if event.endtime is not None else 0.0
+
+
+def _trace_args(event: Event) -> Dict[str, Any]:
+    args: Dict[str, Any] = {'nr': event.nr}
+    for name, value in event.args.items():
+        if name in _HIDDEN_ARGS:
+            continue
+        if isinstance(value, (int, float, bool)) or (isinstance(value, str) and len(value) <= 200):
+            args[name] = value
+    return args
+
+
+def chrome_trace(event: Event) -> Dict[str, Any]:
+    """Event with its sub events in the Chrome Trace Event format (for chrome://tracing, https://ui.perfetto.dev).
+
+    Every event is a complete ('X') span, 'failed' events are instant events. Concurrent sub events (parallel tasks or tool runs)
+    are put on separate tracks ('threads'), so the spans of each track are nested."""
+    close_events(event)
+    origin = event.time
+    trace_events: List[Dict[str, Any]] = []
+    next_tid = 1
+
+    def micros(time: datetime) -> float:
+        return (time - origin).total_seconds() * 1e6
+
+    def add(event: Event, tid: int) -> None:
+        nonlocal next_tid
+        trace_events.append({
+            'name': event_label(event), 'cat': event.key, 'ph': 'X', 'pid': 1, 'tid': tid,
+            'ts': micros(event.time), 'dur': _duration(event) * 1e6, 'args': _trace_args(event),
+        })
+        lanes: List[Tuple[int, datetime]] = [(tid, event.time)] # (track, end of its last span)
+        for sub in sorted(event.sub, key=lambda sub: sub.time):
+            if sub.key == 'failed':
+                trace_events.append({'name': f"failed {sub.args.get('reason_code', '')}".strip(), 'cat': 'failed', 'ph': 'i', 's': 't',
+                                     'pid': 1, 'tid': tid, 'ts': micros(sub.time), 'args': _trace_args(sub)})
+            if sub.key in INSTANT_KEYS:
+                continue
+            assert sub.endtime is not None
+            lane = next((i for i, (_, lane_end) in enumerate(lanes) if lane_end <= sub.time), None)
+            if lane is None:
+                next_tid += 1
+                lanes.append((next_tid, sub.time))
+                lane = len(lanes) - 1
+            lanes[lane] = (lanes[lane][0], sub.endtime)
+            add(sub, lanes[lane][0])
+
+    add(event, next_tid)
+    for tid in sorted({trace_event['tid'] for trace_event in trace_events}):
+        trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': 'main' if tid == 1 else f"parallel {tid - 1}"}})
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(event: Event, path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(chrome_trace(event), f)
+
+
+def _union_seconds(intervals: List[Tuple[datetime, datetime]]) -> float:
+    total, covered_until = 0.0, None
+    for start, end in sorted(intervals):
+        if covered_until is not None and start < covered_until:
+            start = covered_until
+        if end > start:
+            total += (end - start).total_seconds()
+            covered_until = end if covered_until is None else max(covered_until, end)
+    return total
+
+
+def collapsed_stacks(event: Event) -> str:
+    """Event with its sub events in the collapsed stack format of flame graph tools (flamegraph.pl, speedscope, inferno):
+    one line 'query;task;stage make_tool_input;llmcall make_tool_input <microseconds>' per stack, with the time not spent in sub events.
+    Concurrent sub events count fully, so a parent can be narrower than its parallel children."""
+    close_events(event)
+    stacks: Dict[str, int] = {}
+
+    def add(event: Event, prefix: str) -> None:
+        stack = prefix + event_label(event).replace(';', ',')
+        subs = [sub for sub in event.sub if sub.key not in INSTANT_KEYS and sub.endtime is not None]
+        self_seconds = _duration(event) - _union_seconds([(sub.time, sub.endtime) for sub in subs if sub.endtime is not None])
+        micros = round(max(self_seconds, 0.0) * 1e6)
+        if micros > 0:
+            stacks[stack] = stacks.get(stack, 0) + micros
+        for sub in subs:
+            add(sub, stack + ';')
+
+    add(event, '')
+    return "\n".join(f"{stack} {micros}" for stack, micros in stacks.items()) + "\n"
+
+
+def critical_path(event: Event) -> List[Event]:
+    """the chain of events from event down that determined its end: at each level the sub event that ended last"""
+    close_events(event)
+    path = [event]
+    while subs := [sub for sub in path[-1].sub if sub.key not in INSTANT_KEYS and sub.endtime is not None]:
+        path.append(max(subs, key=lambda sub: (sub.endtime, sub.time)))
+    return path
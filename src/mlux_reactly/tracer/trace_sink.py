@@ -0,0 +1,200 @@
+from typing import Any, Dict, Iterator, Literal, Tuple
+import atexit
+import hashlib
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from .test_tracer import Event, make_json_serializable
+
+
+BINARY_MAGIC = b'RTRACE1\n'
+_length_prefix = struct.Struct('>I')
+
+_STOP = object()
+_FLUSH = object()
+
+
+def _read_records(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            while header := f.read(_length_prefix.size):
+                length = _length_prefix.unpack(header)[0]
+                payload = f.read(length)
+                if len(header) < _length_prefix.size or len(payload) < length:
+                    return # cut off by a crash while writing
+                yield json.loads(payload)
+        else:
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def read_trace(path: str) -> Iterator[Dict[str, Any]]:
+    """The records of a trace file written by a `TraceSink` (either format), with interned strings resolved:
+    {'t': 'session', 'session', 'time'}, {'t': 'event', 'nr', 'parent', 'key', 'time', 'level', 'args'} and {'t': 'arg', 'nr', 'name', 'value'}.
+    The 'result' arg of an event is not recorded separately, it is the result of its 'result' child event."""
+    strings: Dict[str, str] = {}
+
+    def resolve(value: Any) -> Any:
+        if isinstance(value, dict) and len(value) == 1 and '$s' in value:
+            return strings.get(value['$s'], value)
+        return value
+
+    for record in _read_records(path):
+        if record['t'] == 'string':
+            strings[record['h']] = record['v']
+        elif record['t'] == 'event':
+            record['args'] = {name: resolve(value) for name, value in record['args'].items()}
+            yield record
+        elif record['t'] == 'arg':
+            record['value'] = resolve(record['value'])
+            yield record
+        else:
+            yield record
+
+
+class TraceSink:
+    """Appends trace events to a file, serialized and written in a background thread.
+
+    format 'jsonl' writes one JSON record per line, 'binary' length-prefixed (4 bytes big endian) JSON records after a magic header,
+    which needs no escaping of line breaks and can be skipped through quickly. Read them back with `read_trace`.
+    Args in `intern_args` (like the static system prompts of the stages) are written once per distinct value and referenced by hash afterwards.
+    The tracer never waits for the writer: at most `max_queue` records wait to be written, further records are dropped (counted in `dropped`).
+    Values that cannot be serialized are written as strings, other write errors are counted in `errors` and reported once on stderr."""
+
+    def __init__(self, path: str, *, format: Literal['jsonl', 'binary'] = 'jsonl', intern_args: Tuple[str, ...] = ('sys_prompt',), max_queue: int = 10000):
+        self.path = path
+        self.format = format
+        self.intern_args = frozenset(intern_args)
+        self.records_written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._interned: set[str] = set()
+        if format == 'binary' and os.path.exists(path) and os.path.getsize(path) > 0 and not _starts_with_magic(path):
+            raise ValueError(f"{path} exists and is no binary trace file")
+        self._file = open(path, 'ab')
+        if format == 'binary' and self._file.tell() == 0:
+            self._file.write(BINARY_MAGIC)
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._writer = threading.Thread(target=self._write_loop, name='mlux-reactly-trace-sink', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    # called by the tracer, only enqueue
+
+    def session(self, session: str) -> None:
+        self._enqueue(('session', session, time.time()))
+
+    def event(self, event: Event, parent_nr: int|None) -> None:
+        self._enqueue(('event', event.nr, parent_nr, event.key, event.time.timestamp(), event.level, dict(event.args)))
+
+    def arg(self, nr: int, name: str, value: Any) -> None:
+        self._enqueue(('arg', nr, name, value))
+
+    def _enqueue(self, item: Tuple[Any, ...]) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout: float|None = 10.0) -> bool:
+        """waits (at most timeout seconds) until all records enqueued so far are written, returns whether they are"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        done = threading.Event()
+        try:
+            self._queue.put((_FLUSH, done), timeout=timeout)
+        except queue.Full:
+            return False
+        while not done.wait(0.1):
+            if not self._writer.is_alive() or (deadline is not None and time.monotonic() >= deadline):
+                return False
+        return True
+
+    def close(self, timeout: float|None = 10.0) -> None:
+        """writes the enqueued records and closes the file, waiting at most timeout seconds for the writer.
+        Records that were dropped or are still unwritten then are reported on stderr"""
+        atexit.unregister(self.close)
+        if self._writer.is_alive():
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            try:
+                self._queue.put((_STOP,), timeout=timeout)
+                self._writer.join(max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+            except queue.Full:
+                pass
+        unwritten = self._queue.qsize() if self._writer.is_alive() else 0
+        if self.dropped or unwritten:
+            print(f"TraceSink {self.path}: {self.dropped} records dropped (queue full), {unwritten} not written on close", file=sys.stderr)
+
+    # writer thread
+
+    def _write_loop(self) -> None:
+        try:
+            while True:
+                item = self._queue.get()
+                kind = item[0]
+                if kind is _STOP:
+                    return
+                try:
+                    self._write_item(item)
+                    if self._queue.empty():
+                        self._file.flush()
+                except Exception as e: # a broken record must not stop the writer
+                    self.errors += 1
+                    if self.errors == 1:
+                        print(f"TraceSink {self.path}: failed to write a {kind!r} record: {e!r}", file=sys.stderr)
+                finally:
+                    if kind is _FLUSH:
+                        item[1].set()
+        finally:
+            self._file.close()
+
+    def _write_item(self, item: Tuple[Any, ...]) -> None:
+        kind = item[0]
+        if kind is _FLUSH:
+            self._file.flush()
+        elif kind == 'session':
+            self._write({'t': 'session', 'session': item[1], 'time': item[2]})
+        elif kind == 'event':
+            _, nr, parent_nr, key, timestamp, level, args = item
+            args = {name: self._value(name, value) for name, value in args.items()}
+            self._write({'t': 'event', 'nr': nr, 'parent': parent_nr, 'key': key, 'time': timestamp, 'level': level, 'args': args})
+        elif kind == 'arg':
+            _, nr, name, value = item
+            self._write({'t': 'arg', 'nr': nr, 'name': name, 'value': self._value(name, value)})
+
+    def _value(self, name: str, value: Any) -> Any:
+        if name in self.intern_args:
+            return self._intern(value)
+        value = make_json_serializable(value)
+        try:
+            json.dumps(value, ensure_ascii=False)
+        except (TypeError, ValueError): # e.g. dicts with tuple keys
+            return str(value)
+        return value
+
+    def _intern(self, value: Any) -> Any:
+        if not isinstance(value, str):
+            return make_json_serializable(value)
+        h = hashlib.blake2b(value.encode(), digest_size=8).hexdigest()
+        if h not in self._interned:
+            self._interned.add(h)
+            self._write({'t': 'string', 'h': h, 'v': value})
+        return {'$s': h}
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode()
+        if self.format == 'binary':
+            self._file.write(_length_prefix.pack(len(payload)) + payload)
+        else:
+            self._file.write(payload + b'\n')
+        self.records_written += 1
+
+
+def _starts_with_magic(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
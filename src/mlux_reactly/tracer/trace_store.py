@@ -0,0 +1,293 @@
+from typing import Any, Dict, Iterable, List, Tuple
+from datetime import datetime
+import argparse
+import json
+import sqlite3
+from .test_tracer import TestTracer, Event, FormatConfig, make_json_serializable, format_event
+from .trace_sink import read_trace
+from .timeline import chrome_trace, collapsed_stacks
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    session INTEGER NOT NULL,
+    nr INTEGER NOT NULL,
+    parent INTEGER,
+    key TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    model TEXT,
+    start REAL NOT NULL,
+    end REAL,
+    duration REAL,
+    failed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (session, nr)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS events_parent ON events (session, parent);
+CREATE INDEX IF NOT EXISTS events_key_name ON events (key, name);
+CREATE INDEX IF NOT EXISTS events_key_duration ON events (key, duration);
+CREATE INDEX IF NOT EXISTS events_model ON events (model, key);
+CREATE TABLE IF NOT EXISTS args (
+    session INTEGER NOT NULL,
+    nr INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (session, nr, name)
+) WITHOUT ROWID;
+"""
+
+NAME_ARGS = {'stage': 'name', 'llmcall': 'stage', 'toolrun': 'tool'}
+"""the arg naming an event of a key, stored in the name column"""
+
+
+class _SessionImport:
+    """keys, parents and models of the events of the session being imported, to time and name the events"""
+    def __init__(self, store: 'TraceStore', session: int):
+        self.store = store
+        self.session = session
+        self.events: Dict[int, Tuple[int|None, str]] = {}
+
+    def event(self, nr: int, parent: int|None, key: str, timestamp: float, args: Dict[str, Any]) -> None:
+        db = self.store.db
+        name = args.get(NAME_ARGS.get(key, ''), '')
+        model = args.get('model')
+        db.execute("INSERT OR REPLACE INTO events (session, nr, parent, key, name, model, start) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (self.session, nr, parent, key, name if isinstance(name, str) else str(name), model, timestamp))
+        db.executemany("INSERT OR REPLACE INTO args VALUES (?, ?, ?, ?)",
+                       [(self.session, nr, arg_name, json.dumps(value, ensure_ascii=False)) for arg_name, value in args.items()])
+        self.events[nr] = (parent, key)
+        if parent is None:
+            return
+        if key == 'result' or key == 'failed':
+            db.execute("UPDATE events SET end = ?, duration = ? - start, failed = ? WHERE session = ? AND nr = ? AND end IS NULL",
+                       (timestamp, timestamp, key == 'failed', self.session, parent))
+            if key == 'result':
+                db.execute("INSERT OR REPLACE INTO args VALUES (?, ?, 'result', ?)", (self.session, parent, json.dumps(args.get('result'), ensure_ascii=False)))
+        if key == 'llmcall' and model is not None:
+            self.set_stage_model(parent, model)
+
+    def arg(self, nr: int, name: str, value: Any) -> None:
+        db = self.store.db
+        db.execute("INSERT OR REPLACE INTO args VALUES (?, ?, ?, ?)", (self.session, nr, name, json.dumps(value, ensure_ascii=False)))
+        if name == 'model' and self.events.get(nr, (None, ''))[1] == 'llmcall':
+            db.execute("UPDATE events SET model = ? WHERE session = ? AND nr = ?", (value, self.session, nr))
+            self.set_stage_model(self.events[nr][0], value)
+
+    def set_stage_model(self, nr: int|None, model: str) -> None:
+        """stages get the model of their LLM calls (of the last call, if a cascade escalated)"""
+        while nr is not None and nr in self.events:
+            parent, key = self.events[nr]
+            if key == 'stage':
+                self.store.db.execute("UPDATE events SET model = ? WHERE session = ? AND nr = ?", (model, self.session, nr))
+                return
+            if key != 'try':
+                return
+            nr = parent
+
+
+class TraceStore:
+    """Traces in a SQLite database, indexed for looking up events by number and filtering by key, name (stage, tool), model and duration.
+
+    Events are imported from trace files of a `TraceSink` or from a `TestTracer`. Each trace session gets its own id,
+    the event numbers are unique within a session. Durations are the time until the 'result' or 'failed' child event."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _new_session(self, name: str, started: float) -> _SessionImport:
+        session = self.db.execute("INSERT INTO sessions (name, started) VALUES (?, ?)", (name, started)).lastrowid
+        assert session is not None
+        return _SessionImport(self, session)
+
+    def import_trace(self, path: str) -> List[int]:
+        """imports a trace file written by a `TraceSink` record by record, returns the ids of the new sessions"""
+        sessions: List[int] = []
+        current: _SessionImport|None = None
+        with self.db:
+            for record in read_trace(path):
+                if record['t'] == 'session':
+                    current = self._new_session(record['session'], record['time'])
+                    sessions.append(current.session)
+                elif record['t'] == 'event':
+                    if current is None:
+                        current = self._new_session(path, record['time'])
+                        sessions.append(current.session)
+                    parent = record['parent'] if record['parent'] in current.events else None
+                    current.event(record['nr'], parent, record['key'], record['time'], record['args'])
+                elif record['t'] == 'arg' and current is not None:
+                    current.arg(record['nr'], record['name'], record['value'])
+        return sessions
+
+    def import_tracer(self, tracer: TestTracer) -> int:
+        """imports the events of a TestTracer kept in memory (its tree, or its recent events), returns the id of the new session"""
+        root = tracer.root_tracer
+        with self.db:
+            current = self._new_session(root.config.session, root.event.time.timestamp())
+
+            def add(event: Event, parent: int|None) -> None:
+                args = make_json_serializable(event.args)
+                if event.key == 'result' and parent is not None:
+                    args = {'result': args.get('result')}
+                current.event(event.nr, parent, event.key, event.time.timestamp(), args)
+                for sub in event.sub:
+                    add(sub, event.nr)
+
+            events: Iterable[Event] = root.recent_events if root.recent_events is not None else root.event.sub
+            for event in events:
+                add(event, None)
+        return current.session
+
+    # queries
+
+    def sessions(self) -> List[Dict[str, Any]]:
+        rows = self.db.execute("""SELECT s.id, s.name, s.started, COUNT(e.nr) AS nr_events FROM sessions s
+                                  LEFT JOIN events e ON e.session = s.id GROUP BY s.id ORDER BY s.id""")
+        return [dict(row) for row in rows]
+
+    def last_session(self) -> int|None:
+        row = self.db.execute("SELECT MAX(id) FROM sessions").fetchone()
+        return row[0]
+
+    def get(self, session: int, nr: int, *, with_args: bool = True) -> Dict[str, Any]|None:
+        """the event with number nr of session, with its args"""
+        row = self.db.execute("SELECT * FROM events WHERE session = ? AND nr = ?", (session, nr)).fetchone()
+        if row is None:
+            return None
+        event = dict(row)
+        if with_args:
+            event['args'] = self.args(session, nr)
+        return event
+
+    def args(self, session: int, nr: int) -> Dict[str, Any]:
+        rows = self.db.execute("SELECT name, value FROM args WHERE session = ? AND nr = ?", (session, nr))
+        return {name: json.loads(value) for name, value in rows}
+
+    def children(self, session: int, nr: int) -> List[Dict[str, Any]]:
+        rows = self.db.execute("SELECT * FROM events WHERE session = ? AND parent = ? ORDER BY nr", (session, nr))
+        return [dict(row) for row in rows]
+
+    def find(self, *, session: int|None = None, key: str|None = None, name: str|None = None, model: str|None = None,
+             failed: bool|None = None, min_duration: float|None = None, slowest: bool = False, limit: int|None = 100) -> List[Dict[str, Any]]:
+        """events matching all given filters (without args), by start time or the slowest first"""
+        conditions: List[str] = []
+        params: List[Any] = []
+        for column, value in (('session', session), ('key', key), ('name', name), ('model', model)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if failed is not None:
+            conditions.append("failed = ?")
+            params.append(int(failed))
+        if min_duration is not None:
+            conditions.append("duration >= ?")
+            params.append(min_duration)
+        if slowest:
+            conditions.append("duration IS NOT NULL")
+        sql = "SELECT * FROM events"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY duration DESC" if slowest else " ORDER BY session, nr"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [dict(row) for row in self.db.execute(sql, params)]
+
+    def load_event(self, session: int, nr: int, *, depth: int|None = None) -> Event|None:
+        """the event with its sub events (up to depth levels) as Event tree, e.g. for `format_event`"""
+        row = self.get(session, nr)
+        if row is None:
+            return None
+        return self._as_event(row, session, depth)
+
+    def _as_event(self, row: Dict[str, Any], session: int, depth: int|None) -> Event:
+        args = row['args'] if 'args' in row else self.args(session, row['nr'])
+        event = Event(row['key'], args, [], datetime.fromtimestamp(row['start']), row['nr'],
+                      endtime=datetime.fromtimestamp(row['end']) if row['end'] is not None else None)
+        if depth is None or depth > 0:
+            event.sub = [self._as_event(child, session, depth - 1 if depth is not None else None) for child in self.children(session, row['nr'])]
+        return event
+
+
+def _format_row(row: Dict[str, Any]) -> str:
+    duration = f"{row['duration']:.3f}s" if row['duration'] is not None else '-'
+    parts = [f"{row['session']}:{row['nr']}", row['key'], row['name'] or '', row['model'] or '', duration, 'FAILED' if row['failed'] else '']
+    return "  ".join(part for part in parts if part)
+
+
+def main(argv: List[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m mlux_reactly.tracer.trace_store', description="Query traces stored in a SQLite trace store")
+    parser.add_argument('db', help="SQLite trace store file")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help="import trace files written by a TraceSink")
+    import_parser.add_argument('files', nargs='+')
+
+    commands.add_parser('sessions', help="list the stored sessions")
+
+    show_parser = commands.add_parser('show', help="show an event with its sub events")
+    show_parser.add_argument('nr', type=int)
+    show_parser.add_argument('--session', type=int, help="default: the last session")
+    show_parser.add_argument('--depth', type=int)
+    show_parser.add_argument('--verbose', action='store_true', help="include LLM calls with their prompts")
+
+    export_parser = commands.add_parser('export', help="export an event (e.g. a query) as Chrome trace / Perfetto JSON or collapsed flame graph stacks")
+    export_parser.add_argument('nr', type=int)
+    export_parser.add_argument('--session', type=int, help="default: the last session")
+    export_parser.add_argument('--format', choices=['chrome', 'collapsed'], default='chrome')
+
+    find_parser = commands.add_parser('find', help="list events matching the filters")
+    find_parser.add_argument('--session', type=int)
+    find_parser.add_argument('--key')
+    find_parser.add_argument('--name', help="stage, tool or LLM call stage name")
+    find_parser.add_argument('--model')
+    find_parser.add_argument('--failed', action='store_true')
+    find_parser.add_argument('--min-duration', type=float)
+    find_parser.add_argument('--slowest', type=int, metavar='N', help="the N slowest events")
+    find_parser.add_argument('--limit', type=int, default=100)
+
+    args = parser.parse_args(argv)
+    store = TraceStore(args.db)
+    try:
+        if args.command == 'import':
+            for file in args.files:
+                print(f"{file}: sessions {store.import_trace(file)}")
+        elif args.command == 'sessions':
+            for session in store.sessions():
+                print(f"{session['id']}  {datetime.fromtimestamp(session['started']):%Y-%m-%d %H:%M:%S}  {session['name']}  {session['nr_events']} events")
+        elif args.command == 'show':
+            session = args.session if args.session is not None else store.last_session()
+            event = store.load_event(session, args.nr, depth=args.depth) if session is not None else None
+            if event is None:
+                print(f"no such event with nr {args.nr}")
+            else:
+                print(format_event(event, format_config=FormatConfig(compact=not args.verbose)))
+        elif args.command == 'export':
+            session = args.session if args.session is not None else store.last_session()
+            event = store.load_event(session, args.nr) if session is not None else None
+            if event is None:
+                print(f"no such event with nr {args.nr}")
+            elif args.format == 'chrome':
+                print(json.dumps(chrome_trace(event)))
+            else:
+                print(collapsed_stacks(event), end='')
+        elif args.command == 'find':
+            rows = store.find(session=args.session, key=args.key, name=args.name, model=args.model, failed=True if args.failed else None,
+                              min_duration=args.min_duration, slowest=args.slowest is not None, limit=args.slowest or args.limit)
+            for row in rows:
+                print(_format_row(row))
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
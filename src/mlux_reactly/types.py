@@ -1,6 +1,8 @@
-from typing import Callable, Any, Dict, Tuple, List
-from typing import Protocol, TypeAlias, TypeVar
+from typing import Callable, Any, Dict, Tuple, List, AsyncIterator
+from typing import Protocol, TypeAlias, TypeVar, Literal, TYPE_CHECKING
 from dataclasses import dataclass, field
+if TYPE_CHECKING:
+    from .cache import ToolResultCache
 
 _UNUSED_sentinel = object()
 AnyBasic: TypeAlias = None | str | int | float | bool | list['AnyBasic'] | tuple[str, 'AnyBasic']
@@ -16,16 +18,82 @@ class Tool:
     doc: str = 'This tool does not exist and does nothing when called'
     input_doc: Dict = field(default_factory=dict)
     run: Callable[..., Any] = lambda **kwargs: ""
+    cache: 'ToolResultCache|None' = None
+    """caches the results of the tool, see `cached_tool`"""
+    execution: Literal['inline', 'thread', 'process'] = 'thread'
+    """How a sync `run` is executed: 'inline' in the event loop (for quick tools, blocks the agent while running),
+    'thread' in the tool thread pool, 'process' in the tool process pool (for CPU heavy tools, `run` has to be picklable).
+    Async tools always run in the event loop."""
+    timeout: float|None = None
+    """Maximal duration in seconds of a tool run, overriding `AgentConfig.tool_timeout`. Overrunning async tools are cancelled,
+    others are abandoned (their thread or process finishes in the background). Not enforced for inline sync tools."""
+
+@dataclass
+class ToolError:
+    """result of a failed tool run, given to the answer stage instead of a result"""
+    error: Literal['timeout', 'exception']
+    message: str
 
 NO_TOOL = Tool("", "The No Tool. This tool does not exist and does nothing when called.", {}, lambda **kwargs: "")
 
 @dataclass
-class LLM:
+class LLMRequest:
+    sys_prompt: str
+    prompt: str
+    stage: str = ''
+    """name of the stage issuing this request (used by backends for per-stage options)"""
+    attempt: int = 0
+    """0 for the first try of a stage, >0 for retries"""
+    cache: bool = True
+    """whether a cached response may be used"""
+    format: Dict[str, Any]|None = None
+    """JSON schema the response has to follow (structured output), None for unconstrained output"""
+    options: Dict[str, Any] = field(default_factory=dict)
+    """model options for this request only, overriding the options of the backend"""
+
+    def as_messages(self) -> List[Dict[str, str]]:
+        messages = []
+        if self.sys_prompt:
+            messages.append({'role': 'system', 'content': self.sys_prompt})
+        messages.append({'role': 'user', 'content': self.prompt})
+        return messages
+
+@dataclass
+class LLMResponse:
+    content: str
+    cached: bool|None = None
+    """True if served from a cache, False on a cache miss, None if no cache was involved"""
+    prompt_eval_count: int|None = None
+    """number of prompt tokens the LLM had to process (prefill), i.e. without tokens reused from its prompt cache"""
+    prompt_eval_time: float|None = None
+    """prefill duration in seconds"""
+    eval_count: int|None = None
+    """number of generated tokens"""
+    model: str|None = None
+    """the model that produced the response, if not the model of the backend (see `RoutedLLM`)"""
+
+class LLM(Protocol):
+    """A LLM backend. See `mlux_reactly.llms` for implementations."""
     model: str
+    async def chat(self, request: LLMRequest) -> LLMResponse: ...
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        """the response content in chunks as they are generated"""
+        yield (await self.chat(request)).content
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        """one embedding vector per text"""
+        raise NotImplementedError(f"{type(self).__name__} does not support embeddings")
+
+    def options_for(self, stage: str) -> Dict[str, Any]:
+        """model options used for requests of a stage"""
+        return {}
 
 @dataclass
 class Task:
     description: str = ""
+    depends_on: List[int]|None = None
+    """indices of the tasks this task depends on. None if unknown, i.e. it may depend on all previous tasks"""
 
 @dataclass
 class TaskResult:
@@ -39,11 +107,36 @@ class Answer:
     satisfaction: float = 0.0
     reason: str = ''
 
+@dataclass
+class StreamEvent:
+    """Progress of a streamed query. kinds:
+    'task' (data: task description), 'toolrun' (data: tool name), 'token' (data: chunk of the final answer),
+    'retry' (data: try number; the final answer is generated again, the tokens so far are void), 'answer' (data: the complete final answer)"""
+    kind: str
+    data: Any
+
 @dataclass
 class ChatQA:
     question: str
     response: str
 
+@dataclass
+class StageRoute:
+    """Where the requests of a stage go, see `AgentConfig.stage_routes`"""
+    llm: LLM|None = None
+    """backend (and thus model) for the stage, None for the backend of the agent"""
+    options: Dict[str, Any] = field(default_factory=dict)
+    """model options for the stage, overriding the options of the backend"""
+    escalate_to: LLM|None = None
+    """If set, a response of `llm` that is no valid JSON (for stages with JSON output) or not accepted by `accept` is discarded
+    and the request is sent to this backend instead. Retries of the stage go to this backend directly."""
+    accept: Callable[[str], bool]|None = None
+    """confidence check of a response of `llm`, e.g. `mlux_reactly.llms.decisive_scores()`"""
+
+AnswerVerifier: TypeAlias = Callable[[str, str, List[Any]], float|None]
+"""Checks the answer of a task (task description, answer, results of the tool runs) without LLM.
+Returns the satisfaction score if it is confident, None to let the LLM rate the answer. See `mlux_reactly.verifiers`."""
+
 class Tracer(Protocol):
     def on(self, key: str, args: Dict[str, Any]) -> "Tracer": ...
     def add_arg(self, arg_name: str, arg: Any): ...
@@ -64,5 +157,63 @@ class AgentConfig:
     tool_use_rating_threshold: float = 0.5
     """Minimum rating (score between 0 and 1) a tool needs to be rated for a specific task in order to be used for this task"""
 
+    tool_pipeline: Literal['classic', 'fused'] = 'classic'
+    """How tools are selected for a task. 'classic': one LLM call rates all tools, then one call per selected tool generates its input.
+    'fused': a single LLM call selects the tools and generates their inputs (fewer calls, tool_use_rating_threshold is not used)."""
+
     task_answer_satisfaction_threshold: float = 0.5
     """Minimum satisfaction score (between 0 and 1) an answer of a task must have in order to be accepted, otherwise the task will be retried."""
+
+    answer_verifiers: List[AnswerVerifier] = field(default_factory=list)
+    """Cheap checks tried in order before the LLM rates a task answer. The first confident verdict is used and the LLM rating is skipped.
+    E.g. `mlux_reactly.verifiers.DEFAULT_ANSWER_VERIFIERS`."""
+
+    max_parallel_tasks: int = 1
+    """Maximal number of tasks run concurrently. If greater than 1, the question is split into tasks with dependencies and independent tasks run concurrently."""
+
+    max_parallel_tool_runs: int = 1
+    """Maximal number of tools used concurrently for a task (each generating its input and running). If 1, the selected tools are used one after another."""
+
+    tool_timeout: float|None = None
+    """Maximal duration in seconds of a single tool run (if the tool sets no `timeout`). An overrunning tool run is abandoned and reported as failed to the answer stage."""
+
+    tool_result_max_tokens: int|None = 1000
+    """Maximal (estimated) number of tokens of a single tool result given to the answer stage. Longer results are cut down
+    to their passages most relevant to the task."""
+
+    tool_results_max_tokens: int|None = 2500
+    """Maximal (estimated) number of tokens of all tool results given to the answer stage together"""
+
+    tool_threads: int|None = None
+    """Size of the thread pool running tools with execution 'thread' (None: Python's default)"""
+
+    tool_processes: int|None = None
+    """Size of the process pool running tools with execution 'process' (None: number of CPUs)"""
+
+    tool_prefilter_top_k: int|None = None
+    """If set, tools are shortlisted by embedding similarity to the task and only the k most similar tools are rated by the LLM"""
+
+    tool_prefilter_decisive_margin: float|None = None
+    """If set, the LLM tool rating is skipped when the embedding similarity of the most similar tool exceeds the second one by at least this margin. Only this tool is used then."""
+
+    tool_prefilter_decisive_min_score: float = 0.5
+    """The most similar tool is only decisive if its similarity to the task is at least this high"""
+
+    llm_priority: Literal['interactive', 'batch'] = 'interactive'
+    """Priority class of the LLM requests of queries, see `mlux_reactly.framework.LLM_SCHEDULER`. `query_many` uses 'batch'."""
+
+    stage_routes: Dict[str, StageRoute] = field(default_factory=dict)
+    """Maps stage names to the backend, options and escalation used for that stage (e.g. a small model for the rating stages).
+    Stages without route use the backend of the agent."""
+
+    local_embeddings: bool = False
+    """Use a local hashing embedding instead of the embeddings of the LLM backend (for the tool prefilter and the history retrieval)"""
+
+    history_keep_last: int = 8
+    """Number of most recent chat interactions given verbatim to the agent. Older ones are folded into a summary."""
+
+    history_token_budget: int = 2000
+    """Maximal (estimated) number of tokens of the verbatim chat interactions. If exceeded, more interactions are folded into the summary."""
+
+    history_retrieve_top_k: int = 0
+    """If greater than 0, this number of folded chat interactions most similar to the question (by embedding) are given to the agent again"""
@@ -0,0 +1,103 @@
+from typing import Any, List
+import json
+import re
+import numpy as np
+from .types import AnswerVerifier, ToolError
+
+
+_number_re = re.compile(r"[-+]?\d+(?:,\d{3})*(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_word_re = re.compile(r"\w+")
+
+
+def successful_results(tool_results: List[Any]) -> List[Any]:
+    """the tool results without the ones of failed tool runs"""
+    return [r for r in tool_results if not isinstance(r, ToolError)]
+
+def as_number(value: Any) -> float|None:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip().replace(',', ''))
+        except ValueError:
+            return None
+    return None
+
+def numbers_in(text: str) -> np.ndarray:
+    return np.array([float(n.replace(',', '')) for n in _number_re.findall(text)], dtype=np.float64)
+
+def words_in(value: Any) -> np.ndarray:
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    return np.array(_word_re.findall(text.lower()), dtype=str)
+
+
+def containment_verifier(*, min_length: int = 4, score: float = 1.0) -> AnswerVerifier:
+    """confident if a (non-numeric) string tool result is contained verbatim in the answer as whole words (ignoring case and whitespace).
+    Results shorter than min_length and single stopwords (like "no") are too unspecific to count, unless they contain several words or a digit."""
+    def verify(task: str, answer: str, tool_results: List[Any]) -> float|None:
+        normalized_answer = answer.lower()
+        for result in successful_results(tool_results):
+            if not isinstance(result, str) or as_number(result) is not None:
+                continue
+            result_words = result.lower().split()
+            if not result_words:
+                continue
+            specific = len(result_words) >= 2 or any(c.isdigit() for c in result_words[0]) \
+                or (len(result_words[0]) >= min_length and result_words[0] not in STOPWORDS)
+            pattern = r'(?<!\w)' + r'\s+'.join(map(re.escape, result_words)) + r'(?!\w)'
+            if specific and re.search(pattern, normalized_answer):
+                return score
+        return None
+    verify.__name__ = 'containment_verifier'
+    return verify
+
+
+def numeric_verifier(*, rtol: float = 1e-6, score: float = 1.0) -> AnswerVerifier:
+    """confident if a numeric tool result appears as number in the answer"""
+    def verify(task: str, answer: str, tool_results: List[Any]) -> float|None:
+        expected = np.array([n for n in map(as_number, successful_results(tool_results)) if n is not None], dtype=np.float64)
+        if expected.size == 0:
+            return None
+        stated = numbers_in(answer)
+        if stated.size == 0:
+            return None
+        if np.isclose(stated[:, None], expected[None, :], rtol=rtol, atol=0.0).any():
+            return score
+        return None
+    verify.__name__ = 'numeric_verifier'
+    return verify
+
+
+STOPWORDS = frozenset("""
+a an the and or but nor not no of in on at to for from by with without about as into onto over under than then so if
+is are was were be been being am do does did done has have had having will would shall should can could may might must
+it its this that these those there here he she they them his her their we us our you your i me my which who whom whose what
+when where why how all any both each few more most other some such only own same too very just also yes
+""".split())
+"""words ignored by lexical_overlap_verifier and not specific enough as result for containment_verifier"""
+
+def lexical_overlap_verifier(*, min_overlap: float = 0.8, min_words: int = 2, score: float = 0.8) -> AnswerVerifier:
+    """Rates answers whose content words (without stopwords) that are not in the task occur in the tool results:
+    score times their fraction in the tool results, if it is at least min_overlap (otherwise not confident).
+    An answer only repeating the wording of the task is not rated. The default score stays below the exact numeric and containment checks."""
+    def verify(task: str, answer: str, tool_results: List[Any]) -> float|None:
+        results = successful_results(tool_results)
+        answer_words = words_in(answer)
+        answer_words = answer_words[~np.isin(answer_words, list(STOPWORDS))]
+        new_words = answer_words[~np.isin(answer_words, words_in(task))]
+        if not results or answer_words.size < min_words or new_words.size == 0:
+            return None
+        result_words = np.concatenate([words_in(r) for r in results])
+        overlap = float(np.isin(new_words, result_words).mean())
+        return score * overlap if overlap >= min_overlap else None
+    verify.__name__ = 'lexical_overlap_verifier'
+    return verify
+
+
+DEFAULT_ANSWER_VERIFIERS: List[AnswerVerifier] = [
+    numeric_verifier(),
+    containment_verifier(),
+    lexical_overlap_verifier(),
+]
@@ -2,10 +2,10 @@ import asyncio
 import traceback
 import json
 
-from mlux_reactly import ReactlyAgent, LLM, ZeroTracer
-from mlux_reactly.tracer import TestTracer, make_json_serializable, format_tracer, format_tracer_with_nr, FormatConfig
+from mlux_reactly import ReactlyAgent, OllamaLLM, ZeroTracer
+from mlux_reactly.tracer import TestTracer, TraceStore, make_json_serializable, format_tracer, format_tracer_with_nr, FormatConfig
 from tools import calculator, text_count, make_rag_for_folder, wikipedia_search
-from eval import main_eval, args_to_eval_runs, EvalRun
+from eval import main_eval, args_to_eval_runs, args_to_runner_config, EvalRun
 
 record_file = open("reactly_query_record.jsonl", "+a")
 test_tracer_format = FormatConfig()
@@ -13,7 +13,7 @@ test_tracer = TestTracer(session='chat', record_file=record_file)
 eval_tracer = test_tracer #TestTracer(config=TraceConfig(session='chateval', record_file=record_file, live_format=FormatConfig(show={'query': True, 'query_answer': True}, show_other=False)))
 tracer = test_tracer
 
-llm = LLM("qwen2.5:7b-instruct-q8_0")
+llm = OllamaLLM("qwen2.5:7b-instruct-q8_0")
 agent = ReactlyAgent(tools=[calculator, text_count, make_rag_for_folder("./test-files/rag-docs-default"), wikipedia_search], tracer=tracer, llm=llm)
 
 # helper
@@ -62,6 +62,13 @@ while True:
                 print(format_tracer_with_nr(tracer, nr))
             elif cmds[1] == "json":
                 print(json.dumps(make_json_serializable(tracer.event), indent=2))
+            elif cmds[1] == "store":
+                if len(cmds) <= 2 or not isinstance(tracer, TestTracer):
+                    print('usage:   /trace store <sqlite file>   (with tracing on)')
+                    continue
+                store = TraceStore(cmds[2])
+                print(f"-- stored as session {store.import_tracer(tracer)}, query with: python -m mlux_reactly.tracer.trace_store {cmds[2]} --help")
+                store.close()
 
         if user_input.startswith('//1'):
             user_input = '/eval -agents reactly llama-react -tests hotpot/train:100:5'
@@ -75,7 +82,10 @@ while True:
                 continue
             try:
                 runs = args_to_eval_runs(argstr[1].split())
-                result = asyncio.run(main_eval(runs, eval_tracer))
+                runner = args_to_runner_config(argstr[1].split())
+                result = asyncio.run(main_eval(runs, eval_tracer, runner=runner))
+                if runner.checkpoint is not None:
+                    runner.checkpoint.close()
             except Exception as e:
                 print(f"\033[31m[eval crashed]\033[0m")
                 traceback.print_exception(e)
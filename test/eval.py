@@ -9,9 +9,10 @@ from pathlib import Path
 import hashlib
 
 from test_types import Agent, AgentContructor, TestFunc, as_list
-from mlux_reactly import ReactlyAgent, LLM, Tracer, ZeroTracer
+from mlux_reactly import ReactlyAgent, AgentConfig, LLM, OllamaLLM, RecordReplayLLM, Tracer, ZeroTracer
 from llama_index_agent import LlamaFunctionAgentWrapper, LlamaReActAgentWrapper
 from run_evaluation_qa_file import qa_file_test_fn
+from eval_runner import RunnerConfig, Checkpoint
 
 
 
@@ -31,9 +32,32 @@ argp.add_argument(
 argp.add_argument(
     "-llms", "-llm", "-l",
     nargs="+",
-    help="List of LLM identifiers",
+    help="List of LLM identifiers. 'record:<file>' records the responses of the default model to file, 'replay:<file>' replays them (with their recorded latency) without Ollama",
     default="qwen2.5:7b-instruct-q8_0"
 )
+argp.add_argument(
+    "-workers", "-w",
+    type=int,
+    default=1,
+    help="Number of examples run at once"
+)
+argp.add_argument(
+    "-pool",
+    choices=['asyncio', 'thread', 'process'],
+    default='asyncio',
+    help="How examples run at once: as asyncio tasks, in threads or in forked processes"
+)
+argp.add_argument(
+    "-checkpoint",
+    default=None,
+    help="Append-only file of finished examples (off by default). Examples in it are skipped (resumed) when running again with the same file, "
+         "even if the code or the dataset changed in between"
+)
+argp.add_argument(
+    "-fresh",
+    action="store_true",
+    help="Run all examples again, ignoring the checkpoint"
+)
 
 
 
@@ -53,17 +77,27 @@ available_tests: Dict[str, TestFunc] = {
 }
 available_agents: Dict[str, AgentContructor] = {
     'reactly': ReactlyAgent,
+    'reactly-fused': lambda **kwargs: ReactlyAgent(**kwargs, config=AgentConfig(tool_pipeline='fused')),
     'llama-react': LlamaReActAgentWrapper,
     'llama-func': LlamaFunctionAgentWrapper,
 }
 available_llms: Dict[str, LLM] = {
-    'qwen2.5:7b-instruct-q8_0': LLM('qwen2.5:7b-instruct-q8_0'),
+    'qwen2.5:7b-instruct-q8_0': OllamaLLM('qwen2.5:7b-instruct-q8_0'),
 }
 
 def assert_arg(name: str, arg: str, availables: Dict[str, Any]):
     if arg not in availables.keys():
         raise AssertionError(f"command line argument {name} '{arg}' not available")
 
+def get_llm(name: str) -> LLM:
+    """the available LLM of that name, or a `RecordReplayLLM` for 'record:<file>' and 'replay:<file>'"""
+    mode, _, path = name.partition(':')
+    if name not in available_llms and mode in ('record', 'replay') and path:
+        backend = available_llms['qwen2.5:7b-instruct-q8_0'] if mode == 'record' else None
+        available_llms[name] = RecordReplayLLM(path, backend, mode='record' if mode == 'record' else 'replay', latency='recorded')
+    assert_arg('llms', name, available_llms)
+    return available_llms[name]
+
 
 
 def args_to_eval_runs(args_as_strings: List[str]|None = None) -> List[EvalRun]:
@@ -74,7 +108,7 @@ def args_to_eval_runs(args_as_strings: List[str]|None = None) -> List[EvalRun]:
     for agent in as_list(args.agents):
         assert_arg('agents', agent, available_agents)
     for llm in as_list(args.llms):
-        assert_arg('llms', llm, available_llms)
+        get_llm(llm)
 
     runs: List[EvalRun] = []
 
@@ -92,6 +126,11 @@ def args_to_eval_runs(args_as_strings: List[str]|None = None) -> List[EvalRun]:
     return runs
 
 
+def args_to_runner_config(args_as_strings: List[str]|None = None) -> RunnerConfig:
+    args = argp.parse_args(args_as_strings)
+    return RunnerConfig(workers=args.workers, pool=args.pool, checkpoint=Checkpoint(args.checkpoint, fresh=args.fresh) if args.checkpoint else None)
+
+
 
 # run evaluations
 
@@ -99,7 +138,7 @@ csv_entries_run = ['version', 'formathash', 'eval_prog', 'eval_time_start',
                    'run_index', 'test', 'test_param', 'agent', 'llm']
 csv_entries_evaluation = ['nr_total', 'nr_finished', 'nr_failed', 
                'duration_total', 'duration_avg', 'duration_min', 'duration_max',
-               'em', 'f1', 'prec', 'recall']
+               'em', 'f1', 'prec', 'recall', 'llmcalls_total', 'llmcalls_avg']
 csv_entries = csv_entries_run + csv_entries_evaluation
 h_blake2b_csv_entries = hashlib.blake2b(digest_size=8)
 h_blake2b_csv_entries.update('\0'.join(csv_entries).encode())
@@ -133,36 +172,28 @@ def evaluation_to_csv(run: EvalRun, run_index: int, evaluation: Dict[str, float]
 
 
 
-async def main_eval(runs: List[EvalRun], tracer: Tracer = ZeroTracer(), talky: bool = True) -> None:
+async def main_eval(runs: List[EvalRun], tracer: Tracer = ZeroTracer(), talky: bool = True, runner: RunnerConfig = RunnerConfig()) -> None:
     eval_time_start = datetime.now()
-    results = []
+    results_file_path = Path('evaluation_results.csv')
     for i, run in enumerate(runs):
         if talky:
             print(f"running {i}: {run}")
 
         test_fn = available_tests[run.test]
         agent = available_agents[run.agent_name]
-        llm = available_llms[run.llm]
+        llm = get_llm(run.llm)
+        run_key = (run.test, run.test_param or '', run.agent_name, run.llm)
 
-        evaluation = await test_fn(run.test, run.test_param, agent, llm, tracer, talky=talky)
-        results.append({
-            'i': i,
-            'run': run,
-            'evaluation': evaluation,
-        })
+        evaluation = await test_fn(run.test, run.test_param, agent, llm, tracer, talky=talky, runner=runner, run_key=run_key)
 
         if talky:
             print(f"---> evaluation {i}: {evaluation}")
 
-    results_file_path = Path('evaluation_results.csv')
-    results_file_exists = results_file_path.exists()
-
-    csv_lines = [] if results_file_exists else [";".join(csv_entries)]
-    for result in results:
-        csv_lines.append(evaluation_to_csv(result['run'], result['i'], result['evaluation'], eval_time_start=eval_time_start))
-
-    with open(results_file_path, 'a') as csv_file:
-        csv_file.write('\n'.join(csv_lines) + '\n')
+        # written after each run, a crash only loses the unfinished examples of the current run (which are resumed from the checkpoint)
+        csv_lines = [] if results_file_path.exists() else [";".join(csv_entries)]
+        csv_lines.append(evaluation_to_csv(run, i, evaluation, eval_time_start=eval_time_start))
+        with open(results_file_path, 'a') as csv_file:
+            csv_file.write('\n'.join(csv_lines) + '\n')
     
 
 
@@ -174,5 +205,8 @@ if __name__ == '__main__':
         print(f"{i}: {run}")
     print()
 
-    asyncio.run(main_eval(runs))
+    runner = args_to_runner_config()
+    asyncio.run(main_eval(runs, runner=runner))
+    if runner.checkpoint is not None:
+        runner.checkpoint.close()
     print("Done")
\ No newline at end of file
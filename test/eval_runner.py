@@ -0,0 +1,196 @@
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Tuple
+from dataclasses import dataclass, asdict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import asyncio
+import inspect
+import json
+import math
+import os
+import time
+from mlux_reactly import LLM, Tracer, ZeroTracer
+from test_types import Agent, AgentContructor, ExampleCase
+
+
+QUERY_PROMPT = ("Answer the following question by *just* stating the questioned fact in a few words (For example, 'Where is the Eiffel Tower' would be best answered by 'Paris, France'. No explanation.)."
+                " Question: ")
+
+
+@dataclass
+class ExampleOutcome:
+    example_id: str
+    finished: bool
+    answer: str
+    duration: float
+    llmcalls: int|None = None
+    """number of LLM calls, None if the agent does not report them (does not use the tracer)"""
+
+
+RunKey = Tuple[str, str, str, str]
+"""(test, test param, agent, llm) of an evaluation run"""
+
+
+class Checkpoint:
+    """Append-only JSON lines file of the outcomes of finished examples, keyed by (test, test param, agent, llm, example id).
+    Examples already in the checkpoint are skipped when an evaluation is run again."""
+
+    def __init__(self, path: str, *, fresh: bool = False):
+        """fresh: ignore the outcomes already in the file (new outcomes are still appended)"""
+        self.path = path
+        self.outcomes: Dict[Tuple[str, ...], ExampleOutcome] = {}
+        if not fresh and os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError: # cut off by a crash while writing
+                        continue
+                    self.outcomes[tuple(record['key'])] = ExampleOutcome(**record['outcome'])
+        self._file = open(path, 'a')
+
+    def get(self, run_key: RunKey, example_id: str) -> ExampleOutcome|None:
+        return self.outcomes.get((*run_key, example_id))
+
+    def add(self, run_key: RunKey, outcome: ExampleOutcome) -> None:
+        self.outcomes[(*run_key, outcome.example_id)] = outcome
+        self._file.write(json.dumps({'key': [*run_key, outcome.example_id], 'outcome': asdict(outcome)}) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+@dataclass
+class RunnerConfig:
+    workers: int = 1
+    """number of examples run at once"""
+    pool: Literal['asyncio', 'thread', 'process'] = 'asyncio'
+    """'asyncio': tasks in the event loop of the evaluation (agents with async `aquery`/`query` run concurrently, others one after another),
+    'thread': a thread per worker, 'process': a forked process per worker (the tracer is not used in processes)"""
+    checkpoint: Checkpoint|None = None
+
+
+class Progress:
+    """prints the progress, throughput and estimated remaining time of an evaluation run"""
+
+    def __init__(self, total: int, resumed: int, *, talky: bool = True):
+        self.total = total
+        self.resumed = resumed
+        self.done = 0
+        self.start_time = time.perf_counter()
+        self.talky = talky
+
+    def update(self) -> None:
+        self.done += 1
+        if not self.talky:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        per_min = self.done / elapsed * 60 if elapsed > 0 else math.inf
+        remaining = self.total - self.resumed - self.done
+        eta = remaining / per_min * 60 if per_min > 0 else math.inf
+        eta_str = f"{int(eta // 60)}m{int(eta % 60):02d}s" if math.isfinite(eta) else "?"
+        print(f"[eval] {self.resumed + self.done}/{self.total} examples, {per_min:.1f} examples/min, ETA {eta_str}")
+
+
+class CountingTracer(Tracer):
+    """forwards all events to tracer and counts them per key"""
+    def __init__(self, tracer: Tracer, counts: Dict[str, int]|None = None):
+        self.tracer = tracer
+        self.counts: Dict[str, int] = counts if counts is not None else {}
+
+    def on(self, key: str, args: Dict[str, Any]) -> "CountingTracer":
+        self.counts[key] = self.counts.get(key, 0) + 1
+        return CountingTracer(self.tracer.on(key, args), self.counts)
+
+    def add_arg(self, arg_name: str, arg: Any):
+        self.tracer.add_arg(arg_name, arg)
+
+
+async def run_example_on_agent(example_case: ExampleCase, agent_constr: AgentContructor, tracer: Tracer, llm: LLM|None, *, prefer_async: bool = True) -> ExampleOutcome:
+    """prefer_async: use `aquery` if the agent has it, so examples in the same event loop run concurrently"""
+    # TODO: maybe retry, logging
+    example = example_case.example
+    counting_tracer = CountingTracer(tracer)
+    start_time = time.perf_counter()
+    try:
+        agent: Agent = agent_constr(tools=example_case.agent_config.tools, tracer=counting_tracer, llm=llm)
+        aquery: Callable[[str], Awaitable[str]]|None = getattr(agent, 'aquery', None) if prefer_async else None
+        result = aquery(QUERY_PROMPT + example.question) if aquery is not None else agent.query(QUERY_PROMPT + example.question)
+        answer: str = await result if inspect.isawaitable(result) else result
+        duration = time.perf_counter() - start_time
+    except Exception as e:
+        print(e)
+        return ExampleOutcome(example.id, False, "", math.nan)
+    llmcalls = counting_tracer.counts.get('llmcall', 0) if counting_tracer.counts.get('query', 0) > 0 else None
+    return ExampleOutcome(example.id, True, answer, duration, llmcalls)
+
+
+def _run_example_blocking(example_case: ExampleCase, agent_constr: AgentContructor, tracer: Tracer, llm: LLM|None) -> ExampleOutcome:
+    return asyncio.run(run_example_on_agent(example_case, agent_constr, tracer, llm, prefer_async=False))
+
+
+# state of a forked worker process, inherited from the parent (not pickled)
+_worker_state: Tuple[List[ExampleCase], AgentContructor, LLM|None]|None = None
+
+def _init_worker(example_cases: List[ExampleCase], agent_constr: AgentContructor, llm: LLM|None) -> None:
+    global _worker_state
+    _worker_state = (example_cases, agent_constr, llm)
+
+def _run_example_in_worker(index: int) -> ExampleOutcome:
+    assert _worker_state is not None
+    example_cases, agent_constr, llm = _worker_state
+    return _run_example_blocking(example_cases[index], agent_constr, ZeroTracer(), llm)
+
+
+async def run_examples(example_cases: List[ExampleCase], agent_constr: AgentContructor, tracer: Tracer, llm: LLM|None, *,
+                       runner: RunnerConfig = RunnerConfig(), run_key: RunKey|None = None, talky: bool = True) -> List[ExampleOutcome]:
+    """Runs the examples on up to `runner.workers` agents at once and returns their outcomes in the order of the examples.
+    With a checkpoint (and run_key), each outcome is appended to it once the example finished, and examples finished before are not run again."""
+    checkpoint = runner.checkpoint if run_key is not None else None
+    outcomes: List[ExampleOutcome|None] = [None] * len(example_cases)
+    pending: List[int] = []
+    for i, example_case in enumerate(example_cases):
+        done = checkpoint.get(run_key, example_case.example.id) if checkpoint is not None and run_key is not None else None
+        if done is not None and done.finished:
+            outcomes[i] = done
+        else:
+            pending.append(i)
+    progress = Progress(len(example_cases), len(example_cases) - len(pending), talky=talky)
+    if checkpoint is not None:
+        print(f"[eval] reusing {progress.resumed} of {progress.total} examples from the checkpoint {checkpoint.path}")
+
+    def finish(i: int, outcome: ExampleOutcome) -> None:
+        outcomes[i] = outcome
+        if checkpoint is not None and run_key is not None and outcome.finished:
+            checkpoint.add(run_key, outcome)
+        if talky:
+            example = example_cases[i].example
+            print(f"=> {example.id[:6]}: '{example.question}' good: '{example.answer}' A: '{outcome.answer}'")
+        progress.update()
+
+    if runner.pool == 'asyncio':
+        semaphore = asyncio.Semaphore(runner.workers)
+
+        async def run(i: int) -> None:
+            async with semaphore:
+                finish(i, await run_example_on_agent(example_cases[i], agent_constr, tracer, llm))
+        await asyncio.gather(*[run(i) for i in pending])
+        return [outcome for outcome in outcomes if outcome is not None]
+
+    loop = asyncio.get_running_loop()
+    executor: Executor
+    if runner.pool == 'thread':
+        executor = ThreadPoolExecutor(runner.workers, thread_name_prefix='eval-worker')
+        submit = lambda i: loop.run_in_executor(executor, _run_example_blocking, example_cases[i], agent_constr, tracer, llm)
+    else:
+        executor = ProcessPoolExecutor(runner.workers, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=_init_worker, initargs=(example_cases, agent_constr, llm))
+        submit = lambda i: loop.run_in_executor(executor, _run_example_in_worker, i)
+
+    async def run_in_executor(i: int) -> None:
+        finish(i, await submit(i))
+    try:
+        await asyncio.gather(*[run_in_executor(i) for i in pending])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return [outcome for outcome in outcomes if outcome is not None]
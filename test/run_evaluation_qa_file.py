@@ -7,6 +7,7 @@ import os
 from mlux_reactly import LLM, Tracer
 from test_types import Example, ExampleCase, AgentConfig, AgentContructor, at_or
 from test_support import run_hotpotlike_examples
+from eval_runner import RunnerConfig, RunKey
 from tools import calculator, text_count, wikipedia_search, make_rag_for_documents, Document
 
 
@@ -62,7 +63,8 @@ available_tests: Dict[str, TestInfo] = {
 }
 
 
-async def qa_file_test_fn(test_name: str, test_param: str|None, agent_constr: AgentContructor, llm: LLM, tracer: Tracer, talky: bool = True):
+async def qa_file_test_fn(test_name: str, test_param: str|None, agent_constr: AgentContructor, llm: LLM, tracer: Tracer, talky: bool = True, *,
+                          runner: RunnerConfig = RunnerConfig(), run_key: RunKey|None = None):
     test = available_tests[test_name]
     param_splits = (test_param or "").split(':')
     set_name = at_or(param_splits, 0, test.default_set)
@@ -79,5 +81,5 @@ async def qa_file_test_fn(test_name: str, test_param: str|None, agent_constr: Ag
         if start_pos < 0 or start_pos >= len(data) or end_pos <= start_pos or end_pos > len(data):
             raise ValueError(f"invalid test range: got {start_pos} .. {end_pos}, available 0 .. {len(data)}")
         datapoints = parse_fn(data[start_pos:end_pos])
-        evaluation = await run_hotpotlike_examples(datapoints, agent_constr, tracer, llm, talky=talky)
+        evaluation = await run_hotpotlike_examples(datapoints, agent_constr, tracer, llm, talky=talky, runner=runner, run_key=run_key)
         return evaluation
\ No newline at end of file
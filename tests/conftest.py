@@ -0,0 +1,27 @@
+from typing import Dict
+import pytest
+from mlux_reactly.framework import LLM_SCHEDULER
+
+
+def count_l(text: str) -> int:
+    """counts the letter l in text"""
+    return text.count('l')
+
+
+RESPONSES: Dict[str, str] = {
+    'split_question_into_tasks': '["Count the letter l in the text."]',
+    'enhance_task_description': '"Count the letter l in \'hello\'."',
+    'rate_tools_for_task': '{"count_l": 0.9}',
+    'make_tool_input': '{"text": "hello"}',
+    'try_answer_task': 'It occurs 2 times.',
+    'rate_task_answer': '{"satisfaction": 0.9}',
+}
+"""FakeLLM responses answering a question with count_l"""
+
+
+@pytest.fixture
+def scheduled_model(request):
+    """a model name of its own for the test, its LLM_SCHEDULER limits are removed afterwards"""
+    model = f"test-{request.node.name}"
+    yield model
+    LLM_SCHEDULER.set_limits(model, None)
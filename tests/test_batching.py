@@ -0,0 +1,85 @@
+import asyncio
+from typing import List
+from mlux_reactly import ReactlyAgent, FakeLLM, LLMRequest, LLMResponse
+from mlux_reactly.batching import BatchingLLM
+from conftest import count_l, RESPONSES
+
+
+class SlowLLM(FakeLLM):
+    """answers after a short delay, recording the maximal number of concurrent requests and the embedded texts"""
+
+    def __init__(self):
+        super().__init__({}, default='{}')
+        self.running = 0
+        self.max_running = 0
+        self.embedded: List[List[str]] = []
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        self.requests.append(request)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            return LLMResponse(request.prompt)
+        finally:
+            self.running -= 1
+
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.append(texts)
+        return await super().embed(texts)
+
+
+def test_identical_concurrent_requests_are_sent_once():
+    backend = SlowLLM()
+    llm = BatchingLLM(backend)
+
+    async def main():
+        request = LLMRequest('sys', 'same', stage='s')
+        return await asyncio.gather(*[llm.chat(request) for _ in range(3)], llm.chat(LLMRequest('sys', 'other', stage='s')))
+    responses = asyncio.run(main())
+    assert [response.content for response in responses] == ['same', 'same', 'same', 'other']
+    assert responses[0] is not responses[1]
+    assert len(backend.requests) == 2 and llm.coalesced == 2
+
+
+def test_retries_and_uncached_stages_are_not_coalesced():
+    backend = SlowLLM()
+    llm = BatchingLLM(backend)
+
+    async def main():
+        await asyncio.gather(*[llm.chat(LLMRequest('sys', 'q', stage='s', attempt=1)) for _ in range(2)])
+        await asyncio.gather(*[llm.chat(LLMRequest('sys', 'q', stage='s', cache=False)) for _ in range(2)])
+    asyncio.run(main())
+    assert len(backend.requests) == 4 and llm.coalesced == 0
+
+
+def test_requests_in_flight_are_limited():
+    backend = SlowLLM()
+    llm = BatchingLLM(backend, max_in_flight=2)
+
+    async def main():
+        await asyncio.gather(*[llm.chat(LLMRequest('sys', f'q{i}', stage='s')) for i in range(6)])
+    asyncio.run(main())
+    assert len(backend.requests) == 6 and backend.max_running == 2
+
+
+def test_concurrent_embeddings_are_batched():
+    backend = SlowLLM()
+    llm = BatchingLLM(backend)
+
+    async def main():
+        return await asyncio.gather(llm.embed(['a', 'b']), llm.embed(['b', 'c']), llm.embed(['a']))
+    vectors = asyncio.run(main())
+    assert backend.embedded == [['a', 'b', 'c']]
+    assert vectors[0][1] == vectors[1][0] and vectors[2][0] == vectors[0][0]
+    assert llm.stats() == {'coalesced': 0, 'embed_calls': 3, 'embed_batches': 1}
+
+
+def test_query_many_answers_in_question_order():
+    def respond(request: LLMRequest) -> str:
+        if request.stage == 'try_answer_task' and 'world' in request.prompt:
+            return "It occurs 3 times."
+        return RESPONSES.get(request.stage, '')
+    questions = ["How many l are in hello?", "How many l are in hello world?", "How many l are in hello?"]
+    answers = ReactlyAgent([count_l], llm=FakeLLM(respond)).query_many(questions, concurrency=3)
+    assert answers == ["It occurs 2 times.", "It occurs 3 times.", "It occurs 2 times."]
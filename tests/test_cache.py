@@ -0,0 +1,110 @@
+import asyncio
+from mlux_reactly import ReactlyAgent, AgentConfig, FakeLLM, CachedLLM, LLMCache, LLMRequest, ToolResultCache, cached_tool
+from mlux_reactly import cache as cache_module
+from conftest import RESPONSES
+
+
+def test_cached_llm_hit_and_miss():
+    backend = FakeLLM({'s': ['first', 'second']})
+    llm = CachedLLM(backend, LLMCache())
+
+    async def main():
+        miss = await llm.chat(LLMRequest('sys', 'q', stage='s'))
+        hit = await llm.chat(LLMRequest('sys', 'q', stage='s'))
+        other = await llm.chat(LLMRequest('sys', 'other question', stage='s'))
+        return miss, hit, other
+    miss, hit, other = asyncio.run(main())
+    assert (miss.content, miss.cached) == ('first', False)
+    assert (hit.content, hit.cached) == ('first', True)
+    assert (other.content, other.cached) == ('second', False)
+    assert len(backend.requests) == 2
+
+
+def test_cached_llm_retries_and_uncached_stages_query_the_backend():
+    backend = FakeLLM({'s': ['first', 'second', 'third']})
+    llm = CachedLLM(backend, LLMCache())
+
+    async def main():
+        await llm.chat(LLMRequest('sys', 'q', stage='s'))
+        retry = await llm.chat(LLMRequest('sys', 'q', stage='s', attempt=1))
+        after_retry = await llm.chat(LLMRequest('sys', 'q', stage='s'))
+        uncached = await llm.chat(LLMRequest('sys', 'q', stage='s', cache=False))
+        return retry, after_retry, uncached
+    retry, after_retry, uncached = asyncio.run(main())
+    assert retry.content == 'second'
+    assert (after_retry.content, after_retry.cached) == ('second', True) # the retry replaced the cached response
+    assert uncached.content == 'third' and uncached.cached is None
+
+
+def test_tool_result_cache_key_keeps_values():
+    cache = ToolResultCache()
+    assert cache.key('text_count', {'a': 1, 'b': [2, 3]}) == cache.key('text_count', {'b': (2, 3), 'a': 1})
+    assert cache.key('text_count', {'text': ' hello '}) != cache.key('text_count', {'text': 'hello'})
+    assert cache.key('text_count', {' text': 'hello'}) != cache.key('text_count', {'text': 'hello'})
+    assert cache.key('text_count', {'n': 1.0}) != cache.key('text_count', {'n': 1})
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+def test_tool_result_cache_evicts_least_recently_used():
+    cache = ToolResultCache(max_entries=2)
+    keys = [cache.key('t', {'n': n}) for n in range(3)]
+    cache.put(keys[0], 'zero')
+    cache.put(keys[1], 'one')
+    assert cache.get(keys[0]) == (True, 'zero')
+    cache.put(keys[2], 'two')
+    assert cache.get(keys[1]) == (False, None)
+    assert cache.get(keys[0]) == (True, 'zero') and cache.get(keys[2]) == (True, 'two')
+    assert cache.stats() == {'hits': 3, 'misses': 1, 'entries': 2, 'bytes': len('"zero"') + len('"two"')}
+
+
+def test_tool_result_cache_limits_bytes():
+    cache = ToolResultCache(max_bytes=20)
+    cache.put('a', 'x' * 8) # 10 bytes as JSON
+    cache.put('b', 'y' * 8)
+    cache.put('c', 'z' * 8)
+    assert cache.get('a') == (False, None)
+    assert cache.memory.nr_bytes == 20
+
+
+def test_tool_result_cache_ttl(monkeypatch, tmp_path):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'time', clock.time)
+    cache = ToolResultCache(ttl=60, pure=False, path=tmp_path / "tools.sqlite")
+    cache.put('k', {'result': 1})
+    clock.now += 30
+    assert cache.get('k') == (True, {'result': 1})
+    assert ToolResultCache(ttl=60, pure=False, path=tmp_path / "tools.sqlite").get('k') == (True, {'result': 1})
+    clock.now += 31
+    assert cache.get('k') == (False, None)
+
+
+def test_impure_tools_are_cached_only_with_ttl():
+    assert ToolResultCache(pure=True).enabled
+    assert not ToolResultCache(pure=False).enabled
+    assert ToolResultCache(pure=False, ttl=10).enabled
+
+
+def test_cached_tool_runs_once_and_does_not_cache_failures():
+    calls = []
+
+    @cached_tool()
+    def count_l(text: str) -> int:
+        """counts the letter l in text"""
+        calls.append(text)
+        if len(calls) == 1:
+            raise ConnectionError("flaky")
+        return text.count('l')
+
+    agent = ReactlyAgent([count_l], llm=FakeLLM(RESPONSES), config=AgentConfig(max_nr_tries_per_task=1))
+    agent.query("How many l are in hello?")
+    agent.query("How many l are in hello?")
+    agent.query("How many l are in hello?")
+    assert calls == ['hello', 'hello']
+    assert count_l.tool_cache.stats()['hits'] == 1
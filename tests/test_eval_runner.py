@@ -0,0 +1,65 @@
+import asyncio
+from mlux_reactly import ZeroTracer
+from eval_runner import Checkpoint, RunnerConfig, run_examples
+from test_types import AgentConfig, Example, ExampleCase
+
+
+class CountingAgent:
+    """answers every question with the text after 'Question: ', fails for questions in `failing`"""
+    queries: list = []
+    failing: set = set()
+
+    def __init__(self, tools, tracer, llm):
+        pass
+
+    def query(self, user_question: str) -> str:
+        question = user_question.split("Question: ")[-1]
+        CountingAgent.queries.append(question)
+        if question in CountingAgent.failing:
+            raise RuntimeError("failed")
+        return question
+
+
+CASES = [ExampleCase(Example(f"id{i}", f"q{i}", f"q{i}"), AgentConfig([])) for i in range(5)]
+RUN_KEY = ('test', '', 'counting', 'none')
+
+
+def run(checkpoint: Checkpoint, pool: str = 'thread'):
+    runner = RunnerConfig(workers=2, pool=pool, checkpoint=checkpoint) # type: ignore[arg-type]
+    try:
+        return asyncio.run(run_examples(CASES, CountingAgent, ZeroTracer(), None, runner=runner, run_key=RUN_KEY, talky=False))
+    finally:
+        checkpoint.close()
+
+
+def test_checkpoint_resumes_unfinished_examples(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    CountingAgent.queries, CountingAgent.failing = [], {'q3'}
+    first = run(Checkpoint(path))
+    assert [outcome.finished for outcome in first] == [True, True, True, False, True]
+
+    CountingAgent.queries, CountingAgent.failing = [], set()
+    second = run(Checkpoint(path))
+    assert CountingAgent.queries == ['q3']
+    assert [outcome.example_id for outcome in second] == [case.example.id for case in CASES]
+    assert all(outcome.finished and outcome.answer == case.example.question for outcome, case in zip(second, CASES))
+
+
+def test_fresh_checkpoint_runs_all_examples(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    CountingAgent.queries, CountingAgent.failing = [], set()
+    run(Checkpoint(path), pool='asyncio')
+    CountingAgent.queries = []
+    run(Checkpoint(path, fresh=True), pool='asyncio')
+    assert sorted(CountingAgent.queries) == [case.example.question for case in CASES]
+
+
+def test_checkpoint_reports_reused_examples(tmp_path, capsys):
+    path = str(tmp_path / "checkpoint.jsonl")
+    CountingAgent.queries, CountingAgent.failing = [], {'q1'}
+    run(Checkpoint(path))
+    capsys.readouterr()
+    CountingAgent.failing = set()
+    run(Checkpoint(path))
+    assert f"reusing 4 of 5 examples from the checkpoint {path}" in capsys.readouterr().out
+
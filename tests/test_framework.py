@@ -0,0 +1,72 @@
+import asyncio
+import json
+import random
+import pytest
+from mlux_reactly import FakeLLM, ZeroTracer
+from mlux_reactly.framework import TokenEstimator, extract_json, make_format, make_stage, run_stage, run_sync
+
+
+def test_run_sync_in_the_background_loop_raises():
+    async def inner() -> int:
+        return 41
+
+    async def outer() -> int:
+        return run_sync(inner()) + 1 # e.g. an inline tool calling the sync query of another agent
+    with pytest.raises(RuntimeError, match="aquery"):
+        run_sync(outer())
+
+
+def test_run_sync_from_a_tool_thread():
+    async def inner() -> int:
+        return 41
+
+    async def outer() -> int:
+        return await asyncio.to_thread(lambda: run_sync(inner()) + 1) # a sync tool in the thread pool
+    assert run_sync(outer()) == 42
+
+
+def test_token_estimator_ignores_prompt_cached_counts():
+    estimator = TokenEstimator()
+    rng = random.Random(0)
+    prefixes = [f"system prompt of stage {i}" for i in range(10)]
+    for call in range(200):
+        nr_chars = rng.randint(500, 4000)
+        reused = 0.0 if call < len(prefixes) else rng.uniform(0.0, 0.3) # the prompt cache only helps once a prefix was seen
+        estimator.observe('m', nr_chars, round(nr_chars / 4.0 * (1 - reused)), prefix=prefixes[call % len(prefixes)])
+    assert abs(estimator.chars_per_token('m') - 4.0) < 0.05
+
+
+def test_token_estimator_ignores_implausible_ratios():
+    estimator = TokenEstimator()
+    estimator.observe('m', 10000, 10)
+    assert estimator.chars_per_token('m') == TokenEstimator.DEFAULT_CHARS_PER_TOKEN
+
+
+def test_schema_from_format_template():
+    format = make_format({'tool': 'name', 'score': 0.5, 'tags': ['tag'], 'ok': True}, label='rating')
+    assert format.schema == {
+        'type': 'object',
+        'properties': {'tool': {'type': 'string'}, 'score': {'type': 'number'}, 'tags': {'type': 'array', 'items': {'type': 'string'}}, 'ok': {'type': 'boolean'}},
+        'required': ['tool', 'score', 'tags', 'ok'],
+    }
+    assert format.as_list('ratings').schema == {'type': 'array', 'items': format.schema}
+    assert make_format("text", is_plain_text=True).schema is None
+
+
+def test_stage_requests_carry_the_output_schema():
+    output = make_format({'n': 1}, label='Count')
+    stage = make_stage('count', "Counts.", inputs=[('Text', make_format("text"))], output=output, tries=2)
+    assert make_stage('count', "Counts.", inputs=[('Text', make_format("text"))], output=output, constrained=False).output_schema is None
+
+    llm = FakeLLM({'count': 'Sure, here it is:\n```json\n{"n": 3}\n```'})
+    assert asyncio.run(run_stage(stage, {'Text': "abc"}, llm, ZeroTracer())) == {'n': 3}
+    assert [request.format for request in llm.requests] == [output.schema] # parsed by the fallback, no retry
+
+
+def test_extract_json_fallbacks():
+    assert extract_json('{"a": 1}') == {'a': 1}
+    assert extract_json('```json\n[1, 2]\n```') == [1, 2]
+    assert extract_json('The answer is {"a": {"b": [1]}} as requested.') == {'a': {'b': [1]}}
+    assert extract_json('not {json} but [1]') == [1]
+    with pytest.raises(json.JSONDecodeError):
+        extract_json('no json here')
@@ -0,0 +1,43 @@
+import asyncio
+from mlux_reactly import FakeLLM, ZeroTracer
+from mlux_reactly.history import ChatHistory
+from mlux_reactly.types import ChatQA
+from mlux_reactly import tracer as tracing # TestTracer itself would be collected by pytest
+
+
+def history_with(nr_turns: int) -> ChatHistory:
+    history = ChatHistory(keep_last=2)
+    for i in range(nr_turns):
+        history.append(ChatQA(f"question {i}", f"answer {i}"))
+    return history
+
+
+def test_compact_folds_old_turns_into_the_summary():
+    history = history_with(4)
+    asyncio.run(history.compact(FakeLLM({'summarize_history': '"asked question 0 and 1"'}), ZeroTracer()))
+    assert history.summary == "asked question 0 and 1"
+    assert [qa.question for qa in history] == ["question 2", "question 3"]
+
+
+def test_compact_keeps_turns_without_summary():
+    history = history_with(4)
+    asyncio.run(history.compact(FakeLLM({'summarize_history': ''}), ZeroTracer()))
+    assert len(history) == 4
+
+    asyncio.run(history.compact(FakeLLM({'summarize_history': '"asked question 0 and 1"'}), ZeroTracer()))
+    assert len(history) == 2
+
+
+def test_compact_survives_failing_embeddings():
+    async def failing_embed(texts):
+        raise ConnectionError("embedding model not available")
+    history = ChatHistory(keep_last=2, retrieve_top_k=1, embed=failing_embed)
+    for i in range(4):
+        history.append(ChatQA(f"question {i}", f"answer {i}"))
+    tracer = tracing.TestTracer()
+    asyncio.run(history.compact(FakeLLM({'summarize_history': '"asked question 0 and 1"'}), tracer))
+    assert history.summary == "asked question 0 and 1"
+    assert [qa.question for qa in history] == ["question 2", "question 3"]
+    assert len(history._archive) == 0
+    failed = [event for event in tracer.events_by_nr.values() if event.key == 'failed']
+    assert failed and failed[0].args['reason_code'] == 'embed'
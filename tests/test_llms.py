@@ -0,0 +1,129 @@
+import asyncio
+import time
+import pytest
+from mlux_reactly import ReactlyAgent, FakeLLM, OllamaLLM, RecordReplayLLM, RoutedLLM, StageRoute, LLMRequest, LLMResponse
+from mlux_reactly.llms import decisive_scores
+from mlux_reactly.stages import STAGES
+from conftest import count_l, RESPONSES
+
+
+def test_fake_llm_answers_each_stage():
+    llm = FakeLLM(RESPONSES)
+    answer = ReactlyAgent([count_l], llm=llm).query("How many l are in hello?")
+    assert answer == "It occurs 2 times."
+    stages = [request.stage for request in llm.requests]
+    assert stages[0] == 'split_question_into_tasks' and stages[-1] == 'try_answer_task'
+
+
+def test_fake_llm_list_responses_repeat_the_last():
+    llm = FakeLLM({'s': ['one', 'two']}, default='other')
+
+    async def main():
+        return [(await llm.chat(LLMRequest('sys', 'q', stage=stage))).content for stage in ['s', 's', 's', 'unknown']]
+    contents = asyncio.run(main())
+    assert contents == ['one', 'two', 'two', 'other']
+
+
+def test_record_replay_round_trip(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    backend = FakeLLM(RESPONSES)
+    recorder = RecordReplayLLM(path, backend, mode='record')
+    recorded_answer = ReactlyAgent([count_l], llm=recorder).query("How many l are in hello?")
+    recorder.close()
+
+    replayer = RecordReplayLLM(path)
+    replayed_answer = ReactlyAgent([count_l], llm=replayer).query("How many l are in hello?")
+    assert replayed_answer == recorded_answer
+    assert replayer.replayed == len(backend.requests)
+    assert replayer.misses == 0
+    assert replayer.model == backend.model
+
+
+def test_replay_repeats_in_order_and_adds_latency(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    request = LLMRequest('sys', 'q', stage='s')
+
+    async def record():
+        recorder = RecordReplayLLM(path, FakeLLM({'s': ['one', 'two']}), mode='record')
+        await recorder.chat(request)
+        await recorder.chat(request)
+        recorder.close()
+    asyncio.run(record())
+
+    async def replay():
+        replayer = RecordReplayLLM(path, latency=0.05)
+        return [(await replayer.chat(request)).content for _ in range(3)]
+    start = time.perf_counter()
+    assert asyncio.run(replay()) == ['one', 'two', 'two']
+    assert time.perf_counter() - start >= 0.15
+
+
+def test_replay_miss(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    with pytest.raises(KeyError):
+        asyncio.run(RecordReplayLLM(path).chat(LLMRequest('sys', 'unknown')))
+    fallback = RecordReplayLLM(path, FakeLLM({}, default='fallback'))
+    assert asyncio.run(fallback.chat(LLMRequest('sys', 'unknown'))).content == 'fallback'
+    assert fallback.misses == 1
+
+
+def test_pinned_ollama_session_options_win():
+    llm = OllamaLLM('m', pinned=True, options={'num_ctx': 8192}, stage_options={'s': {'num_ctx': 2048, 'temperature': 0.1}})
+    args = llm._chat_args(LLMRequest('sys', 'q', stage='s', options={'num_ctx': 4096, 'num_predict': 10}))
+    assert args['options'] == {'num_ctx': 8192, 'temperature': 0.1, 'num_predict': 10}
+    assert args['keep_alive'] == -1
+    unpinned = OllamaLLM('m', options={'num_ctx': 8192})
+    assert unpinned._chat_args(LLMRequest('sys', 'q', stage='s', options={'num_ctx': 4096}))['options'] == {'num_ctx': 4096}
+
+
+def test_warm_up_prefills_every_stage_prompt_once():
+    llm = FakeLLM({})
+    ReactlyAgent([count_l], llm=llm).warm_up()
+    assert [request.stage for request in llm.requests] == [stage.name for stage in STAGES]
+    assert [request.sys_prompt for request in llm.requests] == [stage.static_prompt for stage in STAGES]
+    assert all(request.prompt == '' and not request.cache and request.options == {'num_predict': 1} for request in llm.requests)
+
+
+def test_stage_prompts_are_stable_and_start_with_the_stable_inputs():
+    llm = FakeLLM(RESPONSES)
+    agent = ReactlyAgent([count_l], llm=llm)
+    agent.query("How many l are in hello?")
+    agent.query("How many l are in hello world?")
+    static_prompts = {stage.name: stage.static_prompt for stage in STAGES}
+    assert all(request.sys_prompt == static_prompts[request.stage] for request in llm.requests)
+
+    splits = [request.prompt for request in llm.requests if request.stage == 'split_question_into_tasks']
+    assert len(splits) == 2 and splits[0] != splits[1]
+    tools_section = 'Tools: {"count_l": "counts the letter l in text"}\n'
+    assert all(prompt.startswith(tools_section) for prompt in splits) # the tool list before the question
+
+
+def routed_chat(routed: RoutedLLM, stage: str, *, attempt: int = 0) -> LLMResponse:
+    return asyncio.run(routed.chat(LLMRequest('sys', 'q', stage=stage, attempt=attempt, format={'type': 'object'})))
+
+
+def test_routed_llm_sends_stages_to_their_backend():
+    small, large = FakeLLM({'rate_task_answer': '{"satisfaction": 0.9}'}, model='small'), FakeLLM({}, default='{}', model='large')
+    routed = RoutedLLM(large, {'rate_task_answer': StageRoute(llm=small, options={'num_predict': 16})})
+    assert routed_chat(routed, 'rate_task_answer').model == 'small'
+    assert routed_chat(routed, 'try_answer_task').content == '{}'
+    assert [request.stage for request in small.requests] == ['rate_task_answer']
+    assert small.requests[0].options == {'num_predict': 16}
+    assert [request.stage for request in large.requests] == ['try_answer_task']
+
+
+def test_routed_llm_escalates_invalid_and_undecided_responses():
+    small = FakeLLM({'rate_task_answer': ['no json', '{"satisfaction": 0.55}', '{"satisfaction": 0.95}']}, model='small')
+    large = FakeLLM({'rate_task_answer': '{"satisfaction": 0.2}'}, model='large')
+    routed = RoutedLLM(large, {'rate_task_answer': StageRoute(llm=small, escalate_to=large, accept=decisive_scores())})
+    responses = [routed_chat(routed, 'rate_task_answer') for _ in range(3)]
+    assert [(response.content, response.model) for response in responses] == [
+        ('{"satisfaction": 0.2}', 'large'), ('{"satisfaction": 0.2}', 'large'), ('{"satisfaction": 0.95}', 'small')]
+    assert routed.escalations == 2
+
+
+def test_routed_llm_sends_retries_to_the_escalation_backend():
+    small, large = FakeLLM({}, default='{}', model='small'), FakeLLM({}, default='{}', model='large')
+    routed = RoutedLLM(large, {'rate_tools_for_task': StageRoute(llm=small, escalate_to=large)})
+    assert routed_chat(routed, 'rate_tools_for_task', attempt=1).model == 'large'
+    assert small.requests == [] and routed.escalations == 1
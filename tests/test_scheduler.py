@@ -0,0 +1,110 @@
+import asyncio
+import time
+import pytest
+from mlux_reactly import FakeLLM, CachedLLM, RoutedLLM, StageRoute, LLMRequest, LLMResponse, ZeroTracer
+from mlux_reactly.framework import LLM_SCHEDULER, LLMSchedulerRejected, SchedulerLimits, call_llm
+
+
+class SlowLLM(FakeLLM):
+    """FakeLLM taking `delay` seconds per request in its scheduler slot, tracking the peak of concurrent requests"""
+    def __init__(self, *args, delay: float = 0.02, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delay = delay
+        self.running = 0
+        self.peak = 0
+
+    async def chat(self, request: LLMRequest) -> LLMResponse:
+        async with LLM_SCHEDULER.slot(self.model):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            await asyncio.sleep(self.delay)
+            self.running -= 1
+            return LLMResponse(self._respond(request))
+
+
+def test_max_concurrency(scheduled_model):
+    LLM_SCHEDULER.set_limits(scheduled_model, SchedulerLimits(max_concurrency=2))
+    llm = SlowLLM({'s': 'x'}, model=scheduled_model)
+
+    async def main():
+        await asyncio.gather(*[call_llm(LLMRequest('', 'q', stage='s'), llm, tracer=ZeroTracer()) for _ in range(6)])
+    asyncio.run(main())
+    assert llm.peak == 2
+
+
+def test_rate_limit(scheduled_model):
+    LLM_SCHEDULER.set_limits(scheduled_model, SchedulerLimits(requests_per_second=20, burst=1))
+    llm = FakeLLM({'s': 'x'}, model=scheduled_model)
+
+    async def main():
+        await asyncio.gather(*[call_llm(LLMRequest('', f"q{i}", stage='s'), llm, tracer=ZeroTracer()) for i in range(5)])
+    start = time.perf_counter()
+    asyncio.run(main())
+    assert time.perf_counter() - start >= 0.18 # 4 refills at 20/s
+
+
+def test_max_queue_rejects(scheduled_model):
+    LLM_SCHEDULER.set_limits(scheduled_model, SchedulerLimits(max_concurrency=1, max_queue=1))
+    llm = SlowLLM({'s': 'x'}, model=scheduled_model, delay=0.05)
+
+    async def main():
+        return await asyncio.gather(*[call_llm(LLMRequest('', 'q', stage='s'), llm, tracer=ZeroTracer()) for _ in range(3)], return_exceptions=True)
+    results = asyncio.run(main())
+    assert sum(isinstance(r, LLMSchedulerRejected) for r in results) == 1
+    assert LLM_SCHEDULER.stats()[scheduled_model]['rejected'] == 1
+
+
+def test_max_wait_rejects(scheduled_model):
+    LLM_SCHEDULER.set_limits(scheduled_model, SchedulerLimits(max_concurrency=1, max_wait=0.01))
+    llm = SlowLLM({'s': 'x'}, model=scheduled_model, delay=0.1)
+
+    async def main():
+        return await asyncio.gather(*[call_llm(LLMRequest('', 'q', stage='s'), llm, tracer=ZeroTracer()) for _ in range(2)], return_exceptions=True)
+    results = asyncio.run(main())
+    assert [isinstance(r, LLMSchedulerRejected) for r in results] == [False, True]
+    assert LLM_SCHEDULER.stats()[scheduled_model]['queued'] == 0
+
+
+def test_refill_survives_ended_event_loop(scheduled_model):
+    LLM_SCHEDULER.set_limits(scheduled_model, SchedulerLimits(requests_per_second=10, burst=1))
+
+    async def request():
+        async with LLM_SCHEDULER.slot(scheduled_model):
+            pass
+
+    async def abandon():
+        await request()
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(request(), 0.01) # waits for the refill, gives up before
+    asyncio.run(abandon())
+
+    start = time.perf_counter()
+    asyncio.run(asyncio.wait_for(request(), 2.0)) # another event loop
+    assert time.perf_counter() - start < 1.0
+
+
+def test_cache_hits_take_no_slot(scheduled_model):
+    LLM_SCHEDULER.set_limits(scheduled_model, SchedulerLimits(requests_per_second=2, burst=1))
+    llm = CachedLLM(FakeLLM({'s': 'x'}, model=scheduled_model))
+
+    async def main():
+        for _ in range(5):
+            await call_llm(LLMRequest('', 'q', stage='s'), llm, tracer=ZeroTracer())
+    start = time.perf_counter()
+    asyncio.run(main())
+    assert time.perf_counter() - start < 0.3
+    assert LLM_SCHEDULER.stats()[scheduled_model]['granted'] == 1
+
+
+def test_routed_requests_use_the_limits_of_their_model(scheduled_model):
+    small_model = scheduled_model + '-small'
+    LLM_SCHEDULER.set_limits(scheduled_model, SchedulerLimits(max_concurrency=1))
+    LLM_SCHEDULER.set_limits(small_model, SchedulerLimits(max_concurrency=1))
+    try:
+        llm = RoutedLLM(FakeLLM({}, model=scheduled_model), {'rate': StageRoute(FakeLLM({'rate': '1'}, model=small_model))})
+        asyncio.run(call_llm(LLMRequest('', 'q', stage='rate'), llm, tracer=ZeroTracer()))
+        stats = LLM_SCHEDULER.stats()
+        assert stats[small_model]['granted'] == 1
+        assert stats[scheduled_model]['granted'] == 0
+    finally:
+        LLM_SCHEDULER.set_limits(small_model, None)
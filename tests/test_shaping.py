@@ -0,0 +1,31 @@
+from mlux_reactly.framework import TOKEN_ESTIMATOR, estimate_tokens
+from mlux_reactly.shaping import select_passages, PASSAGE_SEPARATOR
+
+
+TEXT = "\n".join([
+    "The oak is a tree of the beech family.",
+    "Oak wood costs 10 euros per cubic meter.",
+    "Pine trees are evergreen conifers.",
+    "Beech wood costs 12 euros per cubic meter.",
+])
+
+
+def test_select_passages_keeps_the_most_relevant_within_budget():
+    budget = estimate_tokens("Oak wood costs 10 euros per cubic meter.") + estimate_tokens(PASSAGE_SEPARATOR)
+    assert select_passages("what does oak wood cost", TEXT, budget) == "Oak wood costs 10 euros per cubic meter."
+
+
+def test_select_passages_keeps_original_order():
+    selected = select_passages("oak beech wood costs", TEXT, 1000)
+    assert selected.split(PASSAGE_SEPARATOR) == [line for line in TEXT.split("\n")]
+
+
+def test_select_passages_cuts_with_the_calibrated_ratio():
+    model = 'test-shaping'
+    TOKEN_ESTIMATOR._chars_per_token[model] = 2.0
+    try:
+        cut = select_passages("oak", "Oak " * 100, 10, model=model)
+        assert len(cut) == 20
+        assert estimate_tokens(cut, model) <= 10
+    finally:
+        del TOKEN_ESTIMATOR._chars_per_token[model]
@@ -0,0 +1,43 @@
+import asyncio
+from mlux_reactly import ReactlyAgent, FakeLLM, AgentConfig, ZeroTracer
+from mlux_reactly.agent import tool_from_function
+from mlux_reactly.stages import plan_tool_calls
+from mlux_reactly.types import Task
+from conftest import count_l, RESPONSES
+
+
+def count_e(text: str) -> int:
+    """counts the letter e in text"""
+    return text.count('e')
+
+
+TOOLS = [tool_from_function(count_l), tool_from_function(count_e)]
+
+
+def plan(llm: FakeLLM):
+    return asyncio.run(plan_tool_calls(Task("Count l and e in 'hello'."), TOOLS, llm, ZeroTracer()))
+
+
+def test_plan_tool_calls_parses_tools_and_inputs():
+    llm = FakeLLM({'plan_tool_calls': '```json\n[{"tool": "count_e", "input": {"text": "hello"}}, {"tool": "count_l", "input": {"text": "hello"}}]\n```'})
+    calls = plan(llm)
+    assert [(call.tool.name, call.input) for call in calls] == [('count_e', {'text': 'hello'}), ('count_l', {'text': 'hello'})]
+    assert plan(FakeLLM({'plan_tool_calls': '[]'})) == []
+
+
+def test_plan_tool_calls_retries_unknown_tools():
+    llm = FakeLLM({'plan_tool_calls': ['[{"tool": "count_x", "input": {}}]', '[{"tool": "count_l"}]']})
+    calls = plan(llm)
+    assert [(call.tool.name, call.input) for call in calls] == [('count_l', {})]
+    assert [request.attempt for request in llm.requests] == [0, 1]
+
+
+def test_fused_pipeline_plans_with_one_call():
+    llm = FakeLLM(RESPONSES | {'plan_tool_calls': '[{"tool": "count_l", "input": {"text": "hello"}}]'})
+    answer = ReactlyAgent([count_l], llm=llm, config=AgentConfig(tool_pipeline='fused')).query("How many l are in hello?")
+    assert answer == "It occurs 2 times."
+    stages = [request.stage for request in llm.requests]
+    assert stages.count('plan_tool_calls') == 1
+    assert 'rate_tools_for_task' not in stages and 'make_tool_input' not in stages
+    answer_prompt = next(request.prompt for request in llm.requests if request.stage == 'try_answer_task')
+    assert '"result": 2' in answer_prompt
@@ -0,0 +1,61 @@
+import asyncio
+from typing import AsyncIterator
+from mlux_reactly import ReactlyAgent, FakeLLM, LLMRequest
+from conftest import count_l, RESPONSES
+
+
+class FlakyStreamLLM(FakeLLM):
+    """streams the answer word by word, the first stream of the answer breaks off after a word"""
+
+    def __init__(self):
+        super().__init__(RESPONSES)
+        self.answer_streams = 0
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        content = (await self.chat(request)).content
+        if request.stage == 'try_answer_task':
+            self.answer_streams += 1
+            for nr, word in enumerate(content.split(' ')):
+                if self.answer_streams == 1 and nr == 1:
+                    raise ConnectionError("stream broke off")
+                yield word if nr == 0 else ' ' + word
+        else:
+            yield content
+
+
+def test_stream_announces_a_retry_of_the_answer():
+    events = list(ReactlyAgent([count_l], llm=FlakyStreamLLM()).query_stream("How many l are in hello?"))
+    kinds = [event.kind for event in events if event.kind in ['token', 'retry', 'answer']]
+    assert kinds == ['token', 'retry', 'token', 'token', 'token', 'token', 'answer']
+    after_retry = events[[event.kind for event in events].index('retry') + 1:]
+    assert ''.join(event.data for event in after_retry if event.kind == 'token') == "It occurs 2 times."
+    assert events[-1].data == "It occurs 2 times."
+
+
+class WordStreamLLM(FakeLLM):
+    """streams every response word by word"""
+
+    async def chat_stream(self, request: LLMRequest) -> AsyncIterator[str]:
+        content = (await self.chat(request)).content
+        for nr, word in enumerate(content.split(' ')):
+            await asyncio.sleep(0)
+            yield word if nr == 0 else ' ' + word
+
+
+def test_stream_yields_progress_then_the_answer_tokens_in_order():
+    events = list(ReactlyAgent([count_l], llm=WordStreamLLM(RESPONSES)).query_stream("How many l are in hello?"))
+    kinds = [event.kind for event in events]
+    assert kinds.index('task') < kinds.index('toolrun') < kinds.index('token')
+    assert kinds[-1] == 'answer' and 'token' not in kinds[:kinds.index('toolrun')]
+    assert [event.data for event in events if event.kind == 'token'] == ["It", " occurs", " 2", " times."]
+    assert events[-1].data == "It occurs 2 times."
+
+
+def test_async_stream_adds_the_answer_to_the_history():
+    agent = ReactlyAgent([count_l], llm=WordStreamLLM(RESPONSES))
+
+    async def main():
+        return [event async for event in agent.aquery_stream("How many l are in hello?")]
+    events = asyncio.run(main())
+    assert ''.join(event.data for event in events if event.kind == 'token') == events[-1].data
+    assert [qa.response for qa in agent.history] == ["It occurs 2 times."]
@@ -0,0 +1,33 @@
+import json
+import re
+from mlux_reactly import ReactlyAgent, FakeLLM, AgentConfig, LLMRequest
+from conftest import count_l, RESPONSES
+
+
+def task_of(request: LLMRequest) -> str:
+    match = re.search(r'Task: "(.*)"', request.prompt)
+    assert match is not None
+    return match.group(1)
+
+
+def test_tasks_run_after_their_dependencies():
+    graph = [{"task": "country"}, {"task": "oak", "depends_on": [0]}, {"task": "pine", "depends_on": []}, {"task": "diff", "depends_on": [1, 2]}]
+
+    def respond(request: LLMRequest) -> str:
+        if request.stage == 'split_question_into_task_graph':
+            return json.dumps(graph)
+        if request.stage == 'enhance_task_description':
+            return json.dumps(task_of(request))
+        if request.stage == 'try_answer_task':
+            return f"done {task_of(request)}"
+        return RESPONSES.get(request.stage, '')
+    llm = FakeLLM(respond)
+    ReactlyAgent([count_l], llm=llm, config=AgentConfig(max_parallel_tasks=4)).query("q")
+
+    enhance_prompts = {task_of(r): r.prompt for r in llm.requests if r.stage == 'enhance_task_description'}
+    order = list(enhance_prompts)
+    assert order.index('country') < order.index('oak')
+    assert order.index('oak') < order.index('diff') and order.index('pine') < order.index('diff')
+    assert 'done country' in enhance_prompts['oak']
+    assert 'done country' not in enhance_prompts['pine']
+    assert all(f"done {task}" in enhance_prompts['diff'] for task in ['country', 'oak', 'pine'])
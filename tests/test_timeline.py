@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+from mlux_reactly import ReactlyAgent, FakeLLM
+from mlux_reactly import tracer as tracing # TestTracer itself would be collected by pytest
+from mlux_reactly.tracer import Event, chrome_trace, collapsed_stacks, critical_path, close_events
+from conftest import count_l, RESPONSES
+
+
+T0 = datetime(2026, 1, 1)
+
+def at(seconds: float) -> datetime:
+    return T0 + timedelta(seconds=seconds)
+
+def event(key: str, start: float, end: float|None, sub=(), **args) -> Event:
+    return Event(key, args, list(sub), at(start), 0, endtime=at(end) if end is not None else None)
+
+
+def query_with_parallel_tasks() -> Event:
+    """task a (0-6s, with a stage and its LLM call at 1-3s) and task b (2-8s, failed) run in parallel"""
+    llmcall = event('llmcall', 1, 3, stage='make_tool_input')
+    task_a = event('task', 0, 6, [event('stage', 1, 3, [llmcall], name='make_tool_input')], task='a')
+    task_b = event('task', 2, None, [event('failed', 8, None, reason_code='unsatisfied')], task='b')
+    return event('query', 0, 10, [task_a, task_b, event('result', 10, None)])
+
+
+def test_chrome_trace_nests_spans_and_puts_parallel_tasks_on_tracks():
+    trace = chrome_trace(query_with_parallel_tasks())['traceEvents']
+    spans = [(e['name'], e['tid'], e['ts'], e['dur']) for e in trace if e['ph'] == 'X']
+    assert spans == [
+        ('query', 1, 0.0, 10e6),
+        ('task', 1, 0.0, 6e6),
+        ('stage make_tool_input', 1, 1e6, 2e6),
+        ('llmcall make_tool_input', 1, 1e6, 2e6),
+        ('task', 2, 2e6, 6e6),
+    ]
+    assert [(e['name'], e['tid'], e['ts']) for e in trace if e['ph'] == 'i'] == [('failed unsatisfied', 2, 8e6)]
+    assert [e['args']['name'] for e in trace if e['ph'] == 'M'] == ['main', 'parallel 1']
+
+
+def test_collapsed_stacks_count_the_self_time():
+    stacks = dict(line.rsplit(' ', 1) for line in collapsed_stacks(query_with_parallel_tasks()).splitlines())
+    assert stacks == {
+        'query': '2000000', # not covered by the tasks
+        'query;task': '10000000', # 4s of task a and 6s of task b
+        'query;task;stage make_tool_input;llmcall make_tool_input': '2000000',
+    }
+
+
+def test_critical_path_and_closing_events():
+    query = query_with_parallel_tasks()
+    assert [(e.key, e.args.get('task')) for e in critical_path(query)] == [('query', None), ('task', 'b')]
+
+    tries = event('task', 0, None, [event('try', 0, None), event('try', 3, None), event('stage', 4, 5)])
+    assert close_events(tries) == at(5)
+    assert [(e.time, e.endtime) for e in tries.sub[:2]] == [(at(0), at(3)), (at(3), at(5))]
+
+
+def test_traced_query_exports_nested_spans():
+    tracer = tracing.TestTracer()
+    ReactlyAgent([count_l], llm=FakeLLM(RESPONSES), tracer=tracer).query("How many l are in hello?")
+    query = next(e for e in tracer.event.sub if e.key == 'query')
+    assert query.endtime is not None # closed by its result event
+    spans = [e for e in chrome_trace(query)['traceEvents'] if e['ph'] == 'X']
+    by_name = {span['name']: span for span in spans}
+    stage, llmcall = by_name['stage make_tool_input'], by_name['llmcall make_tool_input']
+    assert stage['ts'] <= llmcall['ts'] and llmcall['ts'] + llmcall['dur'] <= stage['ts'] + stage['dur']
+    assert 'toolrun count_l' in by_name
+    assert collapsed_stacks(query).startswith('query')
@@ -0,0 +1,69 @@
+import asyncio
+from typing import Dict, List
+from mlux_reactly.agent import tool_from_function
+from mlux_reactly.tool_index import ToolIndex, hashing_embed
+from mlux_reactly.core import shortlist_tools
+from mlux_reactly.types import AgentConfig, Task, ZeroTracer
+from conftest import count_l
+
+
+async def embed(texts: List[str]) -> List[List[float]]:
+    return hashing_embed(texts)
+
+
+def test_top_k_ranks_the_matching_tool_first():
+    def wikipedia(query: str) -> str:
+        """searches wikipedia articles"""
+        return query
+    index = ToolIndex([tool_from_function(count_l), tool_from_function(wikipedia)], embed)
+    top = asyncio.run(index.top_k("search wikipedia articles", 1))
+    assert [tool.name for tool, _ in top] == ['wikipedia']
+
+
+def test_top_k_of_empty_index():
+    assert asyncio.run(ToolIndex([], embed).top_k("anything", 3)) == []
+
+
+def make_tool(name: str):
+    def tool(query: str) -> str:
+        return query
+    tool.__name__ = name
+    tool.__doc__ = name
+    return tool_from_function(tool)
+
+
+def fixed_embed(vectors: Dict[str, List[float]]):
+    async def embed(texts: List[str]) -> List[List[float]]:
+        return [next(v for key, v in vectors.items() if key in text) for text in texts]
+    return embed
+
+
+def shortlist(tools, vectors, query: str, **config):
+    index = ToolIndex(tools, fixed_embed(vectors))
+    return asyncio.run(shortlist_tools(Task(query), tools, index, ZeroTracer(), AgentConfig(**config)))
+
+
+def test_shortlist_of_one_is_decisive_only_against_the_full_index():
+    tools = [make_tool('alpha'), make_tool('beta')]
+    vectors = {'alpha': [1.0, 0.0], 'beta': [0.95, 0.3], 'query': [1.0, 0.0]}
+    candidates, decisive = shortlist(tools, vectors, 'query', tool_prefilter_top_k=1, tool_prefilter_decisive_margin=0.2)
+    assert [tool.name for tool in candidates] == ['alpha'] and not decisive
+
+    vectors['beta'] = [0.0, 1.0]
+    candidates, decisive = shortlist(tools, vectors, 'query', tool_prefilter_top_k=1, tool_prefilter_decisive_margin=0.2)
+    assert [tool.name for tool in candidates] == ['alpha'] and decisive
+
+
+def test_single_tool_is_never_decisive():
+    tools = [make_tool('alpha')]
+    _, decisive = shortlist(tools, {'alpha': [1.0, 0.0], 'query': [1.0, 0.0]}, 'query', tool_prefilter_decisive_margin=0.2)
+    assert not decisive
+
+
+def test_decisive_tool_needs_a_minimum_similarity():
+    tools = [make_tool('alpha'), make_tool('beta')]
+    vectors = {'alpha': [0.3, 0.95, 0.0], 'beta': [-0.5, 0.0, 0.87], 'query': [1.0, 0.0, 0.0]}
+    _, decisive = shortlist(tools, vectors, 'query', tool_prefilter_decisive_margin=0.2)
+    assert not decisive
+    _, decisive = shortlist(tools, vectors, 'query', tool_prefilter_decisive_margin=0.2, tool_prefilter_decisive_min_score=0.2)
+    assert decisive
@@ -0,0 +1,103 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from mlux_reactly import ReactlyAgent, FakeLLM, AgentConfig, Tool, ToolError, ZeroTracer
+from mlux_reactly import tracer as tracing # TestTracer itself would be collected by pytest
+from mlux_reactly.core import ToolExecutors, run_tool
+from conftest import count_l, RESPONSES
+
+
+def test_agent_context_manager_shuts_the_tool_pools_down():
+    with ReactlyAgent([count_l], llm=FakeLLM(RESPONSES)) as agent:
+        assert agent.query("How many l are in hello?") == "It occurs 2 times."
+        assert agent.tool_executors._thread_pool is not None
+    assert agent.tool_executors._thread_pool is None
+
+
+def test_agent_async_context_manager_shuts_the_tool_pools_down():
+    async def main():
+        async with ReactlyAgent([count_l], llm=FakeLLM(RESPONSES)) as agent:
+            await agent.aquery("How many l are in hello?")
+            assert agent.tool_executors._thread_pool is not None
+        return agent
+    assert asyncio.run(main()).tool_executors._thread_pool is None
+
+
+def test_selected_tools_run_concurrently_with_a_timeout():
+    both_running = threading.Barrier(2, timeout=2) # passes only if both tools run at once
+
+    def left(text: str) -> str:
+        """left side"""
+        both_running.wait()
+        return "left result"
+
+    def right(text: str) -> str:
+        """right side"""
+        both_running.wait()
+        return "right result"
+
+    async def slow(text: str) -> str:
+        """never done in time"""
+        await asyncio.sleep(10)
+        return "slow result"
+
+    llm = FakeLLM(RESPONSES | {'rate_tools_for_task': '{"slow": 0.7, "left": 0.9, "right": 0.8}'})
+    agent = ReactlyAgent([slow, left, right], llm=llm, config=AgentConfig(max_parallel_tool_runs=3, tool_timeout=0.3))
+    start = time.perf_counter()
+    agent.query("How many l are in hello?")
+    assert time.perf_counter() - start < 2.0
+
+    answer_prompt = next(request.prompt for request in llm.requests if request.stage == 'try_answer_task')
+    results = json.loads(answer_prompt.split('\n')[0].removeprefix('Results: '))
+    assert [record['tool'] for record in results] == ['left', 'right', 'slow'] # by rating, not by finishing time
+    assert [record['result'] for record in results[:2]] == ["left result", "right result"]
+    assert results[2]['result']['error'] == 'timeout'
+
+
+def where_am_i() -> tuple:
+    return os.getpid(), threading.current_thread().name
+
+
+def run(tool: Tool, input: dict = {}, **kwargs):
+    executors = ToolExecutors(max_threads=2, max_processes=1)
+    try:
+        return asyncio.run(run_tool(tool, input, ZeroTracer(), executors=executors, **kwargs))
+    finally:
+        executors.shutdown()
+
+
+def test_tool_execution_modes():
+    inline_pid, inline_thread = run(Tool('where', run=where_am_i, execution='inline'))
+    assert inline_pid == os.getpid() and inline_thread == threading.current_thread().name
+    thread_pid, thread_name = run(Tool('where', run=where_am_i, execution='thread'))
+    assert thread_pid == os.getpid() and thread_name.startswith('mlux-reactly-tool')
+    process_pid, _ = run(Tool('where', run=where_am_i, execution='process'))
+    assert process_pid != os.getpid()
+
+
+def test_tool_timeouts():
+    def sleepy() -> str:
+        time.sleep(0.5)
+        return "late"
+
+    async def async_sleepy() -> str:
+        await asyncio.sleep(10)
+        return "late"
+
+    assert run(Tool('sleepy', run=sleepy), timeout=0.05) == ToolError('timeout', "the tool did not finish within 0.05s, its result is not available")
+    assert run(Tool('sleepy', run=sleepy, timeout=0.05), timeout=10).error == 'timeout' # the timeout of the tool wins
+    assert run(Tool('sleepy', run=sleepy, timeout=2), timeout=0.05) == "late"
+
+    tracer = tracing.TestTracer()
+    result = asyncio.run(run_tool(Tool('async_sleepy', run=async_sleepy), {}, tracer, timeout=0.05))
+    assert result.error == 'timeout'
+    failed = next(event for event in tracer.events_by_nr.values() if event.key == 'failed')
+    assert failed.args['reason_code'] == 'timeout' and failed.args['abandoned'] is False # cancelled instead
+
+
+def test_failing_tool_gives_a_tool_error():
+    def broken(text: str) -> str:
+        raise ValueError(f"cannot handle {text}")
+    assert run(Tool('broken', run=broken), {'text': 'this'}) == ToolError('exception', "tool failed: cannot handle this")
@@ -0,0 +1,77 @@
+import json
+import pytest
+from mlux_reactly import ReactlyAgent, FakeLLM, AgentConfig
+from mlux_reactly import tracer as tracing # TestTracer itself would be collected by pytest
+from mlux_reactly.tracer import TraceSink, TraceStore
+from mlux_reactly.tracer.trace_store import main
+from conftest import count_l, RESPONSES
+
+
+def record_queries(tracer) -> None:
+    config = AgentConfig(max_nr_tries_per_task=1)
+    ReactlyAgent([count_l], llm=FakeLLM(RESPONSES), tracer=tracer, config=config).query("How many l are in hello?")
+    ReactlyAgent([count_l], llm=FakeLLM(RESPONSES | {'split_question_into_tasks': 'no json'}), tracer=tracer, config=config).query("broken")
+
+
+@pytest.fixture
+def store_path(tmp_path) -> str:
+    trace_path = str(tmp_path / "trace.jsonl")
+    sink = TraceSink(trace_path)
+    record_queries(tracing.TestTracer(sink=sink))
+    sink.close()
+    path = str(tmp_path / "traces.sqlite")
+    store = TraceStore(path)
+    assert store.import_trace(trace_path) == [1]
+    store.close()
+    return path
+
+
+def test_trace_store_lookup_and_filters(store_path):
+    store = TraceStore(store_path)
+    queries = store.find(key='query')
+    assert [store.get(1, query['nr'])['args']['user_question'] for query in queries] == ["How many l are in hello?", "broken"]
+    assert all(query['duration'] is not None and not query['failed'] for query in queries)
+    assert {child['key'] for child in store.children(1, queries[0]['nr'])} >= {'stage', 'task', 'result'}
+
+    failed_stages = store.find(key='stage', model='fake', failed=True)
+    assert [(row['name'], row['nr'] > queries[1]['nr']) for row in failed_stages] == [('split_question_into_tasks', True)]
+
+    slowest = store.find(key='llmcall', slowest=True, limit=3)
+    assert len(slowest) == 3
+    assert [row['duration'] for row in slowest] == sorted((row['duration'] for row in store.find(key='llmcall')), reverse=True)[:3]
+
+    tree = store.load_event(1, queries[0]['nr'], depth=1)
+    assert tree is not None and tree.endtime is not None
+    assert all(sub.sub == [] for sub in tree.sub)
+    assert store.get(1, 10**6) is None
+    store.close()
+
+
+def test_trace_store_imports_a_tracer_in_memory(tmp_path):
+    tracer = tracing.TestTracer()
+    record_queries(tracer)
+    store = TraceStore(str(tmp_path / "traces.sqlite"))
+    session = store.import_tracer(tracer)
+    assert [row['name'] for row in store.find(session=session, key='stage', failed=True)] == ['split_question_into_tasks']
+    assert len(store.find(session=session, key='query')) == 2
+    store.close()
+
+
+def test_trace_store_cli(store_path, capsys):
+    main([store_path, 'sessions'])
+    assert "1 " in capsys.readouterr().out
+
+    main([store_path, 'find', '--key', 'stage', '--failed'])
+    rows = capsys.readouterr().out.splitlines()
+    assert len(rows) == 1 and 'split_question_into_tasks' in rows[0] and rows[0].endswith('FAILED')
+    query_nr = int(rows[0].split()[0].split(':')[1]) - 1 # the failed stage is the first event of its query
+
+    main([store_path, 'show', str(query_nr), '--depth', '1'])
+    assert 'broken' in capsys.readouterr().out
+
+    main([store_path, 'export', str(query_nr)])
+    spans = [event for event in json.loads(capsys.readouterr().out)['traceEvents'] if event.get('ph') == 'X']
+    assert spans and spans[0]['name'].startswith('query')
+
+    main([store_path, 'show', '999999'])
+    assert "no such event" in capsys.readouterr().out
@@ -0,0 +1,108 @@
+import json
+import math
+import threading
+import time
+from mlux_reactly import tracer as tracing # TestTracer itself would be collected by pytest
+from mlux_reactly import ReactlyAgent, FakeLLM
+from mlux_reactly.tracer import TraceSink, MetricsTracer, read_trace
+from mlux_reactly.tracer.metrics_tracer import Histogram
+from conftest import count_l, RESPONSES
+
+
+def test_trace_sink_round_trip(tmp_path):
+    path = str(tmp_path / "trace.binary")
+    sink = TraceSink(path, format='binary')
+    tracer = tracing.TestTracer(sink=sink)
+    query = tracer.on('query', {'user_question': 'q', 'sys_prompt': 'long static prompt'})
+    query.on('llmcall', {'stage': 's', 'sys_prompt': 'long static prompt'})
+    query.add_arg('prompt_tokens', 12)
+    sink.close()
+
+    records = list(read_trace(path))
+    events = [r for r in records if r['t'] == 'event']
+    assert [e['key'] for e in events] == ['query', 'llmcall']
+    assert events[1]['parent'] == events[0]['nr']
+    assert events[1]['args']['sys_prompt'] == 'long static prompt'
+    assert {'t': 'arg', 'nr': events[0]['nr'], 'name': 'prompt_tokens', 'value': 12} in records
+
+
+def test_trace_sink_survives_unserializable_values(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    sink = TraceSink(path)
+    tracer = tracing.TestTracer(sink=sink)
+    tracer.on('toolrun', {'result': {(1, 2): 'tuple key'}}).add_arg('input', {(3, 4): 1})
+    tracer.on('query', {'user_question': 'next'})
+    sink.flush()
+    assert [r['key'] for r in read_trace(path) if r['t'] == 'event'] == ['toolrun', 'query']
+    sink.close()
+
+
+def test_trace_sink_drops_records_instead_of_blocking(tmp_path):
+    sink = TraceSink(str(tmp_path / "trace.jsonl"), max_queue=2)
+    tracer = tracing.TestTracer(sink=sink)
+    query = tracer.on('query', {'user_question': 'q'})
+    for i in range(10000):
+        query.add_arg('n', i)
+    sink.close()
+    assert sink.dropped > 0
+    assert sink.records_written + sink.dropped == 10000 + 2 # and the session and query records
+
+
+def test_trace_sink_flush_and_close_do_not_wait_for_a_stuck_writer(tmp_path, capsys):
+    sink = TraceSink(str(tmp_path / "trace.jsonl"), max_queue=2)
+    stuck = threading.Event()
+    write_item = sink._write_item
+    sink._write_item = lambda item: (stuck.wait(), write_item(item)) # type: ignore[method-assign]
+    tracer = tracing.TestTracer(sink=sink)
+    query = tracer.on('query', {'user_question': 'q'})
+    for i in range(10):
+        query.add_arg('n', i)
+    start = time.monotonic()
+    assert not sink.flush(timeout=0.2)
+    sink.close(timeout=0.2)
+    assert time.monotonic() - start < 2.0
+    assert "records dropped" in capsys.readouterr().err
+    stuck.set()
+
+
+def metrics_of_a_query() -> MetricsTracer:
+    metrics = MetricsTracer()
+    llm = FakeLLM(RESPONSES | {'rate_task_answer': ['no json', '{"satisfaction": 0.9}']})
+    ReactlyAgent([count_l], llm=llm, tracer=metrics).query("How many l are in hello?")
+    return metrics
+
+
+def test_metrics_tracer_prometheus_text():
+    lines = metrics_of_a_query().prometheus_text().splitlines()
+    assert 'reactly_duration_seconds_count{key="query",name=""} 1' in lines
+    assert 'reactly_duration_seconds_count{key="toolrun",name="count_l"} 1' in lines
+    assert 'reactly_duration_seconds_bucket{key="query",name="",le="+Inf"} 1' in lines
+    assert 'reactly_retries_total{key="stage",name="rate_task_answer"} 1' in lines
+    assert 'reactly_attempt_failures_total{key="stage",name="rate_task_answer",reason="json_parsing"} 1' in lines
+    assert any(line.startswith('reactly_tokens_total{model="fake",stage="try_answer_task",kind="completion"} ') for line in lines)
+    assert '# TYPE reactly_duration_seconds histogram' in lines
+
+
+def test_metrics_tracer_json_snapshots(tmp_path):
+    metrics = metrics_of_a_query()
+    snapshot = json.loads(json.dumps(metrics.snapshot()))
+    query = next(d for d in snapshot['durations'] if d['key'] == 'query')
+    assert query['count'] == 1 and query['buckets']['+Inf'] == 1 and query['p50'] is not None
+    assert snapshot['retries'] == [{'labels': ['stage', 'rate_task_answer'], 'value': 1}]
+    assert snapshot['events']['llmcall'] == 8
+
+    path = str(tmp_path / "metrics.jsonl")
+    metrics.start_snapshots(path, interval=60)
+    metrics.close() # writes a last snapshot
+    with open(path) as file:
+        assert [json.loads(line)['events'] for line in file] == [snapshot['events']]
+
+
+def test_histogram_quantiles():
+    histogram = Histogram((1.0, 2.0, 4.0))
+    for value in [0.5, 1.5, 1.5, 3.0, 10.0]:
+        histogram.observe(value)
+    assert histogram.cumulative() == [(1.0, 1), (2.0, 3), (4.0, 4), (math.inf, 5)]
+    assert histogram.quantile(0.5) == 1.75 # half way through the (1, 2] bucket
+    assert histogram.quantile(1.0) == 4.0 # beyond the largest finite bucket
+    assert Histogram((1.0,)).quantile(0.5) is None
@@ -0,0 +1,46 @@
+from mlux_reactly.verifiers import containment_verifier, lexical_overlap_verifier, numeric_verifier
+from mlux_reactly.types import ToolError
+
+
+TASK = "Where was the author of Dune born?"
+
+
+def test_numeric_verifier():
+    verify = numeric_verifier()
+    assert verify("How many l?", "There are 3 l.", [3]) == 1.0
+    assert verify("How many l?", "There are 4 l.", [3]) is None
+    assert verify("How many l?", "There are 3 l.", [ToolError("exception", "3")]) is None
+
+
+def test_containment_verifier():
+    verify = containment_verifier()
+    assert verify(TASK, "He was born in Tacoma, Washington.", ["Tacoma, Washington"]) == 1.0
+    assert verify(TASK, "He was born in Paris.", ["Tacoma, Washington"]) is None
+
+
+def test_lexical_overlap_scores_below_exact_checks():
+    score = lexical_overlap_verifier()(TASK, "Frank Herbert was born in Tacoma", ["Frank Herbert was born in Tacoma, Washington, in 1920."])
+    assert score is not None and 0.5 < score < 1.0
+
+
+def test_lexical_overlap_ignores_the_wording_of_the_task():
+    verify = lexical_overlap_verifier()
+    results = ["Frank Herbert was born in Tacoma, Washington, in 1920."]
+    assert verify(TASK, "The author of Dune was born in the city", results) is None
+    assert verify(TASK, "The author of Dune was born", results) is None
+    assert verify(TASK, "Frank Herbert was born in Paris", results) is None
+
+
+def test_containment_verifier_matches_whole_words_only():
+    verify = containment_verifier()
+    assert verify(TASK, "I do not know.", ["no"]) is None
+    assert verify(TASK, "Parisian cafes are nice.", ["Paris"]) is None
+    assert verify(TASK, "He was born in Paris.", ["Paris"]) == 1.0
+    assert verify(TASK, "It is in the Tacoma   Washington area.", ["tacoma washington"]) == 1.0
+
+
+def test_containment_verifier_ignores_unspecific_results():
+    verify = containment_verifier()
+    assert verify(TASK, "Yes, he was.", ["yes"]) is None
+    assert verify(TASK, "Go to room B.", ["B"]) is None
+    assert verify(TASK, "Go to room B7.", ["B7"]) == 1.0